@@ -0,0 +1,250 @@
+from __future__ import division
+import collections
+import os
+import logging
+import numpy as np
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+JND = 2.3 # "just noticeable difference"
+LAB_COLUMNS = ['L1', 'a1', 'b1', 'L2', 'a2', 'b2',
+               'L3', 'a3', 'b3', 'L4', 'a4', 'b4']
+L_COLUMNS = [0, 3, 6, 9]
+MAX_E = 512 # more than the distance between any two Lab colors
+
+_Match = collections.namedtuple('Match', 'image_id E_sq dL usages filename')
+
+class Match(_Match):
+    """A chosen pool image. Like the sqlite Row returned by
+    SqlImagePool.choose_match, fields can be had by position or by name,
+    e.g. match[4] or match['filename']."""
+    __slots__ = ()
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return getattr(self, key)
+        return _Match.__getitem__(self, key)
+
+def load_features(db, low=None, high=None):
+    """Read the Lab colors of every image in a pool database, or those with
+    low <= image_id <= high. Return image_ids (sorted), an (N, 12) float32
+    array of L1, a1, b1, ..., b4, usages, and filenames. Usage is counted
+    afresh for each render, so usages are all zero."""
+    c = db.cursor()
+    try:
+        c.execute("""SELECT image_id, {0}, filename
+                     FROM LabColors
+                     JOIN Images USING (image_id)
+                     WHERE image_id BETWEEN ? AND ?
+                     ORDER BY image_id""".format(', '.join(LAB_COLUMNS)),
+                  (-2**63 if low is None else low,
+                   2**63 - 1 if high is None else high))
+        rows = c.fetchall()
+    finally:
+        c.close()
+    n = len(rows)
+    image_ids = np.fromiter((row[0] for row in rows), np.int64, n)
+    features = np.empty((n, 12), dtype=np.float32)
+    for i, row in enumerate(rows):
+        features[i] = tuple(row)[1:13]
+    usages = np.zeros(n, dtype=np.int64)
+    filenames = [row[13] for row in rows]
+    return image_ids, features, usages, filenames
+
+class ArrayMatcher:
+    """Match tiles against a pool held in memory as a contiguous (N, 12)
+    float32 array, with the same rules as SqlImagePool.choose_match, but
+    computed for all images at once with NumPy. Usage counts are kept in
+    an array."""
+    def __init__(self, image_ids, features, usages, filenames, seed=None):
+        self.image_ids = image_ids
+        self.features = np.ascontiguousarray(features, dtype=np.float32)
+        # One contiguous row per channel, for computing distances to many
+        # targets at once.
+        self.columns = np.ascontiguousarray(self.features.T)
+        self.norms = None
+        self.usages = usages
+        self.filenames = filenames
+        self.random = np.random.RandomState(seed)
+
+    @classmethod
+    def from_pool(cls, pool, seed=None):
+        "Load the features of every image in a SqlImagePool."
+        matcher = cls(*load_features(pool.db), seed=seed)
+        logger.info("Loaded %d images into memory for matching.",
+                    len(matcher.image_ids))
+        return matcher
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def reset_usage(self):
+        self.usages[:] = 0
+
+    def usage_counts(self):
+        "Return a dict of the usage of each image used, by image_id."
+        used = np.flatnonzero(self.usages)
+        return dict(zip(self.image_ids[used].tolist(),
+                        self.usages[used].tolist()))
+
+    def distances(self, targets, rows=None):
+        """Compare targets, an (M, 12) array, with each pool image (or just
+        the given rows). Return two (M, N) arrays: E_sq, the mean squared
+        distance over the quadrants, and dL, the mean difference in
+        lightness."""
+        columns = self.columns if rows is None else self.columns[:, rows]
+        return column_distances(columns, targets)
+
+    def choose_match(self, lab, tolerance=1, usage_penalty=1):
+        """If there is are good matches (within tolerance times the 'just
+        noticeable difference'), return one at random. If not, choose the
+        closest match deterministically. Return the match as a Match."""
+        return self.choose_matches([lab], tolerance, usage_penalty)[0]
+
+    def choose_matches(self, labs, tolerance=1, usage_penalty=1, block=64):
+        """Choose matches for a list of targets, as choose_match would one
+        after the other, with the same results. Distances are computed for
+        block targets at a time."""
+        matches = []
+        for start in range(0, len(labs), block):
+            targets = as_targets(labs[start:start + block])
+            E_sq, dL = self.distances(targets)
+            for i in range(len(targets)):
+                matches.append(self._choose(E_sq[i], dL[i], None,
+                                            tolerance, usage_penalty))
+        return matches
+
+    def top_k(self, labs, k=20, block=256):
+        """Find the k closest images to each target, ignoring usage. Return
+        their rows and E_sq, both arrays of shape (len(labs), k), nearest
+        first. Targets are compared with the pool block at a time."""
+        k = min(k, len(self))
+        if self.norms is None:
+            self.norms = (self.features**2).sum(1)
+        rows = np.empty((len(labs), k), dtype=np.int64)
+        E_sq = np.empty((len(labs), k), dtype=np.float32)
+        for start in range(0, len(labs), block):
+            targets = as_targets(labs[start:start + block])
+            # |f - t|^2 = |f|^2 - 2 f.t + |t|^2, and the last term is the
+            # same for every image, so it can be left out when ranking.
+            rank = self.norms - 2*np.dot(targets, self.columns)
+            near = np.argpartition(rank, k - 1, 1)[:, :k]
+            rows[start:start + len(near)], E_sq[start:start + len(near)] = \
+                self._sort_rows(targets, near)
+        return rows, E_sq
+
+    def _sort_rows(self, targets, rows):
+        """Compute the exact E_sq between each target and its rows, and sort
+        the rows of each target by it."""
+        diff = self.features[rows] - targets[:, np.newaxis, :]
+        E_sq = (diff*diff).sum(2)/4
+        order = E_sq.argsort(1, kind='mergesort')
+        within = np.arange(len(rows))[:, np.newaxis]
+        return rows[within, order], E_sq[within, order]
+
+    def _choose(self, E_sq, dL, rows, tolerance, usage_penalty):
+        """Pick among candidates, given their distances from the target.
+        rows are their indexes in the pool, or None for the whole pool."""
+        tol = tolerance*JND
+        penalty = usage_penalty*JND
+        # The same rules as the SQL query: the candidates are the images
+        # within a radius of the target, starting from the tolerance and
+        # widening until there are some; they are ranked by their exact E
+        # plus a random component set by the tolerance, plus the usage
+        # penalty.
+        r = max(tolerance, 1)*JND
+        passing = np.flatnonzero(E_sq <= r*r)
+        while len(passing) == 0:
+            if r > MAX_E:
+                return None
+            r *= 2
+            passing = np.flatnonzero(E_sq <= r*r)
+        candidates = passing if rows is None else rows[passing]
+        jitter = self.random.uniform(-1, 1, len(passing))
+        score = (E_sq[passing] + tol*tol*jitter
+                 + penalty*penalty*self.usages[candidates])
+        best = passing[score.argmin()]
+        i = best if rows is None else rows[best]
+        match = Match(int(self.image_ids[i]), float(E_sq[best]),
+                      float(dL[best]), int(self.usages[i]), self.filenames[i])
+        self.usages[i] += 1
+        logger.debug("%s", match)
+        return match
+
+class IndexMatcher(ArrayMatcher):
+    """An ArrayMatcher that only considers the candidates an index finds
+    for each target: the rows returned by candidates(target, k), which
+    subclasses provide. The tolerance jitter and usage penalty are applied
+    among those. Distances are computed for those rows alone, so features
+    need not be in memory: a memory-mapped array will do."""
+    def __init__(self, image_ids, features, usages, filenames, index, k=50,
+                 seed=None):
+        self.image_ids = image_ids
+        self.features = features
+        self.usages = usages
+        self.filenames = filenames
+        self.random = np.random.RandomState(seed)
+        self.index = index
+        self.k = k
+
+    def candidates(self, target, k):
+        "The rows of (up to) k images near target."
+        raise NotImplementedError
+
+    def distances(self, targets, rows=None):
+        features = self.features if rows is None else self.features[rows]
+        return column_distances(features.T, targets)
+
+    def choose_matches(self, labs, tolerance=1, usage_penalty=1):
+        matches = []
+        for target in as_targets(labs):
+            rows = self.candidates(target, self.k)
+            E_sq, dL = self.distances(target[np.newaxis], rows)
+            matches.append(self._choose(E_sq[0], dL[0], rows, tolerance,
+                                        usage_penalty))
+        return matches
+
+class SavedIndex(object):
+    """An index over the Lab vectors of a pool, saved next to the pool
+    database. Subclasses are made from image_ids and features, and provide
+    save, load and update."""
+    @classmethod
+    def open(cls, path, image_ids, features):
+        """Load the index saved at path, or build one, and bring it up to
+        date with the given images. Save it if it changed."""
+        index = None
+        if os.path.exists(path):
+            try:
+                index = cls.load(path)
+            except Exception as e:
+                logger.warning("Cannot load the index at %s (%s). "
+                               "Rebuilding it.", path, e)
+        if index is None:
+            index = cls(image_ids, features)
+            changed = True
+        else:
+            changed = index.update(image_ids, features)
+        if changed:
+            index.save(path)
+        return index
+
+def column_distances(columns, targets):
+    """Compare targets, an (M, 12) array, with images given by channel, a
+    (12, N) array. Return E_sq and dL, as ArrayMatcher.distances does."""
+    shape = (len(targets), columns.shape[1])
+    E_sq = np.zeros(shape, dtype=np.float32)
+    dL = np.zeros(shape, dtype=np.float32)
+    # Accumulate one channel at a time, so the result for each target
+    # does not depend on how many targets are compared at once.
+    for ch in range(12):
+        diff = columns[ch] - targets[:, ch, np.newaxis]
+        E_sq += diff*diff
+        if ch in L_COLUMNS:
+            dL += diff
+    return E_sq/4, dL/4
+
+def as_targets(labs):
+    "Convert a list of targets, each four (L, a, b) colors, to an (M, 12) array."
+    return np.asarray(labs, dtype=np.float32).reshape(-1, 12)
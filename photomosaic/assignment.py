@@ -0,0 +1,128 @@
+"""Match all tiles at once, as an assignment problem.
+
+Instead of choosing a match for each tile in turn, with a penalty for
+reuse, find the matches that minimize the total distance over all tiles
+while using no image more than max_usage times. Only the k nearest images
+to each tile are considered, so the problem is a sparse bipartite graph,
+solved with an auction algorithm."""
+from __future__ import division
+import logging
+import numpy as np
+from array_matcher import Match, L_COLUMNS, as_targets
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+def auction(candidates, costs, capacity, epsilon=0.01):
+    """Assign each row (tile) one of its candidate objects (images), with
+    no object given to more rows than its capacity, at minimum total cost.
+    candidates and costs are (T, K) arrays listing each row's candidates,
+    distinct within a row; candidates are indexes into capacity, or -1 for
+    none. Every row must have a candidate that no other row has, or the
+    problem may have no solution. Return the object assigned to each row.
+
+    This is Bertsekas' auction, with all unassigned rows bidding at once in
+    each round. An object keeps its highest bids, as many as its capacity,
+    and once full, its price is the lowest bid it keeps; copies of an
+    object are not bid for separately, as that starts a price war among
+    them. The total cost is within T*epsilon of the optimum. There are
+    more places than rows, so prices have to start from zero:
+    epsilon-scaling would leave stale prices on the objects nobody takes."""
+    T, K = candidates.shape
+    valid = candidates >= 0
+    safe = np.where(valid, candidates, 0)
+    price = np.zeros(len(capacity))
+    assigned = np.full(T, -1, dtype=np.int64)
+    held_bid = np.zeros(T)
+    unassigned = np.arange(T)
+    rounds = 0
+    while len(unassigned):
+        rounds += 1
+        value = -costs[unassigned] - price[safe[unassigned]]
+        value[~valid[unassigned]] = -np.inf
+        within = np.arange(len(unassigned))
+        first = value.argmax(1)
+        best = value[within, first]
+        value[within, first] = -np.inf
+        second = value.max(1)
+        # With only one candidate, any bid wins; raise it by epsilon.
+        gap = np.where(np.isfinite(second), best - second, 0)
+        bid_obj = candidates[unassigned, first]
+        bid = price[bid_obj] + gap + epsilon
+        # Each object bid for keeps the highest of its new bids and the
+        # bids it already holds.
+        holding = np.flatnonzero(np.in1d(assigned, bid_obj))
+        rows = np.concatenate([holding, unassigned])
+        objs = np.concatenate([assigned[holding], bid_obj])
+        bids = np.concatenate([held_bid[holding], bid])
+        order = np.lexsort((-bids, objs))
+        objs = objs[order]
+        starts = np.flatnonzero(np.r_[True, objs[1:] != objs[:-1]])
+        rank = np.arange(len(objs)) - np.repeat(starts, np.diff(
+            np.r_[starts, len(objs)]))
+        keep = rank < capacity[objs]
+        assigned[rows[order]] = np.where(keep, objs, -1)
+        held_bid[rows[order]] = bids[order]
+        # Full objects are priced at their lowest kept bid.
+        last = order[keep & (rank == capacity[objs] - 1)]
+        price[objs[keep & (rank == capacity[objs] - 1)]] = bids[last]
+        unassigned = np.flatnonzero(assigned < 0)
+    logger.debug("Solved in %d rounds.", rounds)
+    return assigned
+
+def assign_matches(matcher, labs, max_usage=1, k=20, block=256):
+    """Choose a match for every target in labs with an in-memory matcher,
+    minimizing the total E_sq with no image used more than max_usage
+    times (counting usages the matcher has already recorded). Each target
+    may only get one of its k nearest images; targets left without one
+    get the nearest image that is still available, or the nearest image
+    if the pool is used up. Return a list of Match; their usages are the
+    images' counts after the assignment."""
+    targets = as_targets(labs)
+    T = len(targets)
+    if T == 0:
+        return []
+    rows, costs = matcher.top_k(targets, k, block)
+    images, inverse = np.unique(rows, return_inverse=True)
+    inverse = inverse.reshape(rows.shape)
+    room = np.maximum(max_usage - matcher.usages[images], 0)
+    # Each target also gets a private overflow place, which costs more
+    # than any real candidate, so that a solution always exists.
+    candidates = np.column_stack([np.where(room[inverse] > 0, inverse, -1),
+                                  len(images) + np.arange(T)])
+    costs = np.column_stack([costs, np.full(T, 2*costs.max() + 1)])
+    capacity = np.concatenate([room, np.ones(T, dtype=room.dtype)])
+    assigned = auction(candidates, costs.astype(float), capacity)
+    chosen = np.where(assigned < len(images),
+                      images[np.minimum(assigned, len(images) - 1)], -1)
+    overflow = np.flatnonzero(chosen < 0)
+    if len(overflow):
+        logger.info("%d of %d tiles had no free candidate among their %d "
+                    "nearest images.", len(overflow), T, rows.shape[1])
+    # Record the usages of the assigned images first, so that the overflow
+    # tiles only take images that still have room.
+    np.add.at(matcher.usages, chosen[chosen >= 0], 1)
+    reused = 0
+    for t in overflow:
+        E_sq = matcher.distances(targets[t:t + 1])[0][0]
+        full = matcher.usages >= max_usage
+        if full.all():
+            reused += 1
+        else:
+            E_sq[full] = np.inf
+        chosen[t] = E_sq.argmin()
+        matcher.usages[chosen[t]] += 1
+    if reused:
+        logger.warning("Every image has been used %d times. %d tiles reuse "
+                       "images anyway.", max_usage, reused)
+    return [make_match(matcher, row, target)
+            for row, target in zip(chosen, targets)]
+
+def make_match(matcher, row, target):
+    "Describe the image at row of the matcher as a match for target."
+    diff = matcher.features[row] - target
+    return Match(int(matcher.image_ids[row]), float((diff**2).sum()/4),
+                 float(diff[L_COLUMNS].mean()), int(matcher.usages[row]),
+                 matcher.filenames[row])
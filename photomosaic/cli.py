@@ -22,13 +22,35 @@ def args_parser(output_file=False):
     parser.add_argument('-m', '--mask')
     parser.add_argument('-w', '--output_width', type=int)
     parser.add_argument('-g', '--grey_values', action='store_true')
+    parser.add_argument('-j', '--processes', default=1, type=int)
+    parser.add_argument('--fast_decode', '--fast-decode', action='store_true')
+    parser.add_argument('-t', '--thumbnail_sizes', nargs='*', type=int)
+    parser.add_argument('-e', '--estimator')
+    parser.add_argument('--matcher', default='sql')
+    parser.add_argument('--assign', action='store_true')
+    parser.add_argument('--max_usage', default=1, type=int)
+    parser.add_argument('--record_usage', action='store_true')
+    parser.add_argument('--save_plan')
+    parser.add_argument('--load_plan')
+    parser.add_argument('--vectorized', action='store_true')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--pad', default=0, type=float)
+    parser.add_argument('--scatter', action='store_true')
+    parser.add_argument('--margin', default=0, type=int)
+    parser.add_argument('--scaled_margin', action='store_true')
+    parser.add_argument('--strip_height', type=int)
     return parser
     
 def get_database(args):
     from sql_image_pool import SqlImagePool
-    pool = SqlImagePool(args.database)
-    for folder in args.folders:
-        pool.add_directory(folder)
+    pool = SqlImagePool(args.database, args.thumbnail_sizes, args.estimator)
+    if args.folders:
+        with pool.bulk_load():
+            for folder in args.folders:
+                pool.add_directory(folder, processes=args.processes,
+                                   fast_decode=args.fast_decode)
+    pool.set_matcher(args.matcher)
     return pool    
 
 
@@ -39,9 +61,30 @@ if __name__=='__main__':
     pool = get_database(args)
 
     p = Photomosaic(args.infile, pool, tuning=args.tune, mask=args.mask, debris=args.grey_values)
-    p.partition_tiles(args.dimensions, depth=args.recursion_level)
-    p.match()
-    p.assemble(new_width=args.output_width)
-    p.save(args.outfile)
+    if args.load_plan:
+        p.load_plan(args.load_plan)
+    else:
+        p.partition_tiles(args.dimensions, depth=args.recursion_level,
+                          vectorized=args.vectorized,
+                          processes=args.processes, seed=args.seed)
+        if args.assign:
+            p.match(method='assign', max_usage=args.max_usage)
+        else:
+            p.match()
+        if args.record_usage:
+            pool.flush_usage()
+    if args.save_plan:
+        p.save_plan(args.save_plan)
+    threads = args.processes if args.processes > 1 else None
+    style = dict(pad=args.pad, scatter=args.scatter, margin=args.margin,
+                 scaled_margin=args.scaled_margin)
+    if args.strip_height:
+        p.assemble_streaming(args.outfile, args.strip_height,
+                             new_width=args.output_width,
+                             shuffle=args.shuffle, threads=threads, **style)
+    else:
+        p.assemble(new_width=args.output_width, shuffle=args.shuffle,
+                   threads=threads, **style)
+        p.save(args.outfile)
     
     pool.close()
@@ -0,0 +1,129 @@
+"""Ways to estimate the dominant color of image regions.
+
+Each estimator takes a list of RGB images (regions) and returns a list of
+[r, g, b] integers, one per region. 'kmeans' is the original method; the
+others are deterministic, and all but 'kmeans' work on many regions at
+once in NumPy."""
+from __future__ import division
+import numpy as np
+from PIL import Image
+from image_functions import dominant_color
+
+def region_pixels(regions, size=50):
+    """Scale each region to size x size and stack their pixels into an
+    array of shape (len(regions), size*size, 3)."""
+    pixels = np.empty((len(regions), size*size, 3), dtype=float)
+    for i, region in enumerate(regions):
+        assert region.mode == 'RGB', 'RGB images only!'
+        small = region.resize((size, size), Image.ANTIALIAS)
+        pixels[i] = np.asarray(small, dtype=float).reshape(-1, 3)
+    return pixels
+
+def _as_ints(colors):
+    return np.round(colors).astype(int).tolist()
+
+def kmeans_colors(regions, size=50, clusters=5):
+    "The original method: scipy k-means on each region, randomly seeded."
+    return [dominant_color(region, clusters, size) for region in regions]
+
+def mean_colors(regions, size=50):
+    "The mean color of each region. The fastest, and blurs the most."
+    return mean_of_pixels(region_pixels(regions, size))
+
+def mean_of_pixels(pixels):
+    return _as_ints(pixels.mean(1))
+
+def median_colors(regions, size=50):
+    "The median of each channel in each region."
+    return median_of_pixels(region_pixels(regions, size))
+
+def median_of_pixels(pixels):
+    return _as_ints(np.median(pixels, 1))
+
+def histogram_colors(regions, size=50, bins=8):
+    """Quantize each channel into bins levels, find the most populous cell of
+    the RGB histogram, and return the mean color of the pixels in it."""
+    return histogram_of_pixels(region_pixels(regions, size), bins)
+
+def histogram_of_pixels(pixels, bins=8):
+    n, p, _ = pixels.shape
+    q = np.minimum((pixels*(bins/256.)).astype(int), bins - 1)
+    cells = q[:, :, 0]*bins*bins + q[:, :, 1]*bins + q[:, :, 2]
+    # Number the cells of all regions consecutively to count them at once.
+    cells += (np.arange(n)*bins**3)[:, np.newaxis]
+    counts = np.bincount(cells.ravel(), minlength=n*bins**3)
+    best = counts.reshape(n, bins**3).argmax(1) + np.arange(n)*bins**3
+    in_best = cells == best[:, np.newaxis]
+    sums = (pixels*in_best[:, :, np.newaxis]).sum(1)
+    return _as_ints(sums/in_best.sum(1)[:, np.newaxis])
+
+def batched_kmeans_colors(regions, size=50, clusters=5, iterations=10):
+    """k-means on all regions at once, starting deterministically from
+    pixels spread evenly through each region's range of brightness. Return
+    the center of each region's largest cluster."""
+    return batched_kmeans_of_pixels(region_pixels(regions, size), clusters,
+                                    iterations)
+
+def batched_kmeans_of_pixels(pixels, clusters=5, iterations=10, block=128):
+    "Run k-means on blocks of regions, to bound the memory used."
+    colors = []
+    for start in range(0, len(pixels), block):
+        colors += _kmeans_block(pixels[start:start + block], clusters,
+                                iterations)
+    return colors
+
+def _kmeans_block(pixels, clusters, iterations):
+    n, p, _ = pixels.shape
+    rows = np.arange(n)[:, np.newaxis]
+    order = pixels.sum(2).argsort(1)
+    picks = order[:, np.linspace(0, p - 1, clusters).astype(int)]
+    centers = pixels[rows, picks]
+    offsets = (np.arange(n)*clusters)[:, np.newaxis]
+    flat = [pixels[:, :, ch].ravel() for ch in range(3)]
+    labels = None
+    for i in range(iterations):
+        # |x - c|^2 = |c|^2 - 2 x.c + |x|^2, and the last term is the same
+        # for every center, so it can be left out.
+        dist = ((centers**2).sum(2)[:, np.newaxis, :]
+                - 2*np.matmul(pixels, centers.transpose(0, 2, 1)))
+        new_labels = dist.argmin(2) + offsets
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+        counts = np.bincount(labels.ravel(), minlength=n*clusters)
+        sums = np.column_stack([np.bincount(labels.ravel(), flat[ch],
+                                            minlength=n*clusters)
+                                for ch in range(3)])
+        filled = counts > 0
+        new_centers = centers.reshape(-1, 3).copy()
+        # Empty clusters keep their old centers.
+        new_centers[filled] = sums[filled]/counts[filled][:, np.newaxis]
+        centers = new_centers.reshape(n, clusters, 3)
+    largest = counts.reshape(n, clusters).argmax(1)
+    return _as_ints(centers[np.arange(n), largest])
+
+ESTIMATORS = {'kmeans': kmeans_colors,
+              'mean': mean_colors,
+              'median': median_colors,
+              'histogram': histogram_colors,
+              'batched-kmeans': batched_kmeans_colors}
+
+def get_estimator(name):
+    try:
+        return ESTIMATORS[name]
+    except KeyError:
+        raise ValueError("Unknown color estimator %r. Choose from: %s"
+                         % (name, ', '.join(sorted(ESTIMATORS))))
+
+# The same methods, applied to pixels already stacked into an array of
+# shape (regions, pixels, 3). There is no randomly seeded k-means for many
+# regions at once; 'kmeans' means the batched k-means here.
+PIXEL_ESTIMATORS = {'kmeans': batched_kmeans_of_pixels,
+                    'mean': mean_of_pixels,
+                    'median': median_of_pixels,
+                    'histogram': histogram_of_pixels,
+                    'batched-kmeans': batched_kmeans_of_pixels}
+
+def get_pixel_estimator(name):
+    get_estimator(name) # Fail the same way for unknown names.
+    return PIXEL_ESTIMATORS[name]
@@ -72,3 +72,18 @@ def rgb2CIE_Lab(rgb):
     return xyz2CIE_Lab(rgb2xyz(rgb))
 
 rgb2lab = rgb2CIE_Lab
+
+def rgb2lab_array(rgb):
+    """Compute L, a, b for an array of colors, shape (..., 3), by the same
+    steps as rgb2lab, all at once."""
+    t = np.asarray(rgb, dtype=float)/255.
+    t = np.where(t > 0.04045, 100*((t + 0.055)/1.055)**2.4, 100*t/12.92)
+    matrix = np.array([[0.4124, 0.3576, 0.1805],
+                       [0.2126, 0.7152, 0.0722],
+                       [0.0193, 0.1192, 0.9505]])
+    xyz = np.dot(t, matrix.T)/np.array([95.047, 100.000, 108.883])
+    f = np.where(xyz > 0.00885645, np.abs(xyz)**0.333333,
+                 7.787037*xyz + 0.137931)
+    fx, fy, fz = f[..., 0], f[..., 1], f[..., 2]
+    return np.stack([np.maximum(0, 116*fy - 16), 500*(fx - fy),
+                     200*(fy - fz)], -1)
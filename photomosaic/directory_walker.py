@@ -1,16 +1,111 @@
 import os
+import sys
+import stat
+import logging
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+if scandir is None:
+    logger.warning("Neither os.scandir nor the scandir package is available, "
+                   "so directories are walked with os.listdir and a stat of "
+                   "every entry, which is much slower. pip install scandir "
+                   "to avoid this.")
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff')
+
+def fs_path(path):
+    """A path as a byte string, encoding unicode as the file system encodes
+    names. Pools keep filenames as the bytes that name the files, as
+    os.walk gives them for a byte-string directory."""
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or 'utf-8')
+    return path
 
 class DirectoryWalker:
-    def __init__(self, directory):
-        self.files = []
-        self.index = 0
-        
-        for root,dirs,files in os.walk(directory):
-            for f in files:
-                self.files.append( root + os.sep + f )
-                
-    def __len__(self):
-        return len(self.files)
-
-    def __getitem__(self, index):
-        return self.files[index]
+    """Iterate lazily over the files under a directory, top-down, like
+    os.walk. Files can be filtered by extension (case-insensitive) and by a
+    minimum size in bytes without opening them. Filenames are byte
+    strings, even for a unicode directory; see fs_path."""
+    def __init__(self, directory, extensions=None, min_size=0):
+        # Files are named by joining the directory and their path under it,
+        # with one separator between, however the directory is spelled.
+        self.directory = fs_path(directory).rstrip(os.sep) or os.sep
+        if extensions is not None:
+            extensions = tuple(ext.lower() for ext in extensions)
+        self.extensions = extensions
+        self.min_size = min_size
+
+    def __iter__(self):
+        for filename, st in self.stat_files(stat_all=False):
+            yield filename
+
+    def stat_files(self, stat_all=True):
+        """Yield (filename, stat) for each file. With stat_all=False, files
+        are only stat'ed if needed for the size filter, and stat is None
+        otherwise."""
+        stack = [self.directory]
+        while stack:
+            root = stack.pop()
+            subdirs = []
+            for name, is_dir, get_stat in self._list(root):
+                if is_dir:
+                    subdirs.append(root + os.sep + name)
+                    continue
+                if self.extensions is not None and \
+                   not name.lower().endswith(self.extensions):
+                    continue
+                st = None
+                if stat_all or self.min_size:
+                    try:
+                        st = get_stat()
+                    except OSError:
+                        continue
+                    if st.st_size < self.min_size:
+                        continue
+                yield root + os.sep + name, st
+            stack.extend(reversed(subdirs))
+
+    def _list(self, root):
+        """Yield (name, is_dir, get_stat) for each entry in root. Directories
+        that cannot be read, and symbolic links to directories, are skipped,
+        as os.walk does."""
+        if scandir is not None:
+            try:
+                entries = scandir(root)
+            except OSError:
+                return
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                    if is_dir and entry.is_symlink():
+                        continue
+                except OSError:
+                    continue
+                yield entry.name, is_dir, entry.stat
+            return
+
+        try:
+            names = os.listdir(root)
+        except OSError:
+            return
+        for name in names:
+            path = root + os.sep + name
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if is_dir and os.path.islink(path):
+                continue
+            yield name, is_dir, lambda st=st: st
@@ -0,0 +1,70 @@
+"""Compare the color estimators in color_estimators for speed, and for
+how far their results fall from the original k-means estimator, in Lab.
+
+Usage: python estimator_benchmark.py folder-of-images [max-images]"""
+from __future__ import division
+import sys
+import time
+import logging
+import numpy as np
+from PIL import Image
+import color_spaces as cs
+from color_estimators import ESTIMATORS
+from directory_walker import DirectoryWalker, IMAGE_EXTENSIONS
+from image_functions import split_quadrants
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+def compare_estimators(filenames, estimators=None, reference='kmeans'):
+    """Run each estimator on the quadrants of each image. Return a dict
+    mapping estimator names to (seconds per image, mean Lab error, max Lab
+    error), where errors are distances from a separate run of the reference
+    estimator. (The reference's own row shows how much it varies from run
+    to run.)"""
+    if estimators is None:
+        estimators = sorted(ESTIMATORS)
+    timings = dict((name, 0.) for name in estimators)
+    errors = dict((name, []) for name in estimators)
+    count = 0
+    for filename in filenames:
+        try:
+            img = Image.open(filename)
+            img.load()
+        except IOError:
+            continue
+        if img.mode != 'RGB':
+            continue
+        regions = split_quadrants(img)
+        # Estimators may alter the regions they are given, so give copies.
+        expected = np.array(map(cs.rgb2lab, ESTIMATORS[reference](
+            [region.copy() for region in regions])))
+        for name in estimators:
+            copies = [region.copy() for region in regions]
+            start = time.time()
+            rgb = ESTIMATORS[name](copies)
+            timings[name] += time.time() - start
+            lab = np.array(map(cs.rgb2lab, rgb))
+            errors[name].extend(np.sqrt(((lab - expected)**2).sum(1)))
+        count += 1
+    return dict((name, (timings[name]/max(count, 1),
+                        np.mean(errors[name]) if count else np.nan,
+                        np.max(errors[name]) if count else np.nan))
+                for name in estimators)
+
+def report(results):
+    "Log results from compare_estimators as a table, fastest first."
+    logger.info("%-16s %12s %12s %12s", 'estimator', 'ms/image',
+                'mean error', 'max error')
+    for name, (seconds, mean_err, max_err) in sorted(results.items(),
+                                                     key=lambda x: x[1][0]):
+        logger.info("%-16s %12.2f %12.2f %12.2f", name, 1000*seconds,
+                    mean_err, max_err)
+
+if __name__=='__main__':
+    walker = DirectoryWalker(sys.argv[1], IMAGE_EXTENSIONS)
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    filenames = [f for f, _ in zip(walker, range(limit))]
+    report(compare_estimators(filenames))
@@ -1,9 +1,115 @@
 
+from __future__ import division
+import multiprocessing
+import tempfile
+import os
+import numpy as np
+from PIL import Image
 from image_functions import *
+from color_estimators import get_estimator, get_pixel_estimator
 import color_spaces as cs
 
-def analyze_this(img):
+def analyze_this(img, estimator='kmeans'):
+    """Find the dominant color of each quadrant of img, using one of the
+    methods in color_estimators.ESTIMATORS. Return rgb, lab."""
     regions = split_quadrants(img)
-    rgb = map(dominant_color, regions) 
+    rgb = get_estimator(estimator)(regions)
     lab = map(cs.rgb2lab, rgb)
     return rgb, lab
+
+def quadrant_boxes(tiles):
+    """Return the (x, y, w, h) of the quadrants of each tile of a TileSet, as
+    split_quadrants would cut them: an (len(tiles)*4, 4) integer array, four
+    rows per tile, top-left, top-right, bottom-left, bottom-right."""
+    quads = tiles.quads().astype(int).reshape(-1, 4)
+    x, y, w, h = quads.T
+    qw, qh = w//2, h//2
+    boxes = np.empty((len(quads), 4, 4), dtype=int)
+    for i, (dx, dy) in enumerate([(0, 0), (1, 0), (0, 1), (1, 1)]):
+        boxes[:, i] = np.column_stack([x + dx*qw, y + dy*qh, qw, qh])
+    return boxes.reshape(-1, 4)
+
+def analyze_tiles(img, tiles, estimator='kmeans', size=50, budget=64 << 20):
+    """Analyze every tile of img at once, like analyze_this on each tile's
+    crop, but from one array instead of an image per tile. Quadrants of the
+    same size are stacked and given to the estimator together, budget bytes
+    of pixels at a time; those larger than size x size are first shrunk by
+    averaging blocks of pixels. Return rgb and lab, (len(tiles), 4, 3)
+    arrays of the colors of each tile's quadrants."""
+    estimate = get_pixel_estimator(estimator)
+    arr = np.asarray(img.convert('RGB'))
+    boxes = quadrant_boxes(tiles)
+    # Cropping past the edge of an image gives black, as in PIL.
+    pad_y = max(0, (boxes[:, 1] + 2*boxes[:, 3]).max() - arr.shape[0]) \
+        if len(boxes) else 0
+    pad_x = max(0, (boxes[:, 0] + 2*boxes[:, 2]).max() - arr.shape[1]) \
+        if len(boxes) else 0
+    if pad_x or pad_y:
+        arr = np.pad(arr, ((0, pad_y), (0, pad_x), (0, 0)), 'constant')
+    rgb = np.zeros((len(boxes), 3), dtype=int)
+    shapes = boxes[:, 2:]
+    for w, h in set(map(tuple, shapes.tolist())):
+        if w == 0 or h == 0:
+            continue
+        same = np.flatnonzero((shapes[:, 0] == w) & (shapes[:, 1] == h))
+        f = int(np.ceil(np.sqrt(w*h/size**2))) # shrinking factor
+        sw, sh = w//f, h//f
+        per_region = 8*3*max(w*h, sw*sh)
+        block = max(1, budget//per_region)
+        for start in range(0, len(same), block):
+            chosen = same[start:start + block]
+            x0, y0 = boxes[chosen, 0], boxes[chosen, 1]
+            ys = y0[:, np.newaxis] + np.arange(sh*f)
+            xs = x0[:, np.newaxis] + np.arange(sw*f)
+            pixels = arr[ys[:, :, np.newaxis], xs[:, np.newaxis, :]]
+            pixels = pixels.reshape(len(chosen), sh, f, sw, f, 3)
+            pixels = pixels.mean((2, 4)).reshape(len(chosen), -1, 3)
+            rgb[chosen] = estimate(pixels)
+    lab = cs.rgb2lab_array(rgb)
+    return rgb.reshape(-1, 4, 3), lab.reshape(-1, 4, 3)
+
+# The target, memory-mapped, in a worker process of analyze_tiles_parallel.
+_target = None
+
+def _open_target(path):
+    global _target
+    _target = np.load(path, mmap_mode='r')
+
+def crop_array(arr, box):
+    """Copy the (x, y, w, h) box out of an image array. Parts outside the
+    image are black, as in PIL's crop."""
+    x, y, w, h = box
+    region = np.zeros((h, w) + arr.shape[2:], dtype=arr.dtype)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, arr.shape[1]), min(y + h, arr.shape[0])
+    if x1 > x0 and y1 > y0:
+        region[y0 - y:y1 - y, x0 - x:x1 - x] = arr[y0:y1, x0:x1]
+    return region
+
+def _analyze_box(box, estimator):
+    return analyze_this(Image.fromarray(crop_array(_target, box)), estimator)
+
+def _analyze_box_star(args):
+    return _analyze_box(*args)
+
+def analyze_tiles_parallel(img, tiles, estimator='kmeans', processes=None,
+                           chunksize=16):
+    """Analyze each tile with analyze_this, in a pool of worker processes.
+    The target is written once to a temporary .npy file that the workers
+    memory-map, so no image is pickled per tile. Yield (rgb, lab) for each
+    tile of the TileSet, in order."""
+    fd, path = tempfile.mkstemp(suffix='.npy')
+    os.close(fd)
+    pool = None
+    try:
+        np.save(path, np.asarray(img.convert('RGB')))
+        pool = multiprocessing.Pool(processes, _open_target, (path,))
+        boxes = [(quad, estimator)
+                 for quad in tiles.quads().astype(int).tolist()]
+        for result in pool.imap(_analyze_box_star, boxes, chunksize):
+            yield result
+        pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        os.remove(path)
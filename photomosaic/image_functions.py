@@ -5,7 +5,8 @@ from scipy.cluster import vq
 import numpy as np
 from PIL import Image
 from PIL import ImageFilter
-
+from cStringIO import StringIO
+import struct
 import logging
 
 # Configure logger.
@@ -21,6 +22,54 @@ def open(target_filename):
         logger.warning("Cannot open %s as an image.", target_filename)
         return
 
+def exif_thumbnail(img):
+    """Return the JPEG thumbnail embedded in an image's EXIF data, or None if
+    there is not one. The thumbnail is found through the offset and length
+    tags of the second IFD (IFD1)."""
+    exif = img.info.get('exif')
+    if not exif or not exif.startswith('Exif\x00\x00'):
+        return None
+    tiff = exif[6:]
+    try:
+        endian = {'II': '<', 'MM': '>'}[tiff[:2]]
+        ifd0, = struct.unpack(endian + 'L', tiff[4:8])
+        count, = struct.unpack(endian + 'H', tiff[ifd0:ifd0 + 2])
+        ifd1, = struct.unpack(endian + 'L', tiff[ifd0 + 2 + 12*count:
+                                                 ifd0 + 6 + 12*count])
+        if ifd1 == 0:
+            return None
+        count, = struct.unpack(endian + 'H', tiff[ifd1:ifd1 + 2])
+        tags = {}
+        for i in range(count):
+            entry = tiff[ifd1 + 2 + 12*i:ifd1 + 14 + 12*i]
+            tag, typ, n, value = struct.unpack(endian + 'HHLL', entry)
+            tags[tag] = value
+        offset, length = tags[0x0201], tags[0x0202]
+        thumb = Image.open(StringIO(tiff[offset:offset + length]))
+        thumb.load()
+    except (KeyError, IOError, struct.error):
+        return None
+    return thumb
+
+def reduce_on_decode(img, min_size):
+    """Return a version of an opened (but not yet loaded) image that is at
+    least min_size and has as few pixels as can be had cheaply. A big enough
+    EXIF thumbnail with the image's aspect ratio is used if there is one;
+    otherwise JPEGs are scaled down by a power of two as they are decoded.
+    Other formats are returned as they are."""
+    if img.format != 'JPEG':
+        return img
+    w, h = img.size
+    min_w, min_h = min_size
+    thumb = exif_thumbnail(img)
+    if thumb is not None and thumb.mode == img.mode:
+        tw, th = thumb.size
+        # Some cameras letterbox their thumbnails. Don't use those.
+        if tw >= min_w and th >= min_h and abs(tw/th - w/h) < 0.02*w/h:
+            return thumb
+    img.draft(img.mode, (min_w, min_h))
+    return img
+
 def color_hex(rgb):
     "Convert [r, g, b] to a HEX value with a leading # character."
     return '#' + ''.join(chr(c) for c in rgb).encode('hex')
@@ -110,30 +159,26 @@ def compute_palette(hist):
         palette[ch] = p
     return palette
 
+def levels_lut(from_palette, to_palette, amount=1):
+    """The table, for Image.point on an RGB image, of the levels adjustment
+    made by adjust_levels, blended with the unadjusted levels by amount as
+    Image.blend would blend the two images. Palettes are as compute_palette
+    makes them, in ascending order."""
+    # Blended in single precision, as Image.blend does.
+    x = np.arange(256, dtype=np.float32)
+    lut = []
+    for ch in 'red', 'green', 'blue':
+        # Each level goes to the first entry of from_palette at or above it.
+        inv_f = np.minimum(np.searchsorted(from_palette[ch], x), 255)
+        adjusted = np.asarray(to_palette[ch], dtype=np.float32)[inv_f]
+        blended = x + np.float32(amount)*(adjusted - x)
+        lut.extend(np.clip(blended, 0, 255).astype(np.uint8).tolist())
+    return lut
+
 def adjust_levels(target_img, from_palette, to_palette):
     """Transform the colors of an image to match the color palette of
     another image."""
-    keys = 'red', 'green', 'blue'
-    channels = dict(zip(keys, target_img.split()))
-    f, g = from_palette, to_palette # compact notation
-    func = {} # function to transform color at each pixel
-    for ch in keys:
-        def j(x):
-           while True:
-               try:
-                   inv_f = f[ch].index(x)
-                   break
-               except ValueError:
-                   if x < 255:
-                       x += 1
-                       continue 
-                   else:
-                       inv_f = 255
-                       break
-           return to_palette[ch][inv_f]
-        func[ch] = j 
-    adjusted_channels = [Image.eval(channels[ch], func[ch]) for ch in keys]
-    return Image.merge('RGB', adjusted_channels)
+    return target_img.point(levels_lut(from_palette, to_palette))
 
 def crop_to_fit(img, tile_size):
     "Return a copy of img cropped to precisely fill the dimesions tile_size."
@@ -161,17 +206,19 @@ def crop_to_fit(img, tile_size):
     return img
     
 def shrink_by_lightness(pad, tile_size, dL):
-    """The greater the greater the lightness discrepancy dL
-    the smaller the tile will shrunk."""
-    sgn = lambda x: (x > 0) - (x < 0)
-    if sgn(pad)*dL < 0:
-        return tile_size
+    """The greater the lightness discrepancy dL, the more the tile is
+    shrunk to show the background around it: with pad > 0 (for a light
+    background), tiles whose matches are too dark (dL < 0), and with
+    pad < 0, too light. tile_size is (w, h), and it and dL may be arrays,
+    one entry per tile. Return the shrunk (w, h)."""
+    w, h = tile_size
+    dL = np.asarray(dL)
     MAX_dL = 100 # the largest possible distance in Lab space
     MIN = 0.5 # not so close small that it's a speck
     MAX = 0.95 # not so close to unity that is looks accidental
-    scaling = MAX - (MAX - MIN)*(-pad*dL)/MAX_dL
-    shrunk_size = [int(scaling*dim) for dim in tile_size]
-    return shrunk_size
+    scaling = np.clip(MAX - (MAX - MIN)*(-pad*dL)/MAX_dL, MIN, MAX)
+    scaling = np.where(pad*dL < 0, scaling, 1)
+    return (w*scaling).astype(int), (h*scaling).astype(int)
 
  
 def dynamic_range(img):
@@ -1,54 +1,242 @@
-from directory_walker import DirectoryWalker
+from directory_walker import DirectoryWalker, IMAGE_EXTENSIONS
 from progress_bar import progress_bar
-import color_spaces as cs
 from PIL import Image
 from image_functions import *
+from image_analysis import analyze_this
+from thumbnail_store import make_thumbnails
+import numpy as np
+import multiprocessing
+import hashlib
+import io
 import logging
+import functools
 
 # Configure logger.
 FORMAT = "%(name)s.%(funcName)s:  %(message)s"
 logging.basicConfig(level=logging.INFO, format=FORMAT)
 logger = logging.getLogger(__name__)
 
+class SkipImage(Exception):
+    "Raised for files that cannot be used as pool images at all."
+    pass
+
+def analyze_file(filename, fast_decode=False, thumbnail_sizes=(),
+                 estimator='kmeans'):
+    """Open an image file and find the dominant color of each quadrant with
+    the given estimator (see color_estimators).
+    Return w, h, rgb, lab, thumbnails, where thumbnails is made by
+    make_thumbnails for the given sizes. Raise SkipImage if the file is not
+    a usable image. With fast_decode, only as many pixels as the analysis
+    and the thumbnails need are decoded; see reduce_on_decode."""
+    try:
+        img = Image.open(filename)
+    except IOError:
+        raise SkipImage("Cannot open %s as an image. Skipping it." % filename)
+
+    if img.mode != 'RGB':
+        raise SkipImage("RGB images only. Skipping %s." % filename)
+
+    w, h = img.size
+    if fast_decode:
+        # dominant_color thumbnails each quadrant to 50px.
+        min_size = max([100] + list(thumbnail_sizes))
+        img = reduce_on_decode(img, (min_size, min_size))
+    thumbnails = make_thumbnails(img, thumbnail_sizes)
+    rgb, lab = analyze_this(img, estimator)
+    return w, h, rgb, lab, thumbnails
+
+def file_checksum(filename, blocksize=1<<20):
+    "Return the MD5 hex digest of a file's contents."
+    md5 = hashlib.md5()
+    with io.open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def decode_error(filename, estimator='kmeans', seed=0):
+    """Analyze an image with and without fast_decode and return the largest
+    Lab distance between the two results over the four quadrants. Use this
+    to check that fast_decode is within tolerance for a collection."""
+    np.random.seed(seed) # Both runs start k-means from the same guesses.
+    full = analyze_file(filename, estimator=estimator)[3]
+    np.random.seed(seed)
+    fast = analyze_file(filename, fast_decode=True, estimator=estimator)[3]
+    return max(np.sqrt(np.sum((np.array(full) - np.array(fast))**2, 1)))
+
+def _analyze_worker(filename, fast_decode=False, thumbnail_sizes=(),
+                    estimator='kmeans'):
+    """Run analyze_file in a worker process. Exceptions are returned, not
+    raised, so that the parent can handle them just like add_image does."""
+    try:
+        return (filename, analyze_file(filename, fast_decode, thumbnail_sizes,
+                                       estimator), None)
+    except Exception as e:
+        return filename, None, e
+
 class ImagePool:
+    thumbnail_sizes = ()
+    estimator = 'kmeans'
+
     def __init__(self):
         None
 
-    def add_directory(self, image_dir, skip_errors=True):
-        walker = DirectoryWalker(image_dir)
-        file_count = len(list(walker)) # stupid but needed but progress bar
-        pbar = progress_bar(file_count, "Analyzing images and building db")
+    def add_directory(self, image_dir, skip_errors=True, processes=1,
+                      chunksize=8, fast_decode=False,
+                      extensions=IMAGE_EXTENSIONS, min_size=0):
+        """Analyze every image under image_dir and add it to the pool.
+        With processes > 1, images are decoded and analyzed in a pool of
+        worker processes; only this process writes to the pool. See
+        analyze_file for fast_decode. Only files with one of the given
+        extensions (None for any) and at least min_size bytes are opened."""
+        walker = DirectoryWalker(image_dir, extensions, min_size)
+        pbar = progress_bar(None, "Analyzing images and building db")
 
-        for filename in walker:
-            self.add_image(filename, skip_errors)
-            pbar.next()
+        if processes == 1:
+            for filename in walker:
+                self.add_image(filename, skip_errors, fast_decode)
+                pbar.next()
+        else:
+            # Files are handed to the workers as the walk finds them. The
+            # walk runs in the worker pool's feeder thread, so it must not
+            # touch the database or the progress bar.
+            known = self.file_records(image_dir)
+            def new_files():
+                for filename in walker:
+                    if filename in known:
+                        logger.warning("Image %s is already in the table. Skipping it."%filename)
+                    else:
+                        yield filename
+            self._analyze_many(new_files(), pbar, skip_errors, processes,
+                               chunksize, fast_decode)
+        pbar.close()
         logger.info('Collection %s built with %d images'%(self.db_name, len(self)))
-        
-    def add_image(self, filename, skip_errors=False):
-        if filename in self:
-            logger.warning("Image %s is already in the table. Skipping it."%filename)
+
+    def sync_directory(self, image_dir, checksum=False, skip_errors=True,
+                       processes=1, chunksize=8, fast_decode=False,
+                       extensions=IMAGE_EXTENSIONS, min_size=0):
+        """Bring the pool up to date with image_dir in one pass: analyze new
+        files, re-analyze files whose modification time or size changed, and
+        purge images whose files are gone. With checksum=True, a changed
+        file whose contents hash the same is not re-analyzed. Files that the
+        extensions and min_size filters exclude count as gone. Files that
+        cannot be used are remembered, and not tried again until they
+        change."""
+        known = self.file_records(image_dir)
+        skipped = self.skipped_records(image_dir)
+        stale, touched, retried = [], [], []
+        unchanged_skipped = 0
+        to_analyze = []
+        file_info = {}
+        walker = DirectoryWalker(image_dir, extensions, min_size)
+        for filename, st in walker.stat_files():
+            info = {'mtime': st.st_mtime, 'size': st.st_size}
+            record = known.pop(filename, None)
+            marker = skipped.pop(filename, None)
+            if marker is not None:
+                if record is None and marker == (info['mtime'], info['size']):
+                    unchanged_skipped += 1
+                    continue
+                retried.append(filename)
+            if record is not None:
+                image_id, mtime, size, digest = record
+                if mtime is None:
+                    # Indexed before file info was stored. Trust it.
+                    if checksum:
+                        digest = file_checksum(filename)
+                    touched.append((info['mtime'], info['size'], digest,
+                                    image_id))
+                    continue
+                if mtime == info['mtime'] and size == info['size']:
+                    continue
+                if checksum and digest is not None:
+                    info['checksum'] = file_checksum(filename)
+                    if info['checksum'] == digest:
+                        touched.append((info['mtime'], info['size'], digest,
+                                        image_id))
+                        continue
+                stale.append(image_id)
+            if checksum and 'checksum' not in info:
+                info['checksum'] = file_checksum(filename)
+            file_info[filename] = info
+            to_analyze.append(filename)
+
+        gone = [record[0] for record in known.itervalues()]
+        self.delete(stale + gone)
+        self.update_file_info(touched)
+        self.forget_skipped(retried + skipped.keys())
+        logger.info("%d new or changed files, %d removed files, %d unusable "
+                    "files unchanged", len(to_analyze), len(gone),
+                    unchanged_skipped)
+
+        pbar = progress_bar(len(to_analyze), "Analyzing new and changed images")
+        self._analyze_many(to_analyze, pbar, skip_errors, processes, chunksize,
+                           fast_decode, file_info)
+        logger.info('Collection %s synced with %d images'%(self.db_name, len(self)))
+
+    def _analyze_many(self, filenames, pbar, skip_errors, processes=1,
+                      chunksize=8, fast_decode=False, file_info={}):
+        """Analyze files, in worker processes if processes > 1, and insert
+        the results as they come. file_info maps filenames to extra keyword
+        arguments for insert. Files in file_info that cannot be used are
+        marked as skipped, with their mtime and size."""
+        worker = functools.partial(_analyze_worker, fast_decode=fast_decode,
+                                   thumbnail_sizes=self.thumbnail_sizes,
+                                   estimator=self.estimator)
+        if processes == 1:
+            results = (worker(filename) for filename in filenames)
+            self._insert_results(results, pbar, skip_errors, file_info)
             return
-            
+
+        workers = multiprocessing.Pool(processes)
         try:
-            img = Image.open(filename)
-        except IOError:
-            logger.warning("Cannot open %s as an image. Skipping it.",
-                           filename)
-            return
-            
-        if img.mode != 'RGB':
-            logger.warning("RGB images only. Skipping %s.", filename)
+            results = workers.imap_unordered(worker, filenames, chunksize)
+            self._insert_results(results, pbar, skip_errors, file_info)
+            workers.close()
+        except:
+            workers.terminate()
+            raise
+        finally:
+            workers.join()
+
+    def _insert_results(self, results, pbar, skip_errors, file_info):
+        for filename, result, error in results:
+            if error is None:
+                w, h, rgb, lab, thumbnails = result
+                self.insert(filename, w, h, rgb, lab, thumbnails=thumbnails,
+                            **file_info.get(filename, {}))
+            else:
+                self._handle_error(filename, error, skip_errors)
+                if filename in file_info:
+                    info = file_info[filename]
+                    self.mark_skipped(filename, info.get('mtime'),
+                                      info.get('size'))
+            pbar.next()
+
+    def add_image(self, filename, skip_errors=False, fast_decode=False):
+        if filename in self:
+            logger.warning("Image %s is already in the table. Skipping it."%filename)
             return
-            
-        w, h = img.size
+
         try:
-            regions = split_quadrants(img)
-            rgb = map(dominant_color, regions) 
-            lab = map(cs.rgb2lab, rgb)
+            w, h, rgb, lab, thumbnails = analyze_file(filename, fast_decode,
+                                                      self.thumbnail_sizes,
+                                                      self.estimator)
         except Exception as e:
-            logger.warning("Unknown problem analyzing %s. (%s) Skipping it.",
-                           filename, str(e))
-            if not skip_errors:
-                raise
-        self.insert(filename, w, h, rgb, lab)
+            self._handle_error(filename, e, skip_errors)
+            return
+        self.insert(filename, w, h, rgb, lab, thumbnails=thumbnails)
         return
+
+    def open_image(self, image_id, filename, size=None):
+        """Open a pool image to be cropped and scaled to size. Pools that
+        keep thumbnails return the smallest one that is big enough."""
+        return Image.open(filename)
+
+    def _handle_error(self, filename, error, skip_errors):
+        if isinstance(error, SkipImage):
+            logger.warning("%s", error)
+            return
+        logger.warning("Unknown problem analyzing %s. (%s) Skipping it.",
+                       filename, str(error))
+        if not skip_errors:
+            raise error
@@ -0,0 +1,326 @@
+"""An approximate index for very large pools: an inverted file with
+product-quantized residuals (IVF-PQ).
+
+The 12-D Lab vectors are clustered into coarse cells. Each image is filed
+under its nearest cell, and its residual (its vector less the cell's
+center) is compressed to four bytes, one per quadrant, each the nearest of
+256 centers learned for that quadrant. A search looks in the nprobe cells
+nearest the target and ranks their images by the compressed distances;
+more probes find more of the true nearest images, more slowly."""
+from __future__ import division
+import io
+import os
+import logging
+import tempfile
+import numpy as np
+from array_matcher import IndexMatcher, SavedIndex, LAB_COLUMNS, as_targets
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+SUBSPACES = 4 # one (L, a, b) per quadrant
+CODES = 256 # so that each code fits in a byte
+
+def nearest(data, centers, block=4096):
+    "Return the index of the center nearest each row of data."
+    norms = (centers**2).sum(1)
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block):
+        # |x - c|^2 = |c|^2 - 2 x.c + |x|^2, and the last term is the same
+        # for every center, so it can be left out.
+        dist = norms - 2*np.dot(data[start:start + block], centers.T)
+        labels[start:start + block] = dist.argmin(1)
+    return labels
+
+def kmeans(data, clusters, iterations=10, seed=0):
+    """Lloyd's k-means, started from randomly chosen rows. Return the
+    centers. Empty clusters keep their old centers."""
+    random = np.random.RandomState(seed)
+    clusters = min(clusters, len(data))
+    centers = data[random.choice(len(data), clusters, replace=False)]
+    for i in range(iterations):
+        labels = nearest(data, centers)
+        counts = np.bincount(labels, minlength=clusters)
+        sums = np.column_stack([np.bincount(labels, data[:, d],
+                                            minlength=clusters)
+                                for d in range(data.shape[1])])
+        filled = counts > 0
+        centers = centers.copy()
+        centers[filled] = sums[filled]/counts[filled][:, np.newaxis]
+    return centers.astype(np.float32)
+
+def fingerprints(features):
+    "A 64-bit hash of each row of features, to notice changed colors."
+    words = np.ascontiguousarray(features, dtype=np.float32).view(np.uint32)
+    h = np.zeros(len(features), dtype=np.uint64)
+    for i in range(words.shape[1]):
+        h = (h*np.uint64(1099511628211)) ^ words[:, i].astype(np.uint64)
+    return h
+
+class IVFPQIndex(SavedIndex):
+    """An IVF-PQ index over the Lab vectors of a pool. Images added or
+    changed since it was trained are filed with the existing cells and
+    codebooks; once more than rebuild_fraction of the pool has changed,
+    it is trained again."""
+    def __init__(self, image_ids, features, cells=None, rebuild_fraction=0.2,
+                 seed=0):
+        self.rebuild_fraction = rebuild_fraction
+        self.seed = seed
+        self.train(image_ids, features, cells)
+
+    def train(self, image_ids, features, cells=None):
+        features = np.asarray(features, dtype=np.float32)
+        n = len(features)
+        if cells is None:
+            cells = int(4*np.sqrt(n))
+        cells = max(1, min(cells, n))
+        random = np.random.RandomState(self.seed)
+        sample = features[random.choice(n, min(n, 64*cells), replace=False)] \
+            if n else features
+        logger.info("Training %d cells on %d of %d images.",
+                    cells, len(sample), n)
+        self.centers = kmeans(sample, cells, seed=self.seed) if n else \
+            np.zeros((1, 12), dtype=np.float32)
+        residuals = sample - self.centers[nearest(sample, self.centers)]
+        self.codebooks = np.zeros((SUBSPACES, CODES, 3), dtype=np.float32)
+        for m in range(SUBSPACES):
+            if len(residuals):
+                book = kmeans(residuals[:, 3*m:3*m + 3], CODES, seed=self.seed)
+                self.codebooks[m, :len(book)] = book
+                # Unused codes repeat the first, so none is spurious.
+                self.codebooks[m, len(book):] = book[0]
+        self.changed = 0
+        self.image_ids = np.empty(0, dtype=np.int64)
+        self.cells = np.empty(0, dtype=np.int64)
+        self.codes = np.empty((0, SUBSPACES), dtype=np.uint8)
+        self.fingerprints = np.empty(0, dtype=np.uint64)
+        self.add(image_ids, features)
+        self.changed = 0
+
+    def encode(self, features):
+        "Return the cell and the codes of each of features."
+        cells = nearest(features, self.centers)
+        residuals = features - self.centers[cells]
+        codes = np.column_stack([nearest(residuals[:, 3*m:3*m + 3],
+                                         self.codebooks[m])
+                                 for m in range(SUBSPACES)]).astype(np.uint8)
+        return cells, codes
+
+    def add(self, image_ids, features):
+        features = np.asarray(features, dtype=np.float32)
+        cells, codes = self.encode(features) if len(features) else \
+            (np.empty(0, dtype=np.int64), np.empty((0, SUBSPACES), np.uint8))
+        self._file(np.concatenate([self.image_ids, image_ids]),
+                   np.concatenate([self.cells, cells]),
+                   np.concatenate([self.codes, codes]),
+                   np.concatenate([self.fingerprints,
+                                   fingerprints(features)]))
+        self.changed += len(image_ids)
+
+    def remove(self, image_ids):
+        keep = ~np.in1d(self.image_ids, image_ids)
+        self.changed += len(keep) - keep.sum()
+        self._file(self.image_ids[keep], self.cells[keep], self.codes[keep],
+                   self.fingerprints[keep])
+
+    def _file(self, image_ids, cells, codes, prints):
+        "Keep the entries sorted by cell, so that each cell is a slice."
+        order = np.lexsort((image_ids, cells))
+        self.image_ids = image_ids[order]
+        self.cells = cells[order]
+        self.codes = codes[order]
+        self.fingerprints = prints[order]
+        self.offsets = np.searchsorted(self.cells,
+                                       np.arange(len(self.centers) + 1))
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def update(self, image_ids, features):
+        """Bring the index up to date with a pool whose images are image_ids
+        with the given features. Return True if anything changed."""
+        prints = fingerprints(features)
+        by_id = self.image_ids.argsort()
+        known_ids = self.image_ids[by_id]
+        pos = np.minimum(np.searchsorted(known_ids, image_ids),
+                         max(len(known_ids) - 1, 0))
+        same = np.zeros(len(image_ids), dtype=bool)
+        if len(known_ids):
+            same = (known_ids[pos] == image_ids) & \
+                   (self.fingerprints[by_id][pos] == prints)
+        gone = np.setdiff1d(self.image_ids, image_ids[same])
+        if not len(gone) and same.all():
+            return False
+        self.remove(gone)
+        self.add(image_ids[~same], np.asarray(features)[~same])
+        if self.changed > self.rebuild_fraction*len(image_ids):
+            logger.info("Retraining the index for %d images.", len(image_ids))
+            self.train(image_ids, features)
+        return True
+
+    def search(self, lab, nprobe=8, k=50):
+        """Return the ids of the (up to) k images in the nprobe cells nearest
+        lab, nearest first by their compressed distances."""
+        target = np.asarray(lab, dtype=np.float32).reshape(12)
+        probes = ((self.centers - target)**2).sum(1).argsort()[:nprobe]
+        ids, dist = [], []
+        for cell in probes:
+            start, stop = self.offsets[cell], self.offsets[cell + 1]
+            if start == stop:
+                continue
+            # Distances from the target's residual to every code, then a
+            # lookup for each image's codes.
+            residual = target - self.centers[cell]
+            table = ((self.codebooks
+                      - residual.reshape(SUBSPACES, 1, 3))**2).sum(2)
+            codes = self.codes[start:stop]
+            dist.append(sum(table[m, codes[:, m]] for m in range(SUBSPACES)))
+            ids.append(self.image_ids[start:stop])
+        if not ids:
+            return np.empty(0, dtype=np.int64)
+        ids, dist = np.concatenate(ids), np.concatenate(dist)
+        if len(ids) > k:
+            near = np.argpartition(dist, k - 1)[:k]
+            ids, dist = ids[near], dist[near]
+        return ids[dist.argsort(kind='mergesort')]
+
+    ARRAYS = ['centers', 'codebooks', 'image_ids', 'cells', 'codes',
+              'fingerprints']
+
+    def save(self, path):
+        with io.open(path, 'wb') as f:
+            np.savez(f, rebuild_fraction=self.rebuild_fraction,
+                     seed=self.seed, changed=self.changed,
+                     **dict((name, getattr(self, name))
+                            for name in self.ARRAYS))
+
+    @classmethod
+    def load(cls, path):
+        index = cls.__new__(cls)
+        with io.open(path, 'rb') as f:
+            saved = np.load(f)
+            for name in cls.ARRAYS:
+                setattr(index, name, saved[name])
+            index.rebuild_fraction = float(saved['rebuild_fraction'])
+            index.seed = int(saved['seed'])
+            index.changed = int(saved['changed'])
+        index._file(index.image_ids, index.cells, index.codes,
+                    index.fingerprints)
+        return index
+
+def dump_features(db, path, block=4096):
+    """Write the Lab colors of every image in a pool database to a .npy
+    file at path, block images at a time. Return the image_ids (sorted) and
+    the features, memory-mapped from the file."""
+    c = db.cursor()
+    try:
+        c.execute("SELECT count(*) FROM LabColors JOIN Images USING (image_id)")
+        n = c.fetchone()[0]
+        features = np.lib.format.open_memmap(path, mode='w+',
+                                             dtype=np.float32, shape=(n, 12))
+        image_ids = np.empty(n, dtype=np.int64)
+        # Images added since the count are left for the next load.
+        c.execute("""SELECT image_id, {0}
+                     FROM LabColors
+                     JOIN Images USING (image_id)
+                     ORDER BY image_id
+                     LIMIT ?""".format(', '.join(LAB_COLUMNS)), (n,))
+        stored = 0
+        while True:
+            rows = c.fetchmany(block)
+            if not rows:
+                break
+            image_ids[stored:stored + len(rows)] = [row[0] for row in rows]
+            features[stored:stored + len(rows)] = [tuple(row)[1:13]
+                                                   for row in rows]
+            stored += len(rows)
+    finally:
+        c.close()
+    features.flush()
+    del features
+    return image_ids[:stored], np.load(path, mmap_mode='r')[:stored]
+
+class PoolFilenames(object):
+    "The filenames of a pool's images by row, read from the database as needed."
+    def __init__(self, db, image_ids):
+        self.db = db
+        self.image_ids = image_ids
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, row):
+        c = self.db.cursor()
+        try:
+            c.execute("SELECT filename FROM Images WHERE image_id=?",
+                      (int(self.image_ids[row]),))
+            return c.fetchone()[0]
+        finally:
+            c.close()
+
+class IVFPQMatcher(IndexMatcher):
+    """An IndexMatcher that only considers the k images the IVFPQIndex kept
+    in db_name + '.ivfpq' finds in the nprobe cells nearest each target.
+    Those are ranked by their exact distances, with the tolerance jitter
+    and usage penalty, as usual."""
+    def __init__(self, image_ids, features, usages, filenames, index,
+                 nprobe=8, k=50, seed=None):
+        IndexMatcher.__init__(self, image_ids, features, usages, filenames,
+                              index, k, seed)
+        self.nprobe = nprobe
+        self.path = None
+
+    @classmethod
+    def from_pool(cls, pool, nprobe=8, k=50, seed=None):
+        """Only the image_ids and usages are held in memory. The features
+        are written to a temporary .npy file beside the pool, and memory-
+        mapped from there, and filenames are read from the pool when
+        matched. close deletes the file."""
+        fd, path = tempfile.mkstemp(
+            suffix='.npy', dir=os.path.dirname(os.path.abspath(pool.db_name)))
+        os.close(fd)
+        try:
+            image_ids, features = dump_features(pool.db, path)
+            index = IVFPQIndex.open(pool.db_name + '.ivfpq', image_ids,
+                                    features)
+        except:
+            os.remove(path)
+            raise
+        matcher = cls(image_ids, features,
+                      np.zeros(len(image_ids), dtype=np.int64),
+                      PoolFilenames(pool.db, image_ids), index, nprobe, k,
+                      seed)
+        matcher.path = path
+        return matcher
+
+    def close(self):
+        if self.path is not None:
+            self.features = None
+            os.remove(self.path)
+            self.path = None
+
+    def candidates(self, target, k):
+        "The rows of the images the index finds for target."
+        rows = np.searchsorted(self.image_ids,
+                               self.index.search(target, self.nprobe, k))
+        if not len(rows):
+            # Too few probes to find anything: fall back to every image.
+            rows = np.arange(len(self))
+        return rows
+
+    def top_k(self, labs, k=20, block=256):
+        targets = as_targets(labs)
+        k = min(k, len(self))
+        rows = np.empty((len(targets), k), dtype=np.int64)
+        E_sq = np.empty((len(targets), k), dtype=np.float32)
+        for i, target in enumerate(targets):
+            found = self.candidates(target, max(k, self.k))
+            if len(found) < k:
+                # Pad with other images, so every target has k candidates.
+                others = np.setdiff1d(np.arange(len(self)), found)
+                found = np.concatenate([found, others[:k - len(found)]])
+            near, dist = self._sort_rows(target[np.newaxis], found[np.newaxis])
+            rows[i], E_sq[i] = near[0, :k], dist[0, :k]
+        return rows, E_sq
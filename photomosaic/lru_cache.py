@@ -0,0 +1,112 @@
+"""A cache that holds at most a given number of bytes, dropping the least
+recently used entries to make room, and counts its hits, misses and
+evictions."""
+from __future__ import division
+import collections
+import sys
+import logging
+import numpy as np
+from PIL import Image
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+# Bytes per pixel per band, for the PIL modes that are not one byte.
+BAND_BYTES = {'1': 1, 'I': 4, 'F': 4, 'I;16': 2, 'I;16B': 2, 'I;16L': 2}
+
+def image_nbytes(size, mode='RGB'):
+    "The bytes held by an image of this size and mode, from its dimensions."
+    width, height = size
+    return width*height*Image.getmodebands(mode)*BAND_BYTES.get(mode, 1)
+
+def nbytes(value):
+    """Estimate the bytes held by a cached value: images and arrays by their
+    pixels, tuples by their items, anything else by sys.getsizeof."""
+    if isinstance(value, Image.Image):
+        return image_nbytes(value.size, value.mode)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum(nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+class LRUCache(object):
+    """A dict-like cache of at most max_bytes, as measured by sizeof, and
+    at most max_items entries; None means no limit. Adding an entry evicts
+    the least recently used ones until it fits. An entry larger than the
+    whole budget is not kept at all."""
+    def __init__(self, max_bytes=None, max_items=None, sizeof=nbytes,
+                 name='cache'):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.sizeof = sizeof
+        self.name = name
+        self._entries = collections.OrderedDict() # key: (value, size)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def get(self, key, default=None):
+        "Return the value cached for key, counting a hit or a miss."
+        try:
+            value, size = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # Move it to the most recently used end.
+        self._entries[key] = value, size
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        "Cache value for key, evicting what must go to stay within budget."
+        size = self.sizeof(value)
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._entries[key] = value, size
+        self.nbytes += size
+        while ((self.max_bytes is not None and self.nbytes > self.max_bytes)
+               or (self.max_items is not None
+                   and len(self._entries) > self.max_items)):
+            _, (_, dropped) = self._entries.popitem(last=False)
+            self.nbytes -= dropped
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        "Return a dict of the counters and the current size."
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self._entries),
+                    nbytes=self.nbytes, max_bytes=self.max_bytes,
+                    hit_rate=self.hits/lookups if lookups else 0.)
+
+    def log_stats(self, level=logging.INFO):
+        stats = self.stats()
+        logger.log(level, "%s: %d hits, %d misses (%.0f%% hit rate), "
+                   "%d evictions; %d entries, %.1f MB", self.name,
+                   stats['hits'], stats['misses'], 100*stats['hit_rate'],
+                   stats['evictions'], stats['entries'], self.nbytes/2.**20)
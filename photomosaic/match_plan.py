@@ -0,0 +1,47 @@
+"""Save the result of matching, so a mosaic can be assembled again, at other
+sizes or in other styles, without analyzing and matching again.
+
+A plan is an .npz file of columns, one row per tile: the tile's x, y, w and
+h in the target image, and its match's image_id, filename, E_sq and dL."""
+from __future__ import division
+import io
+import logging
+import numpy as np
+from partition import TileSet
+from directory_walker import fs_path
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+def save_plan(path, tiles):
+    "Save a matched TileSet to path."
+    image_ids = tiles.image_id.tolist()
+    with io.open(path, 'wb') as f:
+        np.savez_compressed(
+            f, version=VERSION,
+            x=tiles.x.astype(np.int32), y=tiles.y.astype(np.int32),
+            w=tiles.w.astype(np.int32), h=tiles.h.astype(np.int32),
+            image_id=tiles.image_id,
+            filename=np.array([fs_path(tiles.filenames.get(image_id, ''))
+                               for image_id in image_ids]),
+            E_sq=tiles.E_sq, dL=tiles.dL)
+    logger.info("Saved a plan of %d tiles to %s", len(tiles), path)
+
+def load_plan(path):
+    "Load a plan saved by save_plan, as a matched TileSet."
+    with io.open(path, 'rb') as f:
+        plan = np.load(f)
+        if int(plan['version']) > VERSION:
+            raise ValueError("The plan in %s is from a newer version." % path)
+        tiles = TileSet(plan['x'], plan['y'], plan['w'], plan['h'], dtype=int)
+        tiles.image_id = plan['image_id'].astype(np.int64)
+        tiles.E_sq = plan['E_sq'].astype(np.float32)
+        tiles.dL = plan['dL'].astype(np.float32)
+        tiles.filenames = dict(zip(plan['image_id'].tolist(),
+                                   plan['filename'].tolist()))
+    logger.info("Loaded a plan of %d tiles from %s", len(tiles), path)
+    return tiles
@@ -19,17 +19,26 @@
 import collections
 import functools
 import logging
+from lru_cache import LRUCache
 
 logger = logging.getLogger(__name__)
 
+MEMO_BYTES = 256 << 20 # default budget of each memoized function
+
 class memo(object):
    """Decorator. Caches a function's return value each time it is called.
    If called later with the same arguments, the cached value is returned
-   (not reevaluated).
+   (not reevaluated). The cache holds at most MEMO_BYTES, least recently
+   used values first out; use @memo.bounded(max_bytes) for another budget.
    http://wiki.python.org/moin/PythonDecoratorLibrary#Memoize """
-   def __init__(self, func):
+   def __init__(self, func, max_bytes=MEMO_BYTES, max_items=None):
       self.func = func
-      self.cache = {}
+      self.cache = LRUCache(max_bytes, max_items,
+                            name=getattr(func, '__name__', 'memo'))
+   @classmethod
+   def bounded(cls, max_bytes=MEMO_BYTES, max_items=None):
+      "Return a memo decorator with the given budget."
+      return lambda func: cls(func, max_bytes, max_items)
    def __call__(self, *args):
       if not isinstance(args, collections.Hashable):
          # uncacheable. a list, for instance.
@@ -37,9 +46,10 @@ class memo(object):
          logger.warning("""@memo decorator has been used on a function
                         with unhashable arguments.""")
          return self.func(*args)
-      if args in self.cache:
+      value = self.cache.get(args, self.cache)
+      if value is not self.cache:
          logger.debug("""Found in cache. Returning cached value.""")
-         return self.cache[args]
+         return value
       else:
          logger.debug("""%s not found in cache. Computing value.""", args)
          value = self.func(*args)
@@ -1,7 +1,10 @@
 from __future__ import division
 from image_functions import *
+from tile_stats import TileStats, MaskStats
+from lru_cache import LRUCache, image_nbytes
+from array_matcher import Match
 from math import floor, ceil
-from random import randrange
+import numpy as np
 
 FORMAT = "%(name)s.%(funcName)s:  %(message)s"
 logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -50,26 +53,143 @@ def procreate(tile):
             children.append( Tile(x+w*i, y+h*j, w, h))
     return children
 
+class TileSet(object):
+    """Tiles as a struct of arrays, one entry per tile: the x, y, w and h
+    of each, its depth (the generations of splitting that made it), and,
+    once they are known, its colors and its match. Indexing with an int
+    gives a Tile (with an index attribute) for code that wants one; with a
+    slice, an array of indexes or a boolean mask, a TileSet of those tiles.
+
+    rgb and lab are (N, 4, 3) arrays of the colors of the quadrants, and
+    image_id (-1 until matched), E_sq and dL describe the matches; each
+    image's filename is kept once, in filenames, by image_id."""
+    ARRAYS = ['x', 'y', 'w', 'h', 'depth', 'rgb', 'lab', 'image_id', 'E_sq',
+              'dL']
+
+    def __init__(self, x=(), y=(), w=(), h=(), depth=None, dtype=float):
+        self.x = np.asarray(x, dtype=dtype)
+        self.y = np.asarray(y, dtype=dtype)
+        self.w = np.asarray(w, dtype=dtype)
+        self.h = np.asarray(h, dtype=dtype)
+        n = len(self.x)
+        self.depth = np.zeros(n, dtype=np.uint8) if depth is None else \
+            np.asarray(depth, dtype=np.uint8)
+        self.rgb = np.zeros((n, 4, 3), dtype=np.float32)
+        self.lab = np.zeros((n, 4, 3), dtype=np.float32)
+        self.image_id = np.full(n, -1, dtype=np.int64)
+        self.E_sq = np.zeros(n, dtype=np.float32)
+        self.dL = np.zeros(n, dtype=np.float32)
+        self.filenames = {}
+
+    @classmethod
+    def from_tiles(cls, tiles):
+        "Make a TileSet of a list of Tile objects."
+        quads = [tile.quad() for tile in tiles]
+        return cls(*zip(*quads)) if quads else cls()
+
+    @classmethod
+    def concatenate(cls, sets):
+        sets = list(sets)
+        tiles = cls()
+        for name in cls.ARRAYS:
+            setattr(tiles, name, np.concatenate([getattr(t, name)
+                                                 for t in sets]))
+        for t in sets:
+            tiles.filenames.update(t.filenames)
+        return tiles
+
+    def __len__(self):
+        return len(self.x)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.tile(i)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            return self.tile(key)
+        tiles = TileSet()
+        for name in self.ARRAYS:
+            setattr(tiles, name, getattr(self, name)[key])
+        tiles.filenames = dict(self.filenames)
+        return tiles
+
+    def tile(self, i):
+        "A Tile of the i-th tile."
+        tile = Tile(self.x[i].item(), self.y[i].item(), self.w[i].item(),
+                    self.h[i].item())
+        tile.index = int(i)
+        return tile
+
+    def quads(self):
+        "An (N, 4) array of the x, y, w and h of each tile."
+        return np.column_stack([self.x, self.y, self.w, self.h])
+
+    def int_version(self):
+        """The tiles, like Tile.int_version, rounded out to whole pixels,
+        with their colors and matches."""
+        tiles = self[np.arange(len(self))]
+        tiles.x, tiles.y = np.floor(self.x).astype(int), \
+            np.floor(self.y).astype(int)
+        tiles.w = np.ceil(self.x + self.w).astype(int) - tiles.x
+        tiles.h = np.ceil(self.y + self.h).astype(int) - tiles.y
+        return tiles
+
+    def set_matches(self, indexes, matches):
+        "Record the matches (as Match or sqlite Rows) of the tiles at indexes."
+        for i, match in zip(indexes, matches):
+            if match is None:
+                self.image_id[i] = -1
+                continue
+            self.image_id[i] = match['image_id']
+            self.E_sq[i] = match['E_sq']
+            self.dL[i] = match['dL']
+            self.filenames[match['image_id']] = match['filename']
+
+    def match(self, i):
+        "The match of the i-th tile, as a Match, or None if it has none."
+        image_id = int(self.image_id[i])
+        if image_id < 0:
+            return None
+        return Match(image_id, float(self.E_sq[i]), float(self.dL[i]), None,
+                     self.filenames[image_id])
+
+# The crops of tiles kept, at most, as a fraction of the size of the image.
+CACHE_FRACTION = 0.25
+
 class Partition:
-    def __init__(self, img, mask=None):
+    def __init__(self, img, mask=None, cache_fraction=CACHE_FRACTION,
+                 seed=None):
+        """Crops of the image and the mask are cached, least recently used
+        first out, up to cache_fraction of the bytes of each. seed seeds the
+        random blanking of tiles where the mask is grey."""
         self.img = img
         self.mask = mask
-        self.tiles = []
+        self.mask_stats = MaskStats(mask) if mask else None
+        self.random = np.random.RandomState(seed)
+        self.tiles = TileSet()
         self.final_tiles = None
-        self.img_cache = {}
-        self.mask_cache = {}
+        self.img_cache = LRUCache(
+            int(cache_fraction*image_nbytes(img.size, img.mode)),
+            name='tile crops')
+        self.mask_cache = LRUCache(
+            int(cache_fraction*image_nbytes(mask.size, mask.mode))
+            if mask else 0, name='mask crops')
 
     def simple_partition(self, dimensions=10):
-        "Partition the target image into a list of Tile objects."
+        "Partition the target image into a TileSet."
         if isinstance(dimensions, int):
             dimensions = dimensions, dimensions
 
         width = self.img.size[0] / dimensions[0] 
         height = self.img.size[1] / dimensions[1]
 
-        for y in range(dimensions[1]):
-            for x in range(dimensions[0]):
-                self.tiles.append( Tile(x*width, y*height, width, height) )
+        x, y = np.meshgrid(np.arange(dimensions[0])*width,
+                           np.arange(dimensions[1])*height)
+        n = x.size
+        self.tiles = TileSet.concatenate([
+            self.tiles, TileSet(x.ravel(), y.ravel(), np.full(n, width),
+                                np.full(n, height))])
 
     def brick_partition(self, dimensions=10):
         if isinstance(dimensions, int):
@@ -78,30 +198,63 @@ class Partition:
         width = self.img.size[0] / dimensions[0] 
         height = self.img.size[1] / dimensions[1]
 
+        tiles = []
         for y in range(dimensions[1]):
             if y%2==0:
                 for x in range(dimensions[0]):
-                    self.tiles.append( Tile(x*width, y*height, width, height) )
+                    tiles.append( Tile(x*width, y*height, width, height) )
             else:
                 for x in range(dimensions[0]-1):
-                    self.tiles.append( Tile(x*width+width/2, y*height, width, height) )
-                self.tiles.append( Tile(0, y*height, width/2, height) )    
-                self.tiles.append( Tile(self.img.size[0]-width/2, y*height, width/2, height) )    
+                    tiles.append( Tile(x*width+width/2, y*height, width, height) )
+                tiles.append( Tile(0, y*height, width/2, height) )    
+                tiles.append( Tile(self.img.size[0]-width/2, y*height, width/2, height) )    
+        self.tiles = TileSet.concatenate([self.tiles,
+                                          TileSet.from_tiles(tiles)])
 
     def recursive_split(self, depth=0, hdr=80):
-        for g in xrange(depth):
-            old_tiles = self.tiles
-            self.tiles = []
-            for tile in old_tiles:
-                im = self.get_tile_img(tile)
-                if dynamic_range(im) > hdr or self.straddles_mask_edge(tile):
-                    # Keep children; discard parent.
-                    self.tiles += procreate(tile)
-                else:
-                    # Keep tile -- no children.
-                    self.tiles.append(tile)
-            logging.info("There are %d tiles in generation %d",
-                         len(self.tiles), g)
+        """Split each tile into quadrants, for depth generations, wherever
+        its blurred dynamic range is more than hdr or it straddles the edge
+        of the mask. The statistics of every tile of every generation are
+        worked out at once, with TileStats, so each decision is a lookup."""
+        if depth < 1 or not self.tiles:
+            return
+        stats = TileStats(self.img, self.tiles, depth, self.mask_stats)
+        # Each tile is a cell (generation, parent, column, row), listed in
+        # the order that splitting in place would leave the tiles.
+        g = np.zeros(len(self.tiles), dtype=int)
+        parent = np.arange(len(self.tiles))
+        i = np.zeros(len(self.tiles), dtype=int)
+        j = np.zeros(len(self.tiles), dtype=int)
+        for gen in xrange(depth):
+            # Tiles kept in earlier generations would be kept again.
+            new = np.flatnonzero(g == gen)
+            split = np.zeros(len(g), dtype=bool)
+            split[new] = ((stats.dynamic_range(gen, parent[new], i[new], j[new])
+                           > hdr)
+                          | stats.straddles_mask_edge(gen, parent[new], i[new],
+                                                      j[new]))
+            # Keep children; discard parent. The children of a tile are in
+            # procreate's order.
+            count = np.where(split, 4, 1)
+            g, parent, i, j = [np.repeat(a, count) for a in (g, parent, i, j)]
+            child = np.arange(len(g)) - np.repeat(np.cumsum(count) - count,
+                                                  count)
+            children = np.repeat(split, count)
+            g[children] += 1
+            i[children] = 2*i[children] + child[children]//2
+            j[children] = 2*j[children] + child[children]%2
+            logging.info("There are %d tiles in generation %d", len(g), gen)
+        # The tiles, with the same coordinates procreate would give them.
+        tiles = TileSet(np.empty(len(g)), np.empty(len(g)), np.empty(len(g)),
+                        np.empty(len(g)), self.tiles.depth[parent] + g)
+        for gen in xrange(depth + 1):
+            cells = g == gen
+            p, x, y = parent[cells], i[cells], j[cells]
+            tiles.x[cells] = stats.xs[gen][p, x]
+            tiles.y[cells] = stats.ys[gen][p, y]
+            tiles.w[cells] = stats.ws[gen][p]
+            tiles.h[cells] = stats.hs[gen][p]
+        self.tiles = tiles
 
     def straddles_mask_edge(self, tile):
         """A tile straddles an edge if it contains PURE white (255) and some
@@ -109,13 +262,8 @@ class Partition:
         straddle an edge."""
         if not self.mask:
             return False
-        mtile = self.get_mask_img(tile)
-        darkest_pixel, brightest_pixel = mtile.getextrema()
-        if brightest_pixel != 255:
-            return False
-        if darkest_pixel == 255:
-            return False
-        return True
+        x0, y0, x1, y1 = tile.int_version().coords()
+        return bool(self.mask_stats.straddles_edge(x0, y0, x1, y1))
 
     def remove_blanks(self, max_size=0.2):
         """Decide which tiles are blank. 
@@ -124,38 +272,38 @@ class Partition:
               max_size * img_width)"""
         if not self.mask:
             return
-        new_tiles = []
-        for tile in self.tiles:
-            mtile = self.get_mask_img(tile)
-            brightest_pixel = mtile.getextrema()[1]
-            if brightest_pixel == 255:
-                new_tiles.append( tile )
-            elif brightest_pixel == 0:
-                continue
-            elif tile.w >= max_size * self.img.size()[0]:
-                continue
-            elif rand_range(255) < brightest_pixel:
-                new_tiles.append( tile )
+        tiles = self.tiles.int_version()
+        brightest_pixel = self.mask_stats.brightest(
+            tiles.x, tiles.y, tiles.x + tiles.w, tiles.y + tiles.h)
+        # Keep tiles with some white; blank those with none, and grey ones
+        # that are not small; keep small grey ones with a chance that grows
+        # with their brightest pixel.
+        grey = ((brightest_pixel > 0) & (brightest_pixel < 255)
+                & (self.tiles.w < max_size * self.img.size[0]))
+        chance = self.random.randint(0, 255, len(self.tiles))
+        keep = (brightest_pixel == 255) | (grey & (chance < brightest_pixel))
             
         logger.info("%d/%d tiles are set to be blank",
-                    len(self.tiles)-len(new_tiles), len(self.tiles))
-        self.tiles = new_tiles
+                    len(self.tiles)-keep.sum(), len(self.tiles))
+        self.tiles = self.tiles[keep]
 
     def get_tiles(self):
-        if self.final_tiles:
+        "Return the final tiles, without blanks, in whole pixels, as a TileSet."
+        if self.final_tiles is not None:
             return self.final_tiles
         self.remove_blanks()
-        self.final_tiles = map(Tile.int_version, self.tiles)
+        self.final_tiles = self.tiles.int_version()
         return self.final_tiles
 
     def get_cached_img(self, tile, cache, img):
         if tile.is_float():
             tile = tile.int_version()
 
-        if tile not in cache:
-            cache[tile] = img.crop( tile.coords() )
+        cropped = cache.get(tile)
+        if cropped is None:
+            cropped = cache[tile] = img.crop( tile.coords() )
 
-        return cache[tile]
+        return cropped
 
     def get_tile_img(self, tile):
         return self.get_cached_img(tile, self.img_cache, self.img)
@@ -18,15 +18,16 @@
 
 from __future__ import division
 import logging
-import random
 import numpy as np
 from PIL import Image
 from progress_bar import progress_bar
 from sql_image_pool import SqlImagePool
-from tile import Tile
 from image_functions import *
 from partition import *
 from image_analysis import *
+from match_plan import save_plan, load_plan
+from render import layout, render_tiles, render_strips
+from strip_writer import open_writer
 
 # Configure logger.
 FORMAT = "%(name)s.%(funcName)s:  %(message)s"
@@ -56,14 +57,17 @@ class Photomosaic:
             self.img = self.tune(quiet=True)
         else:    
             self.img = self.orig_img
-        self.tiles = None
+        self.tiles = None # a TileSet, with the colors and matches of the tiles
         self.mos = None
-        self.numbers = {}
-        self.matches = {}
         
-    def partition_tiles(self, dimensions=10, depth=0, hdr=80, analyze=True):
-        "Partition the target image into a list of Tile objects."
-        self.p = Partition(self.img, self.mask)
+    def partition_tiles(self, dimensions=10, depth=0, hdr=80, analyze=True,
+                        vectorized=False, processes=1, seed=None):
+        """Partition the target image into a TileSet, self.tiles. With
+        vectorized=True, analyze all the tiles at once from an array of the
+        target, instead of cropping each one. With processes > 1, analyze
+        the tiles one by one, as usual, but in that many processes. seed
+        seeds the random blanking of small tiles where the mask is grey."""
+        self.p = Partition(self.img, self.mask, seed=seed)
         self.p.simple_partition(dimensions)
         self.p.recursive_split(depth, hdr)    
             
@@ -71,65 +75,125 @@ class Photomosaic:
 
         if not analyze:
             return
+        if vectorized:
+            logger.info("Analyzing %d tiles at once.", len(self.tiles))
+            self.tiles.rgb, self.tiles.lab = analyze_tiles(
+                self.p.img, self.tiles, self.pool.estimator)
+            return
         pbar = progress_bar(len(self.tiles), "Analyzing images")
-        for tile in self.tiles:
-            self.analyze_one(tile)
+        if processes > 1:
+            results = analyze_tiles_parallel(self.p.img, self.tiles,
+                                             self.pool.estimator, processes)
+            for i, (rgb, lab) in enumerate(results):
+                self.tiles.rgb[i], self.tiles.lab[i] = rgb, lab
+                pbar.next()
+            return
+        for i in xrange(len(self.tiles)):
+            self.analyze_one(i)
             pbar.next()
+        self.p.img_cache.log_stats(logging.DEBUG)
             
     def analyze_one(self, tile):
-        self.numbers[tile] = analyze_this( self.p.get_tile_img(tile) )
-        return self.numbers[tile]
+        "Analyze one tile, given as its index or as a Tile of self.tiles."
+        i = getattr(tile, 'index', tile)
+        rgb, lab = analyze_this(self.p.get_tile_img(self.tiles[i]),
+                                self.pool.estimator)
+        self.tiles.rgb[i], self.tiles.lab[i] = rgb, lab
+        return rgb, lab
 
-    def match(self, tolerance=1, usage_penalty=1, usage_impunity=2):
-        """Assign each tile a new image, and open that image in the Tile object."""
+    def match(self, tolerance=1, usage_penalty=1, usage_impunity=2,
+              method='greedy', max_usage=1, candidates=20):
+        """Assign each tile a new image, and open that image in the Tile object.
+        The 'greedy' method chooses for one tile after another, penalizing
+        reuse. The 'assign' method chooses for all tiles at once, minimizing
+        the total color difference with no image used more than max_usage
+        times, among the nearest candidates to each tile."""
+        if method not in ('greedy', 'assign'):
+            raise ValueError("Unknown match method %r. Choose greedy or assign."
+                             % method)
         if len(self.pool)==0:
             logger.error('No images in pool to match!')
             exit(-1)
         self.pool.reset_usage()
         
+        if method == 'assign':
+            logger.info("Assigning images to %d tiles at once.", len(self.tiles))
+            matches = self.pool.assign_matches(self.tiles.lab, max_usage,
+                                               candidates)
+            self.tiles.set_matches(xrange(len(self.tiles)), matches)
+            return
         pbar = progress_bar(len(self.tiles), "Choosing and loading matching images")
-        for tile in self.tiles:
-            self.match_one(tile, tolerance, usage_penalty, usage_impunity)
-            pbar.next()
+        batch = 256
+        for start in range(0, len(self.tiles), batch):
+            labs = self.tiles.lab[start:start + batch].tolist()
+            matches = self.pool.choose_matches(labs, tolerance, usage_penalty)
+            self.tiles.set_matches(xrange(start, start + len(matches)),
+                                   matches)
+            for match in matches:
+                pbar.next()
     
     def match_one(self, tile, tolerance=1, usage_penalty=1, usage_impunity=2):
-        rgb, lab = self.numbers[ tile ] 
+        "Match one tile, given as its index or as a Tile of self.tiles."
+        i = getattr(tile, 'index', tile)
+        lab = self.tiles.lab[i].tolist()
         match = self.pool.choose_match(lab, tolerance, usage_penalty )
-        self.matches[ tile ] = match
+        self.tiles.set_matches([i], [match])
         return match
             
+    def save_plan(self, path):
+        """Save the tiles and their matches to a file, so that the mosaic can
+        be assembled again later with load_plan, without matching."""
+        save_plan(path, self.tiles)
+
+    def load_plan(self, path):
+        "Load tiles and their matches saved by save_plan, ready to assemble."
+        self.tiles = load_plan(path)
+
     def assemble(self, pad=False, scatter=False, margin=0, scaled_margin=False,
-           background=(255, 255, 255), new_width=None):
-        """Create the mosaic image.""" 
-        # Infer dimensions so they don't have to be passed in the function call.
-        mosaic_size = map(max, zip(*[(tile.x+tile.w, tile.y+tile.h) for tile in self.tiles]))
-        if new_width is None:
-            scale = 1.0
-        else:
-            scale = new_width / mosaic_size[0]
-            mosaic_size = (new_width, int(scale * mosaic_size[1]))
-        
+           background=(255, 255, 255), new_width=None, shuffle=False,
+           threads=None):
+        """Create the mosaic image. Tiles are rendered in threads (by default,
+        one per core), each pool image decoded once; see render.render_tiles.
+        With shuffle=True, tiles are pasted in a random order, which decides
+        which is on top where they overlap. pad, scatter, margin and
+        scaled_margin shrink and move the tiles; see render.layout.
+        Scattered tiles are always shuffled.""" 
+        mosaic_size, scale = self.mosaic_size(new_width)
         mos = Image.new('RGB', mosaic_size, background)
-        pbar = progress_bar(len(self.tiles), "Scaling and placing tiles")
-        random.shuffle(self.tiles)
-        for tile in self.tiles:
-            if False: #pad: TODO!
-                size = shrink_by_lightness(pad, tile.size, tile.match['dL'])
-                if margin == 0:
-                    margin = min(tile.size[0] - size[0], tile.size[1] - size[1])
-            else:
-                size = int(tile.w*scale), int(tile.h*scale)
-            if scaled_margin:
-                pos = tile.get_position(size, scatter, margin//(1 + tile.depth)) #TODO
-            else:
-                pos = int(tile.x*scale), int(tile.y*scale) #tile.get_position(size, scatter, margin)
-                
-            fn = self.matches[tile][4]
-            mi = Image.open(fn)
-            mos.paste(crop_to_fit(mi, size), pos)
-            pbar.next()
+        placed = layout(self.tiles, scale, pad, scatter, margin, scaled_margin)
+        render_tiles(mos, self.pool, self.tiles, scale, shuffle or scatter,
+                     threads, placed=placed)
         self.mos = mos
         
+    def mosaic_size(self, new_width=None):
+        """The size of the mosaic, new_width wide if given, and the scale of
+        its tiles."""
+        # Infer dimensions so they don't have to be passed in the function call.
+        mosaic_size = [int((self.tiles.x + self.tiles.w).max()),
+                       int((self.tiles.y + self.tiles.h).max())]
+        if new_width is None:
+            return mosaic_size, 1.0
+        scale = new_width / mosaic_size[0]
+        return (new_width, int(scale * mosaic_size[1])), scale
+
+    def assemble_streaming(self, output_file, strip_height=1024,
+                           background=(255, 255, 255), new_width=None,
+                           shuffle=False, threads=None, pad=False,
+                           scatter=False, margin=0, scaled_margin=False):
+        """Create the mosaic and save it to output_file, a .tif (BigTIFF if
+        it is 4 GB or more) or a memory-mapped .npy, strip_height rows at a
+        time, so that memory holds a strip, not the whole mosaic. Levels
+        are untuned strip by strip, as save does. self.mos is not set. The
+        other options are as for assemble."""
+        mosaic_size, scale = self.mosaic_size(new_width)
+        lut = self.untune_lut() if self.tuning else None
+        placed = layout(self.tiles, scale, pad, scatter, margin, scaled_margin)
+        logger.info('Saving mosaic to %s', output_file)
+        with open_writer(output_file, mosaic_size, strip_height) as writer:
+            render_strips(writer, self.pool, self.tiles, mosaic_size, scale,
+                          background, lut, shuffle or scatter, threads,
+                          placed=placed)
+
     def save(self, output_file):
         if self.tuning:
             mos = self.untune()
@@ -181,12 +245,14 @@ class Photomosaic:
             plot_histograms(adjusted_hist, title='Adjusted target image')
         return adjusted_img
         
+    def untune_lut(self, amount=1):
+        """The table, for Image.point, that takes the levels of the tuned
+        target back to those of the original, blended by amount."""
+        img_palette = compute_palette(img_histogram(self.img, self.m))
+        return levels_lut(img_palette, self.target_palette, amount)
+
     def untune(self, amount=1):
-        if self.mask:
-            img_palette = compute_palette(img_histogram(self.img, m))
-        else:    
-            img_palette = compute_palette(img_histogram(self.img))
-        return Image.blend(self.mos, adjust_levels(self.mos, img_palette, self.target_palette), amount)
+        return self.mos.point(self.untune_lut(amount))
 
 
 def assemble_tiles(tiles, margin=1):
@@ -3,30 +3,38 @@ import time
 
 logger = logging.getLogger(__name__)
 
-def progress_bar(total_steps, message=''):
+def progress_bar(total_steps=None, message=''):
     """This generator gives regular progress reports. Usage:
     pbar = progressbar(len(steps)), "Doing steps...")
     for step in steps:
         ...
         pbar.next()
+    If total_steps is None (not known in advance) progress is reported as a
+    running count; call pbar.close() at the end to report the total time.
     """
     logger.info('%s...', message)
     step = 0
+    total = '?' if total_steps is None else total_steps
     start = time.clock()
     previous_notif = start
     virgin = True
-    while step < total_steps - 1:
-        now = time.clock()
-        elapsed = now - start
-        if (now - previous_notif) > 10:
-            logger.info("%s/%s complete after %d seconds elapsed", 
-                        step, total_steps, round(elapsed))
-            previous_notif = now
-        elif (virgin is True and elapsed > 1):
-            virgin = False
-            logger.info("%s/%s complete after %d second elapsed", 
-                        step, total_steps, round(elapsed))
-        yield
-        step += 1
+    try:
+        while total_steps is None or step < total_steps - 1:
+            now = time.clock()
+            elapsed = now - start
+            if (now - previous_notif) > 10:
+                logger.info("%s/%s complete after %d seconds elapsed", 
+                            step, total, round(elapsed))
+                previous_notif = now
+            elif (virgin is True and elapsed > 1):
+                virgin = False
+                logger.info("%s/%s complete after %d second elapsed", 
+                            step, total, round(elapsed))
+            yield
+            step += 1
+    except GeneratorExit:
+        logger.info("Completed %d steps in %d seconds.", step + 1,
+                    round(time.clock() - start))
+        return
     logger.info("Completed in %d seconds.", round(time.clock() - start))
     yield
@@ -0,0 +1,284 @@
+"""Render the matched tiles of a mosaic onto its canvas with a pool of
+threads.
+
+Tiles are grouped by the image they show (the pool file or thumbnail it
+is read from), so that each image is decoded once, and cropped and scaled
+once for each size it is shown at. Decoding and scaling are done in
+threads, as PIL lets go of the GIL for them; the results are pasted onto
+the canvas here, in the order the groups were given out, with only a
+bounded number of groups in flight at a time.
+
+A mosaic too large to hold can be rendered a strip of rows at a time, by
+render_strips, and written out strip by strip; tiles spanning strips are
+scaled once and kept for the next strip."""
+from __future__ import division
+import collections
+import itertools
+import logging
+import multiprocessing
+import random
+import threading
+from math import ceil
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from PIL import Image
+from image_functions import crop_to_fit, shrink_by_lightness
+from lru_cache import LRUCache
+from progress_bar import progress_bar
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+DECODED_BYTES = 128 << 20 # decoded images shared by tiles pasted in random order
+SCALED_BYTES = 128 << 20 # scaled tiles shared by the strips they span
+
+def bounded_imap(workers, func, items, prefetch):
+    """Like workers.imap(func, items), but with no more than prefetch items
+    given out and not yet collected, so that results waiting to be used do
+    not pile up."""
+    pending = collections.deque()
+    for item in items:
+        pending.append(workers.apply_async(func, (item,)))
+        if len(pending) >= prefetch:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def layout(tiles, scale=1.0, pad=0, scatter=False, margin=0,
+           scaled_margin=False):
+    """Place the tiles of a TileSet in the mosaic, scaled by scale. Return
+    int arrays x, y, w and h: where each tile is pasted, at what size.
+    With pad, tiles are shrunk by their matches' lightness error dL (see
+    shrink_by_lightness) and centered in their places. margin shrinks
+    tiles by that many pixels on every side or, with scatter, is how far
+    they may stray out of their places: scattered tiles go anywhere from
+    margin left of and above their places to margin beyond them. With
+    scaled_margin, a tile's margin is divided by one plus its depth, so
+    smaller tiles get smaller margins."""
+    x = (tiles.x*scale).astype(int)
+    y = (tiles.y*scale).astype(int)
+    box_w = (tiles.w*scale).astype(int)
+    box_h = (tiles.h*scale).astype(int)
+    if not (pad or scatter or margin):
+        return x, y, box_w, box_h
+    margins = np.full(len(tiles), int(margin), dtype=int)
+    if scaled_margin:
+        margins //= 1 + tiles.depth.astype(int)
+    w, h = box_w, box_h
+    if pad:
+        w, h = shrink_by_lightness(pad, (w, h), tiles.dL)
+    if not scatter:
+        w = np.maximum(w - 2*margins, 0)
+        h = np.maximum(h - 2*margins, 0)
+        return x + (box_w - w)//2, y + (box_h - h)//2, w, h
+    room_x = box_w - w + 2*margins + 1
+    room_y = box_h - h + 2*margins + 1
+    x = x - margins + (np.random.uniform(size=len(tiles))*room_x).astype(int)
+    y = y - margins + (np.random.uniform(size=len(tiles))*room_y).astype(int)
+    return x, y, w, h
+
+def decode(pool, source, sizes):
+    """Open an image from its source, drafting JPEGs down to the smallest
+    scale that can still fill every one of sizes."""
+    img = pool.read_source(source)
+    w, h = img.size
+    scale = max(max(tw/w, th/h) for tw, th in sizes)
+    if scale < 1:
+        img.draft('RGB', (int(ceil(w*scale)), int(ceil(h*scale))))
+    img.load()
+    return img
+
+class Renderer(object):
+    """Renders tiles from a pool, with threads workers; see render_tiles.
+    If scaled_bytes is given, tiles already scaled are kept, up to that
+    many bytes, for later calls to render: a canvas drawn in parts sees
+    the same tiles again. Images are drafted for the sizes a call to
+    render shows them at, unless draft_sizes maps their sources to the
+    sizes to draft them for."""
+    def __init__(self, pool, threads=None, prefetch=None, scaled_bytes=None):
+        self.pool = pool
+        self.threads = threads or multiprocessing.cpu_count()
+        self.prefetch = prefetch or 4*self.threads
+        # For tiles pasted one by one, decoded images are shared through a
+        # cache, which the threads take turns at.
+        self.decoded = LRUCache(DECODED_BYTES, name='decoded images')
+        self.lock = threading.Lock()
+        self.scaled = None
+        if scaled_bytes:
+            self.scaled = LRUCache(scaled_bytes, name='scaled tiles')
+        self.draft_sizes = {}
+
+    def job(self, args):
+        """Decode a source and make a tile of each size. Return a list of
+        (tile image, the indexes of the tiles to paste it at), in the order
+        of sizes."""
+        source, sizes, cached = args
+        draft_sizes = self.draft_sizes.get(source) or sizes.keys()
+        found = {}
+        if self.scaled is not None:
+            with self.lock:
+                found = dict((size, self.scaled.get((source, size)))
+                             for size in sizes)
+        if found and all(img is not None for img in found.itervalues()):
+            return [(found[size], indexes)
+                    for size, indexes in sizes.iteritems()]
+        if cached:
+            key = source, tuple(sorted(draft_sizes))
+            with self.lock:
+                img = self.decoded.get(key)
+            if img is None:
+                img = decode(self.pool, source, draft_sizes)
+                with self.lock:
+                    self.decoded[key] = img
+        else:
+            img = decode(self.pool, source, draft_sizes)
+        # In the order of sizes, which is the order they are pasted in.
+        made = []
+        for size, indexes in sizes.iteritems():
+            tile = found.get(size)
+            if tile is None:
+                tile = crop_to_fit(img, size)
+                if self.scaled is not None:
+                    with self.lock:
+                        self.scaled[source, size] = tile
+            made.append((tile, indexes))
+        return made
+
+    def sources(self, tiles, w, h):
+        """The indexes of the matched tiles of a TileSet that are not empty
+        at the widths w and heights h they are pasted at, the sources of
+        their images, and w and h, as lists."""
+        w = np.asarray(w).tolist()
+        h = np.asarray(h).tolist()
+        matched = [i for i in xrange(len(tiles))
+                   if tiles.image_id[i] >= 0 and w[i] > 0 and h[i] > 0]
+        sources = self.pool.image_sources(
+            [(int(tiles.image_id[i]), tiles.filenames[tiles.image_id[i]],
+              (w[i], h[i])) for i in matched])
+        return matched, sources, w, h
+
+    @staticmethod
+    def group(matched, sources, w, h):
+        """Group tile indexes by source, and those by size, each in order of
+        first appearance."""
+        groups = collections.OrderedDict()
+        for i, source in zip(matched, sources):
+            groups.setdefault(source, collections.OrderedDict()) \
+                .setdefault((w[i], h[i]), []).append(i)
+        return groups
+
+    def render(self, canvas, tiles, scale=1.0, shuffle=False, offset=(0, 0),
+               quiet=False, in_order=False, placed=None):
+        """Paste each matched tile of a TileSet onto canvas, scaled by scale,
+        with the canvas's corner at offset in the scaled mosaic. placed is
+        the tiles' x, y, w and h in the scaled mosaic, as made by layout
+        (by default, with no padding or margins). With shuffle=True, tiles
+        are pasted one by one in a random order, which decides which tile
+        is on top where they overlap, and with in_order=True, one by one in
+        their order in the TileSet; otherwise, all the tiles showing one
+        image at one size are pasted together."""
+        if placed is None:
+            placed = layout(tiles, scale)
+        x = (placed[0] - offset[0]).tolist()
+        y = (placed[1] - offset[1]).tolist()
+        matched, sources, w, h = self.sources(tiles, placed[2], placed[3])
+        one_by_one = shuffle or in_order
+        if one_by_one:
+            order = range(len(matched))
+            if shuffle:
+                random.shuffle(order)
+            jobs = [(sources[k], {(w[matched[k]], h[matched[k]]):
+                                  [matched[k]]}, True) for k in order]
+        else:
+            jobs = [(source, sizes, False) for source, sizes
+                    in self.group(matched, sources, w, h).iteritems()]
+        if quiet:
+            pbar = itertools.repeat(None)
+        else:
+            logger.info("Rendering %d tiles from %d images with %d threads.",
+                        len(matched), len(set(sources)), self.threads)
+            pbar = progress_bar(len(matched), "Scaling and placing tiles")
+        workers = ThreadPool(self.threads)
+        try:
+            for made in bounded_imap(workers, self.job, jobs, self.prefetch):
+                for img, indexes in made:
+                    for i in indexes:
+                        canvas.paste(img, (x[i], y[i]))
+                        pbar.next()
+        finally:
+            workers.terminate()
+        if one_by_one:
+            self.decoded.log_stats(logging.DEBUG)
+            self.decoded.clear()
+
+def render_tiles(canvas, pool, tiles, scale=1.0, shuffle=False, threads=None,
+                 prefetch=None, placed=None):
+    """Paste the matched tiles of a TileSet onto canvas, scaled by scale and
+    placed as layout placed them, reading their images from pool with
+    threads threads (by default, one per core) and no more than prefetch
+    jobs ahead."""
+    Renderer(pool, threads, prefetch).render(canvas, tiles, scale, shuffle,
+                                             placed=placed)
+
+def render_strips(writer, pool, tiles, size, scale=1.0,
+                  background=(255, 255, 255), lut=None, shuffle=False,
+                  threads=None, prefetch=None, placed=None):
+    """Render the matched tiles of a TileSet, scaled by scale and placed as
+    layout placed them, into a mosaic of the given size, one strip of rows
+    at a time, each handed to a strip_writer writer once it is done. Only
+    a strip is held in memory, not the mosaic. Each strip is passed
+    through lut, a table for Image.point, if given."""
+    width, height = size
+    if placed is None:
+        placed = layout(tiles, scale)
+    top = placed[1]
+    bottom = top + placed[3]
+    # Tiles by their first row. A tile enters the strips when the first of
+    # them reaches it, and leaves when one starts below it.
+    order = np.argsort(top, kind='mergesort')
+    tops = top[order]
+    active = np.empty(0, dtype=int)
+    entered = 0
+    renderer = Renderer(pool, threads, prefetch, SCALED_BYTES)
+    groups = renderer.group(*renderer.sources(tiles, placed[2], placed[3]))
+    # Each image is drafted for every size it is shown at in the mosaic,
+    # not only those in the strip at hand, so that it is decoded at the
+    # same scale in every strip, as render decodes it for the whole mosaic.
+    renderer.draft_sizes = dict((source, sizes.keys())
+                                for source, sizes in groups.iteritems())
+    # Every strip pastes its tiles in the order of one paste order for the
+    # whole mosaic, so that where tiles overlap, the same one is on top in
+    # every strip. Unshuffled, tiles sorted in the order render pastes them
+    # are grouped by render in that same order.
+    if shuffle:
+        pasted = np.random.permutation(len(tiles))
+    else:
+        pasted = [i for sizes in groups.itervalues()
+                  for indexes in sizes.itervalues() for i in indexes]
+    rank = np.empty(len(tiles), dtype=int)
+    rank.fill(len(tiles))
+    rank[pasted] = np.arange(len(pasted))
+    strips = range(0, height, writer.strip_height)
+    logger.info("Rendering %d tiles in %d strips of %d rows with %d threads.",
+                len(tiles), len(strips), writer.strip_height,
+                renderer.threads)
+    pbar = progress_bar(len(strips), "Rendering and writing strips")
+    for y in strips:
+        rows = min(writer.strip_height, height - y)
+        reached = np.searchsorted(tops, y + rows)
+        active = np.concatenate([active, order[entered:reached]])
+        entered = reached
+        active = active[bottom[active] > y]
+        strip = Image.new('RGB', (width, rows), background)
+        chosen = active[np.argsort(rank[active], kind='mergesort')]
+        renderer.render(strip, tiles[chosen], scale, offset=(0, y),
+                        quiet=True, in_order=shuffle,
+                        placed=[a[chosen] for a in placed])
+        if lut is not None:
+            strip = strip.point(lut)
+        writer.write(strip)
+        pbar.next()
+    if renderer.scaled is not None:
+        renderer.scaled.log_stats(logging.DEBUG)
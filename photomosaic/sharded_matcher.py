@@ -0,0 +1,114 @@
+"""Match on many cores by splitting the pool into shards.
+
+Each shard is a range of image_ids, loaded from the pool database by its
+own worker process over its own read-only connection, so the pool's
+changes must be committed before the shards are loaded. For each target,
+every worker returns the k nearest images in its shard; the nearest k of
+those are then ranked here, with the tolerance and usage rules applied
+across the whole pool."""
+from __future__ import division
+import multiprocessing
+import sqlite3
+import logging
+import numpy as np
+from array_matcher import ArrayMatcher, load_features, as_targets
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+# The shard loaded in a worker process.
+_shard = None
+
+def _open_shard(db_name, low, high):
+    "Load the images with low <= image_id <= high, in a worker process."
+    global _shard
+    db = sqlite3.connect(db_name)
+    db.execute("PRAGMA query_only=ON")
+    try:
+        _shard = ArrayMatcher(*load_features(db, low, high))
+    finally:
+        db.close()
+
+def _shard_top_k(targets, k):
+    "Return the image_ids and E_sq of the k images nearest each target."
+    if not len(_shard):
+        return (np.empty((len(targets), 0), dtype=np.int64),
+                np.empty((len(targets), 0), dtype=np.float32))
+    rows, E_sq = _shard.top_k(targets, k)
+    return _shard.image_ids[rows], E_sq
+
+def shard_ranges(image_ids, shards):
+    "Split sorted image_ids into shards ranges of about equal size."
+    bounds = np.linspace(0, len(image_ids), shards + 1).astype(int)
+    return [(int(image_ids[start]), int(image_ids[stop - 1]))
+            for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+class ShardedMatcher(ArrayMatcher):
+    """An ArrayMatcher that finds each target's k nearest images with one
+    worker process per shard of the pool. Among those, the tolerance
+    jitter and usage penalty are applied as usual, with usage counted
+    here, over the whole pool. Call close to stop the workers."""
+    def __init__(self, image_ids, features, usages, filenames, db_name,
+                 processes=None, k=50, block=1024, seed=None):
+        ArrayMatcher.__init__(self, image_ids, features, usages, filenames,
+                              seed)
+        self.k = k
+        self.block = block
+        processes = processes or multiprocessing.cpu_count()
+        # A pool of one process for each shard, so that each shard's
+        # images are loaded by one process and stay there.
+        self.workers = [multiprocessing.Pool(1, _open_shard,
+                                             (db_name, low, high))
+                        for low, high in shard_ranges(image_ids, processes)]
+        logger.info("Matching with %d shards.", len(self.workers))
+
+    @classmethod
+    def from_pool(cls, pool, processes=None, k=50, seed=None):
+        """The workers read the pool over their own connections, which only
+        see committed rows, so images still buffered by a bulk load or in
+        an open transaction are written and committed first."""
+        if getattr(pool, 'writer', None) is not None:
+            pool.writer.flush()
+        pool.db.commit()
+        return cls(*load_features(pool.db), db_name=pool.db_name,
+                   processes=processes, k=k, seed=seed)
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+        self.workers = []
+
+    def top_k(self, labs, k=20, block=None):
+        targets = as_targets(labs)
+        k = min(k, len(self))
+        rows = np.empty((len(targets), k), dtype=np.int64)
+        E_sq = np.empty((len(targets), k), dtype=np.float32)
+        block = block or self.block
+        for start in range(0, len(targets), block):
+            chunk = targets[start:start + block]
+            results = [worker.apply_async(_shard_top_k, (chunk, k))
+                       for worker in self.workers]
+            found = [result.get() for result in results]
+            # Merge: the nearest k of each shard's nearest k.
+            ids = np.concatenate([shard_ids for shard_ids, _ in found], 1)
+            dist = np.concatenate([shard_dist for _, shard_dist in found], 1)
+            near = np.argpartition(dist, k - 1, 1)[:, :k]
+            within = np.arange(len(chunk))[:, np.newaxis]
+            found_rows = np.searchsorted(self.image_ids, ids[within, near])
+            rows[start:start + len(chunk)], E_sq[start:start + len(chunk)] = \
+                self._sort_rows(chunk, found_rows)
+        return rows, E_sq
+
+    def choose_matches(self, labs, tolerance=1, usage_penalty=1):
+        targets = as_targets(labs)
+        matches = []
+        for start in range(0, len(targets), self.block):
+            chunk = targets[start:start + self.block]
+            candidates, _ = self.top_k(chunk, self.k)
+            for target, rows in zip(chunk, candidates):
+                E_sq, dL = self.distances(target[np.newaxis], rows)
+                matches.append(self._choose(E_sq[0], dL[0], rows, tolerance,
+                                            usage_penalty))
+        return matches
@@ -0,0 +1,106 @@
+from __future__ import division
+import cPickle
+import io
+import logging
+import numpy as np
+from scipy.spatial import cKDTree
+from array_matcher import IndexMatcher, SavedIndex, load_features, as_targets
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+class KDTreeIndex(SavedIndex):
+    """A k-d tree over the 12-D Lab vectors of a pool. Images added since
+    the tree was built are kept in a short list that is searched by brute
+    force, until there are enough of them to make rebuilding worthwhile.
+    Any other change to the pool means a rebuild."""
+    def __init__(self, image_ids, features, rebuild_fraction=0.1):
+        self.rebuild_fraction = rebuild_fraction
+        self.build(image_ids, features)
+
+    def build(self, image_ids, features):
+        self.image_ids = np.asarray(image_ids, dtype=np.int64)
+        self.tree = cKDTree(np.asarray(features, dtype=np.float32))
+        self.pending_ids = np.empty(0, dtype=np.int64)
+        self.pending = np.empty((0, 12), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.image_ids) + len(self.pending_ids)
+
+    def contents(self):
+        "Return the ids (sorted) and features of the images in the index."
+        ids = np.concatenate([self.image_ids, self.pending_ids])
+        features = np.concatenate([self.tree.data.astype(np.float32),
+                                   self.pending])
+        order = ids.argsort()
+        return ids[order], features[order]
+
+    def update(self, image_ids, features):
+        """Bring the index up to date with a pool whose images are image_ids
+        (sorted) with the given features. Return True if anything changed."""
+        known_ids, known = self.contents()
+        if np.array_equal(known_ids, image_ids) and \
+           np.array_equal(known, features):
+            return False
+        old = np.in1d(image_ids, known_ids, assume_unique=True)
+        only_added = np.array_equal(image_ids[old], known_ids) and \
+                     np.array_equal(features[old], known)
+        pending = len(self.pending_ids) + len(old) - old.sum()
+        if only_added and pending <= self.rebuild_fraction*len(image_ids):
+            self.pending_ids = np.concatenate([self.pending_ids,
+                                               image_ids[~old]])
+            self.pending = np.concatenate([self.pending, features[~old]])
+        else:
+            logger.info("Rebuilding the k-d tree for %d images.",
+                        len(image_ids))
+            self.build(image_ids, features)
+        return True
+
+    def query(self, lab, k=50):
+        "Return the ids of the (up to) k images closest to lab."
+        target = np.asarray(lab, dtype=np.float32).reshape(12)
+        want = min(len(self.image_ids), k)
+        ids = np.empty(0, dtype=np.int64)
+        dist = np.empty(0)
+        if want:
+            dist, rows = self.tree.query(target, want)
+            dist, rows = np.atleast_1d(dist), np.atleast_1d(rows)
+            ids = self.image_ids[rows]
+        if len(self.pending_ids):
+            pending_dist = np.sqrt(((self.pending - target)**2).sum(1))
+            ids = np.concatenate([ids, self.pending_ids])
+            dist = np.concatenate([dist, pending_dist])
+        return ids[np.argsort(dist, kind='mergesort')[:k]]
+
+    def save(self, path):
+        with io.open(path, 'wb') as f:
+            cPickle.dump(self.__dict__, f, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        index = cls.__new__(cls)
+        with io.open(path, 'rb') as f:
+            index.__dict__.update(cPickle.load(f))
+        return index
+
+class KDTreeMatcher(IndexMatcher):
+    """An IndexMatcher that only considers the k images nearest to each
+    target, found with a KDTreeIndex kept in db_name + '.kdtree'. The
+    tolerance jitter and usage penalty are applied among those k."""
+    @classmethod
+    def from_pool(cls, pool, k=50, seed=None):
+        image_ids, features, usages, filenames = load_features(pool.db)
+        index = KDTreeIndex.open(pool.db_name + '.kdtree', image_ids, features)
+        return cls(image_ids, features, usages, filenames, index, k, seed)
+
+    def candidates(self, target, k):
+        return np.searchsorted(self.image_ids, self.index.query(target, k))
+
+    def top_k(self, labs, k=20, block=256):
+        targets = as_targets(labs)
+        k = min(k, len(self))
+        rows = np.array([self.candidates(target, k) for target in targets],
+                        dtype=np.int64)
+        return self._sort_rows(targets, rows.reshape(len(targets), k))
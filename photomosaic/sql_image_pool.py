@@ -1,6 +1,21 @@
 import sqlite3
 from image_pool import ImagePool
+from directory_walker import fs_path
+from thumbnail_store import ThumbnailStore, make_thumbnails, covers
+from color_estimators import get_estimator
+from array_matcher import ArrayMatcher, Match, JND, LAB_COLUMNS, MAX_E
+from spatial_index import KDTreeMatcher
+from ivf_index import IVFPQMatcher
+from sharded_matcher import ShardedMatcher
+from assignment import assign_matches
+from PIL import Image
+import numpy as np
+import collections
+import random
+import contextlib
 import logging
+import json
+import os
 
 # Configure logger.
 FORMAT = "%(name)s.%(funcName)s:  %(message)s"
@@ -15,6 +30,9 @@ def connect(db_path):
         logger.error("Cannot connect to SQLite database at %s",  db_path)
         return
     db.row_factory = sqlite3.Row # Rows are dictionaries.
+    # Filenames are byte strings (see directory_walker.fs_path), which may
+    # not be ASCII. Text is stored as given and read back as byte strings.
+    db.text_factory = str
     return db
     
 def create_tables(db):
@@ -28,7 +46,10 @@ def create_tables(db):
                   usages INTEGER,
                   w INTEGER,
                   h INTEGER,
-                  filename TEXT UNIQUE)""")
+                  filename TEXT UNIQUE,
+                  mtime REAL,
+                  size INTEGER,
+                  checksum TEXT)""")
     c.execute("""CREATE TABLE IF NOT EXISTS Colors
                  (color_id INTEGER PRIMARY KEY,
                   image_id INTEGER,
@@ -52,148 +73,817 @@ def create_tables(db):
                   L4 REAL,
                   a4 REAL,
                   b4 REAL)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS Thumbnails
+                 (image_id INTEGER,
+                  size INTEGER,
+                  w INTEGER,
+                  h INTEGER,
+                  shard INTEGER,
+                  offset INTEGER,
+                  length INTEGER,
+                  PRIMARY KEY (image_id, size))""")
+    c.execute("""CREATE TABLE IF NOT EXISTS SkippedFiles
+                 (filename TEXT PRIMARY KEY,
+                  mtime REAL,
+                  size INTEGER)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS Settings
+                 (name TEXT PRIMARY KEY,
+                  value TEXT)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS ColorHistogram
+                 (channel TEXT,
+                  value INTEGER,
+                  count INTEGER,
+                  PRIMARY KEY (channel, value))""")
+    c.execute("SELECT count(*) FROM ColorHistogram")
+    if c.fetchone()[0] == 0:
+        rebuild_histogram(db)
     c.close()
+    add_missing_columns(db, 'Images', [('mtime', 'REAL'),
+                                       ('size', 'INTEGER'),
+                                       ('checksum', 'TEXT')])
+    create_color_bounds(db)
+    create_indexes(db)
+    db.commit()
+
+def create_color_bounds(db):
+    """Keep the mean L, a and b of each image's quadrants (Lm, am, bm) in
+    LabColors, and index them in the R*Tree LabBounds, or, if SQLite was
+    built without the R*Tree module, a B-tree index made by create_indexes.
+    Pools made before these existed are filled in."""
+    add_missing_columns(db, 'LabColors', [('Lm', 'REAL'),
+                                          ('am', 'REAL'),
+                                          ('bm', 'REAL')])
+    # Look before filling in, so that opening a pool that needs nothing
+    # does not write, and does not wait for other connections' writes.
+    c = db.cursor()
+    try:
+        c.execute("SELECT 1 FROM LabColors WHERE Lm IS NULL LIMIT 1")
+        if c.fetchone() is not None:
+            c.execute("""UPDATE LabColors
+                         SET Lm=(L1+L2+L3+L4)/4.,
+                             am=(a1+a2+a3+a4)/4.,
+                             bm=(b1+b2+b3+b4)/4.
+                         WHERE Lm IS NULL""")
+        if not has_table(c, 'LabBounds'):
+            try:
+                c.execute("""CREATE VIRTUAL TABLE LabBounds
+                             USING rtree(image_id, Lm_min, Lm_max,
+                                         am_min, am_max, bm_min, bm_max)""")
+            except sqlite3.OperationalError:
+                logger.info("SQLite has no R*Tree module. Using a B-tree "
+                            "index.")
+                return
+        c.execute("""SELECT 1 FROM LabColors
+                     WHERE NOT EXISTS (SELECT 1 FROM LabBounds
+                                       WHERE LabBounds.image_id=
+                                             LabColors.image_id)
+                     LIMIT 1""")
+        if c.fetchone() is not None:
+            c.execute("""INSERT INTO LabBounds
+                         SELECT image_id, Lm, Lm, am, am, bm, bm
+                         FROM LabColors
+                         WHERE image_id NOT IN
+                         (SELECT image_id FROM LabBounds)""")
+    finally:
+        c.close()
+
+def has_table(db, name):
+    "Does the database (a connection or a cursor) have this table?"
+    return db.execute("SELECT count(*) FROM sqlite_master WHERE name=?",
+                      (name,)).fetchone()[0] > 0
+
+CHANNELS = ['red', 'green', 'blue']
+
+def rebuild_histogram(db):
+    """Count the values of each channel in the Colors table from scratch,
+    to fill the ColorHistogram table. Afterward, update_histogram keeps it
+    current."""
+    c = db.cursor()
+    try:
+        c.execute("DELETE FROM ColorHistogram")
+        c.executemany("""INSERT INTO ColorHistogram (channel, value, count)
+                         VALUES (?, ?, 0)""",
+                      [(ch, value) for ch in CHANNELS for value in range(256)])
+        for ch in CHANNELS:
+            c.execute("""SELECT {ch}, count(*)
+                         FROM Colors
+                         GROUP BY {ch}""".format(ch=ch))
+            c.executemany("""UPDATE ColorHistogram SET count=?
+                             WHERE channel=? AND value=?""",
+                          [(count, ch, value) for value, count in c.fetchall()])
+    finally:
+        c.close()
+
+def update_histogram(c, colors, sign=1):
+    """Add (sign=1) or remove (sign=-1) a list of (red, green, blue) colors
+    to or from the counts in the ColorHistogram table."""
+    counts = collections.Counter()
+    for rgb in colors:
+        for ch, value in zip(CHANNELS, rgb):
+            counts[ch, value] += 1
+    c.executemany("""UPDATE ColorHistogram SET count=count+?
+                     WHERE channel=? AND value=?""",
+                  [(sign*n, ch, value) for (ch, value), n in counts.iteritems()])
+
+def create_indexes(db):
+    """Index the color tables by image_id, for joins and deletes, and
+    without an R*Tree, LabColors by mean color, for choose_match."""
+    c = db.cursor()
+    try:
+        for table in ['Colors', 'LabColors']:
+            c.execute("""CREATE INDEX IF NOT EXISTS {0}_image_id
+                         ON {0} (image_id)""".format(table))
+        if not has_table(c, 'LabBounds'):
+            c.execute("""CREATE INDEX IF NOT EXISTS LabColors_means
+                         ON LabColors (Lm, am, bm)""")
+    finally:
+        c.close()
+
+def drop_indexes(db):
+    "Drop the indexes made by create_indexes, ahead of a bulk load."
+    c = db.cursor()
+    try:
+        for index in ['Colors_image_id', 'LabColors_image_id',
+                      'LabColors_means']:
+            c.execute("DROP INDEX IF EXISTS {0}".format(index))
+    finally:
+        c.close()
+
+def add_missing_columns(db, table, columns):
+    """Upgrade a table created by an older version of this module by adding
+    any of the (name, type) columns that it lacks."""
+    c = db.cursor()
+    try:
+        c.execute("PRAGMA table_info({0})".format(table))
+        existing = [row['name'] for row in c.fetchall()]
+        for name, sql_type in columns:
+            if name not in existing:
+                c.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                          table, name, sql_type))
+    finally:
+        c.close()
+
+def directory_bounds(directory):
+    """The bounds, low <= filename < high, of the filenames under directory.
+    Filenames under a sibling that merely starts with the same name, like
+    photos_2019 beside photos, are out of bounds. As DirectoryWalker names
+    files by joining the directory as given, less trailing separators, it
+    is not normalized further: './photos' covers './photos/a.jpg'."""
+    directory = fs_path(directory).rstrip(os.sep)
+    # Everything starting with directory and a separator sorts before
+    # directory and the character after the separator.
+    return directory + os.sep, directory + chr(ord(os.sep) + 1)
+
+INSERT_IMAGE = """INSERT INTO Images (image_id, usages, w, h, filename,
+                                      mtime, size, checksum)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+def color_means(lab):
+    "The mean L, a and b of the four quadrants of lab."
+    return [sum(color[ch] for color in lab)/4. for ch in range(3)]
+
+def insert_colors(c, records):
+    """Insert rows into the Colors and LabColors tables for a list of
+    (image_id, rgb, lab) records."""
+    c.executemany("""INSERT INTO Colors (image_id, region, red, green, blue)
+                     VALUES (?, ?, ?, ?, ?)""",
+                  [(image_id, region, r, g, b) for image_id, rgb, lab in records
+                   for region, (r, g, b) in enumerate(rgb)])
+    c.executemany("""INSERT INTO LabColors (image_id,
+                     L1, a1, b1, L2, a2, b2, L3, a3, b3, L4, a4, b4,
+                     Lm, am, bm)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                  [tuple([image_id] + [ch for reg in lab for ch in reg]
+                         + color_means(lab))
+                   for image_id, rgb, lab in records])
+    if has_table(c, 'LabBounds'):
+        c.executemany("""INSERT INTO LabBounds
+                         VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                      [(image_id, Lm, Lm, am, am, bm, bm)
+                       for image_id, rgb, lab in records
+                       for Lm, am, bm in [color_means(lab)]])
+    update_histogram(c, [color for image_id, rgb, lab in records
+                         for color in rgb])
+
+def insert_thumbnails(c, store, records):
+    """Write thumbnails into a ThumbnailStore and record where they are in
+    the Thumbnails table. records is a list of (image_id, thumbs)."""
+    c.executemany("""INSERT OR REPLACE INTO Thumbnails
+                     (image_id, size, w, h, shard, offset, length)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                  store.write(records))
+
+
+class BulkWriter:
+    """Buffer images on their way into the pool and write them in batches,
+    with one executemany per table and one transaction per batch. Images
+    that cannot be written are logged and collected in errors, as
+    (filename, message) tuples."""
+    def __init__(self, db, batch_size=1000, thumbnails=None):
+        self.db = db
+        self.batch_size = batch_size
+        self.thumbnails = thumbnails
+        self.pending = []
+        self.errors = []
+        self.written = 0
+        c = db.cursor()
+        try:
+            c.execute("SELECT max(image_id) FROM Images")
+            self.next_id = (c.fetchone()[0] or 0) + 1
+        finally:
+            c.close()
+
+    def add(self, filename, w, h, rgb, lab, mtime=None, size=None,
+            checksum=None, thumbnails=None):
+        self.pending.append(((self.next_id, 0, w, h, filename,
+                              mtime, size, checksum), rgb, lab, thumbnails))
+        self.next_id += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        "Write and commit all pending images."
+        if not self.pending:
+            return
+        c = self.db.cursor()
+        try:
+            c.executemany(INSERT_IMAGE, [image for image, rgb, lab, thumbs
+                                         in self.pending])
+            insert_colors(c, [(image[0], rgb, lab) for image, rgb, lab, thumbs
+                              in self.pending])
+            if self.thumbnails is not None:
+                insert_thumbnails(c, self.thumbnails,
+                                  [(image[0], thumbs) for image, rgb, lab, thumbs
+                                   in self.pending if thumbs])
+            self.db.commit()
+            self.written += len(self.pending)
+        except sqlite3.Error:
+            # Something in the batch is bad. Find it by going one at a time.
+            self.db.rollback()
+            self._write_one_by_one(c)
+        finally:
+            c.close()
+        self.pending = []
+
+    def _write_one_by_one(self, c):
+        for image, rgb, lab, thumbs in self.pending:
+            filename = image[4]
+            try:
+                c.execute(INSERT_IMAGE, image)
+            except sqlite3.IntegrityError:
+                self._error(filename, "already in the table")
+                continue
+            except sqlite3.Error as e:
+                self._error(filename, str(e))
+                continue
+            insert_colors(c, [(image[0], rgb, lab)])
+            if self.thumbnails is not None and thumbs:
+                insert_thumbnails(c, self.thumbnails, [(image[0], thumbs)])
+            self.written += 1
+        self.db.commit()
+
+    def _error(self, filename, message):
+        logger.warning("Could not store image %s (%s). Skipping it.",
+                       filename, message)
+        self.errors.append((filename, message))
+
+# Write-ahead logging that only syncs at checkpoints, and a larger page
+# cache, for bulk loads.
+BULK_LOAD_PRAGMAS = [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+                     ('cache_size', -65536), # in KiB
+                     ('temp_store', 'MEMORY')]
+
+def tune_for_bulk_load(db):
+    """Apply BULK_LOAD_PRAGMAS. Return the settings they replace, for
+    restore_pragmas."""
     db.commit()
+    c = db.cursor()
+    try:
+        previous = []
+        for pragma, value in BULK_LOAD_PRAGMAS:
+            c.execute("PRAGMA {0}".format(pragma))
+            previous.append((pragma, c.fetchone()[0]))
+            c.execute("PRAGMA {0}={1}".format(pragma, value))
+        return previous
+    finally:
+        c.close()
+
+def restore_pragmas(db, settings):
+    """Put back the settings returned by tune_for_bulk_load. Leaving
+    write-ahead logging needs the only connection to the database; if
+    another is open, the journal mode stays, with a warning."""
+    db.commit()
+    c = db.cursor()
+    try:
+        for pragma, value in reversed(settings):
+            c.execute("PRAGMA {0}={1}".format(pragma, value))
+        c.execute("PRAGMA journal_mode")
+        journal_mode = c.fetchone()[0]
+    except sqlite3.OperationalError as e:
+        journal_mode = str(e)
+    finally:
+        c.close()
+    if journal_mode != dict(settings)['journal_mode']:
+        logger.warning("Could not restore the %s journal mode (%s).",
+                       dict(settings)['journal_mode'], journal_mode)
+
+# An image within E <= r of the target has each of its mean L, a and b
+# within r of the target's (the mean of the quadrants' differences is no
+# longer than their root mean square), and each quadrant's L within 2r (as
+# E_sq is the mean of four squares). So these ranges, which an index can
+# answer, lose no candidate.
+MATCH = """SELECT
+           image_id,
+           ({E_sq})/4. AS E_sq,
+           ({dL})/4. AS dL,
+           filename
+           FROM {tables}
+           WHERE {means}
+           AND {quadrants}
+           AND E_sq <= :r*:r"""
+_match_tokens = dict(
+    E_sq=' + '.join('({0}-:{0})*({0}-:{0})'.format(col) for col in LAB_COLUMNS),
+    dL=' + '.join('{0}-:{0}'.format(col) for col in ['L1', 'L2', 'L3', 'L4']),
+    quadrants=' AND '.join('{0} BETWEEN :{0} - 2*:r AND :{0} + 2*:r'.format(col)
+                           for col in ['L1', 'L2', 'L3', 'L4']))
+RTREE_MATCH = MATCH.format(
+    tables="LabBounds JOIN LabColors USING (image_id) JOIN Images USING (image_id)",
+    means=' AND '.join('{0}_max >= :{0} - :r AND {0}_min <= :{0} + :r'.format(col)
+                       for col in ['Lm', 'am', 'bm']),
+    **_match_tokens)
+BTREE_MATCH = MATCH.format(
+    tables="LabColors JOIN Images USING (image_id)",
+    means=' AND '.join('{0} BETWEEN :{0} - :r AND :{0} + :r'.format(col)
+                       for col in ['Lm', 'am', 'bm']),
+    **_match_tokens)
+
+MATCHERS = {'array': ArrayMatcher,
+            'kdtree': KDTreeMatcher,
+            'ivfpq': IVFPQMatcher,
+            'sharded': ShardedMatcher}
 
 
 class SqlImagePool(ImagePool):
-    def __init__(self, db_name):
+    def __init__(self, db_name, thumbnail_sizes=None, estimator=None):
+        """Open (or create) the pool stored in db_name. To keep thumbnails
+        of the pool images for fast assembly, give thumbnail_sizes, the
+        lengths of their shorter sides. The sizes are remembered by the pool,
+        and the thumbnails are kept in the directory db_name + '.thumbs'.
+        estimator names the method in color_estimators used to analyze
+        images, in the pool and in targets matched against it. It is also
+        remembered, and defaults to 'kmeans'; once the pool has images, a
+        different estimator is a ValueError."""
         self.db_name = db_name
         self.db = connect(db_name)
+        self.writer = None
+        self.usages = collections.Counter()
+        self.set_matcher('sql')
         create_tables(self.db)
+        self.rtree = has_table(self.db, 'LabBounds')
+        # Settings are only written when they change, so that opening a
+        # pool does not write to it.
+        stored = self.get_setting('estimator')
+        if self._has_images():
+            # Pools made before the estimator was saved used k-means.
+            stored = stored or 'kmeans'
+            if estimator is not None and estimator != stored:
+                raise ValueError("Images already in %s were analyzed with %s, "
+                                 "not %s." % (db_name, stored, estimator))
+            estimator = stored
+        elif estimator is None:
+            estimator = stored or 'kmeans'
+        get_estimator(estimator) # Fail early if it does not exist.
+        if estimator != self.get_setting('estimator'):
+            self.set_setting('estimator', estimator)
+        self.estimator = estimator
+        if thumbnail_sizes is None:
+            thumbnail_sizes = self.get_setting('thumbnail_sizes', [])
+        elif sorted(thumbnail_sizes) != self.get_setting('thumbnail_sizes'):
+            self.set_setting('thumbnail_sizes', sorted(thumbnail_sizes))
+        self.thumbnail_sizes = tuple(thumbnail_sizes)
+        if self.thumbnail_sizes:
+            self.thumbnails = ThumbnailStore(db_name + '.thumbs')
+        else:
+            self.thumbnails = None
 
-    def insert(self, filename, w, h, rgb, lab):
+    def set_matcher(self, name, **options):
+        """Choose how choose_match finds matches. 'sql' (the default) ranks
+        the images in a query; the others are in MATCHERS, and are loaded
+        with their options the first time they are needed, and again after
+        the pool has changed. For example, 'array' keeps the Lab colors in
+        memory and ranks them all at once with NumPy, and 'kdtree' ranks
+        only the k nearest images, found with a k-d tree saved next to the
+        pool database. 'ivfpq' is an approximate index for very large pools,
+        also saved next to the database, that finds candidates in the
+        nprobe cells nearest each target, e.g.
+        set_matcher('ivfpq', nprobe=16, k=50). 'sharded' splits the pool
+        among worker processes, one per core unless processes is given."""
+        if name != 'sql' and name not in MATCHERS:
+            raise ValueError("Unknown matcher %r. Choose from: sql, %s"
+                             % (name, ', '.join(sorted(MATCHERS))))
+        self.matcher_name = name
+        self.matcher_options = options
+        self._drop_matcher()
+
+    @property
+    def matcher(self):
+        "The loaded matcher, or None for 'sql'."
+        if self.matcher_name == 'sql':
+            return None
+        if self._matcher is None:
+            self._matcher = MATCHERS[self.matcher_name].from_pool(
+                self, **self.matcher_options)
+        return self._matcher
+
+    def _drop_matcher(self):
+        "Unload the matcher, to be loaded again when next needed."
+        matcher = getattr(self, '_matcher', None)
+        if hasattr(matcher, 'close'):
+            matcher.close()
+        self._matcher = None
+
+    def _has_images(self):
+        c = self.db.cursor()
+        try:
+            c.execute("SELECT 1 FROM Images LIMIT 1")
+            return c.fetchone() is not None
+        finally:
+            c.close()
+
+    def get_setting(self, name, default=None):
+        "Look up a setting saved in the pool by set_setting."
+        c = self.db.cursor()
+        try:
+            c.execute("SELECT value FROM Settings WHERE name=?", (name,))
+            row = c.fetchone()
+        finally:
+            c.close()
+        return default if row is None else json.loads(row[0])
+
+    def set_setting(self, name, value):
+        "Save a setting (anything JSON can encode) in the pool."
+        c = self.db.cursor()
+        try:
+            c.execute("INSERT OR REPLACE INTO Settings (name, value) VALUES (?, ?)",
+                      (name, json.dumps(value)))
+        finally:
+            c.close()
+        self.db.commit()
+
+    def insert(self, filename, w, h, rgb, lab, mtime=None, size=None,
+               checksum=None, thumbnails=None):
         """Insert image info in the Images table and color information in the
-        Color and LabColor tables."""
+        Color and LabColor tables. The file's modification time, size and
+        checksum, if given, let sync_directory detect changes later.
+        thumbnails, as made by make_thumbnails, go in the thumbnail store.
+        Inside bulk_load, the image is buffered and written in a batch."""
+        filename = fs_path(filename)
+        self._drop_matcher()
+        if self.writer is not None:
+            self.writer.add(filename, w, h, rgb, lab, mtime, size, checksum,
+                            thumbnails)
+            return
         c = self.db.cursor()
         try:
-            c.execute("""INSERT INTO Images (usages, w, h, filename)
-                         VALUES (?, ?, ?, ?)""",
-                      (0, w, h, filename))
+            c.execute(INSERT_IMAGE,
+                      (None, 0, w, h, filename, mtime, size, checksum))
             image_id = c.lastrowid
-            c.executemany("""INSERT INTO Colors (image_id, region, red, green, blue)
-                             VALUES (?, ?, ?, ?, ?)""",
-                             [tuple([image_id, region] + list(colors)) \
-                              for region, colors in enumerate(rgb)])
-            c.execute("""INSERT INTO LabColors (image_id,
-                         L1, a1, b1, L2, a2, b2, L3, a3, b3, L4, a4, b4)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                         tuple([image_id] + [ch for reg in lab for ch in reg]))
+            insert_colors(c, [(image_id, rgb, lab)])
+            if self.thumbnails is not None and thumbnails:
+                insert_thumbnails(c, self.thumbnails, [(image_id, thumbnails)])
         except sqlite3.IntegrityError:
             logger.warning("Image %s is already in the table. Skipping it.",
                            filename)
-        except:
-            logger.warning("Unknown problem with image %s. Skipping it.",
-                           filename)
+        except sqlite3.Error as e:
+            logger.warning("Could not store image %s (%s). Skipping it.",
+                           filename, str(e))
         finally:
             c.close()
+
+    @contextlib.contextmanager
+    def bulk_load(self, batch_size=1000):
+        """Within this context, images are inserted in batches of batch_size
+        with a commit after each batch, the database uses write-ahead
+        logging, and the color tables' indexes are only rebuilt at the end,
+        when the previous journal mode and other settings are restored.
+        Yield the BulkWriter, whose errors lists the images that could not
+        be stored. Usage:
+        with pool.bulk_load():
+            pool.add_directory('folder-of-many-images/')
+        """
+        settings = tune_for_bulk_load(self.db)
+        drop_indexes(self.db)
+        self.writer = BulkWriter(self.db, batch_size, self.thumbnails)
+        try:
+            yield self.writer
+        finally:
+            writer, self.writer = self.writer, None
+            writer.flush()
+            create_indexes(self.db)
+            restore_pragmas(self.db, settings)
+            logger.info("Bulk load wrote %d images; %d could not be stored.",
+                        writer.written, len(writer.errors))
             
+    def delete(self, image_ids):
+        "Remove images, and their color information, from the pool."
+        if not image_ids:
+            return
+        self._drop_matcher()
+        params = [(image_id,) for image_id in image_ids]
+        c = self.db.cursor()
+        try:
+            colors = []
+            for image_id in image_ids:
+                c.execute("""SELECT red, green, blue FROM Colors
+                             WHERE image_id=?""", (image_id,))
+                colors.extend(c.fetchall())
+            update_histogram(c, colors, -1)
+            tables = ['Colors', 'LabColors', 'Thumbnails', 'Images']
+            if self.rtree:
+                tables.append('LabBounds')
+            for table in tables:
+                c.executemany("DELETE FROM {0} WHERE image_id=?".format(table),
+                              params)
+        finally:
+            c.close()
+        logger.info("Removed %d images from the pool.", len(image_ids))
+
+    def open_image(self, image_id, filename, size=None):
+        """Open a pool image to be cropped and scaled to size. Use the
+        smallest stored thumbnail that can fill size without being scaled
+        up, and fall back to the original file if there is none."""
+        return self.read_source(
+            self.image_sources([(image_id, filename, size)])[0])
+
+    def image_sources(self, requests):
+        """For each (image_id, filename, size) in requests, say where
+        open_image would read the image from: ('thumbnail', shard, offset,
+        length) or ('file', filename). The thumbnails of all the images are
+        looked up at once."""
+        thumbs = collections.defaultdict(list)
+        if self.thumbnails is not None:
+            image_ids = sorted(set(image_id for image_id, _, _ in requests))
+            c = self.db.cursor()
+            try:
+                for start in range(0, len(image_ids), 500):
+                    chunk = image_ids[start:start + 500]
+                    c.execute("""SELECT image_id, w, h, shard, offset, length
+                                 FROM Thumbnails
+                                 WHERE image_id IN ({0})
+                                 ORDER BY image_id, size""".format(
+                                     ', '.join('?'*len(chunk))), chunk)
+                    for image_id, w, h, shard, offset, length in c:
+                        thumbs[image_id].append(
+                            ((w, h), ('thumbnail', shard, offset, length)))
+            finally:
+                c.close()
+        sources = []
+        for image_id, filename, size in requests:
+            source = ('file', filename)
+            if size is not None:
+                for thumb_size, thumb in thumbs.get(image_id, []):
+                    if covers(thumb_size, size):
+                        source = thumb
+                        break
+            sources.append(source)
+        return sources
+
+    def read_source(self, source):
+        """Open an image from where image_sources says it is. This does not
+        use the database, so it is safe to call from other threads. Files are
+        opened lazily, so they can still be drafted at a smaller size."""
+        if source[0] == 'thumbnail':
+            return self.thumbnails.read(*source[1:])
+        return Image.open(source[1])
+
+    def build_thumbnails(self):
+        """Make thumbnails for images that were added to the pool before it
+        kept thumbnails (or before its thumbnail sizes were changed). Only
+        missing sizes are made, and only those an image is big enough for,
+        so images that already have every thumbnail they can are not opened
+        again."""
+        if self.thumbnails is None:
+            return
+        sizes = sorted(self.thumbnail_sizes)
+        wanted = " UNION ALL ".join(["SELECT ? AS size"]*len(sizes))
+        c = self.db.cursor()
+        try:
+            c.execute("""SELECT Images.image_id, filename, wanted.size
+                         FROM Images JOIN (%s) AS wanted
+                         ON min(w, h) >= wanted.size
+                         WHERE NOT EXISTS
+                         (SELECT 1 FROM Thumbnails
+                          WHERE Thumbnails.image_id=Images.image_id
+                          AND Thumbnails.size=wanted.size)
+                         ORDER BY Images.image_id""" % wanted, sizes)
+            missing = collections.OrderedDict()
+            for image_id, filename, size in c.fetchall():
+                missing.setdefault((image_id, filename), []).append(size)
+            for (image_id, filename), missing_sizes in missing.iteritems():
+                try:
+                    thumbs = make_thumbnails(Image.open(filename),
+                                             missing_sizes)
+                except IOError:
+                    logger.warning("Cannot open %s. No thumbnails made.",
+                                   filename)
+                    continue
+                insert_thumbnails(c, self.thumbnails, [(image_id, thumbs)])
+            self.db.commit()
+        finally:
+            c.close()
+        logger.info("Made thumbnails for %d images.", len(missing))
+
+    def file_records(self, directory=None):
+        """Return a dictionary mapping each filename under directory (or,
+        by default, every filename) to a tuple (image_id, mtime, size,
+        checksum)."""
+        query = """SELECT filename, image_id, mtime, size, checksum
+                   FROM Images"""
+        params = ()
+        if directory is not None:
+            query += " WHERE filename >= ? AND filename < ?"
+            params = directory_bounds(directory)
+        if self.writer is not None:
+            self.writer.flush()
+        c = self.db.cursor()
+        try:
+            c.execute(query, params)
+            return dict((row[0], (row[1], row[2], row[3], row[4])) for row in c)
+        finally:
+            c.close()
+
+    def skipped_records(self, directory=None):
+        """Return a dictionary mapping each file under directory (or, by
+        default, every file) that could not be added to the pool to its
+        (mtime, size) when it was tried."""
+        query = "SELECT filename, mtime, size FROM SkippedFiles"
+        params = ()
+        if directory is not None:
+            query += " WHERE filename >= ? AND filename < ?"
+            params = directory_bounds(directory)
+        c = self.db.cursor()
+        try:
+            c.execute(query, params)
+            return dict((row[0], (row[1], row[2])) for row in c)
+        finally:
+            c.close()
+
+    def mark_skipped(self, filename, mtime=None, size=None):
+        """Remember that a file could not be added to the pool, so that
+        sync_directory does not try it again until it changes."""
+        c = self.db.cursor()
+        try:
+            c.execute("""INSERT OR REPLACE INTO SkippedFiles
+                         (filename, mtime, size) VALUES (?, ?, ?)""",
+                      (fs_path(filename), mtime, size))
+        finally:
+            c.close()
+
+    def forget_skipped(self, filenames):
+        "Forget that files could not be added, to try them again."
+        c = self.db.cursor()
+        try:
+            c.executemany("DELETE FROM SkippedFiles WHERE filename=?",
+                          [(filename,) for filename in filenames])
+        finally:
+            c.close()
+
+    def update_file_info(self, records):
+        """Record new file info for images whose contents are unchanged.
+        records is a list of (mtime, size, checksum, image_id) tuples."""
+        c = self.db.cursor()
+        try:
+            c.executemany("""UPDATE Images SET mtime=?, size=?, checksum=?
+                             WHERE image_id=?""", records)
+        finally:
+            c.close()
+
     def pool_histogram(self):
         """Generate a histogram of the images in the pool.
         Return a dictionary of the channels red, green blue.
         Each dict entry contains a list of the frequencies correspond to the
         domain 0 - 255.""" 
-        hist = {}
+        hist = dict((ch, [0]*256) for ch in CHANNELS)
         c = self.db.cursor()
         try: 
-            for ch in ['red', 'green', 'blue']:
-                c.execute("""SELECT {ch}, count(*)
-                             FROM Colors 
-                             GROUP BY {ch}""".format(ch=ch))
-                values, counts = zip(*c.fetchall())
-                # Normalize the histogram to 256 for readability,
-                # and fill in 0 for missing entries.
-                full_domain = range(0,256)
-                N = sum(counts)
-                all_counts = [256./N*counts[values.index(i)] if i in values else 0 \
-                              for i in full_domain]
-                hist[ch] = all_counts
+            c.execute("SELECT channel, value, count FROM ColorHistogram")
+            for ch, value, count in c:
+                hist[ch][value] = count
         finally:
             c.close()
+        # Normalize the histogram to 256 for readability.
+        for ch in CHANNELS:
+            N = sum(hist[ch])
+            hist[ch] = [256./N*count for count in hist[ch]]
         return hist
             
     def reset_usage(self):
+        """Start counting usage afresh, for a new render. The counts are
+        kept in memory, by this pool object (or its matcher), so renders
+        sharing a database neither wait on each other's writes nor see
+        each other's counts."""
+        if self.matcher is not None:
+            self.matcher.reset_usage()
+        self.usages = collections.Counter()
+
+    def usage_counts(self):
+        "Return a dict of the usage of each image used, by image_id."
+        if self.matcher is not None:
+            return self.matcher.usage_counts()
+        return dict(self.usages)
+
+    def flush_usage(self):
+        """Add the usage counted since reset_usage to the usages recorded in
+        the Images table, in one transaction. Afterward, Images.usages
+        is the number of times each image has been used, over all the
+        renders that were flushed."""
+        counts = self.usage_counts()
+        c = self.db.cursor()
         try:
-            c = self.db.cursor()
-            c.execute("UPDATE Images SET usages=0")
+            c.executemany("UPDATE Images SET usages=usages+? WHERE image_id=?",
+                          [(n, image_id) for image_id, n in counts.iteritems()])
         finally:
             c.close()
-        return
+        self.db.commit()
+        logger.info("Recorded the usage of %d images.", len(counts))
         
     def choose_match(self, lab, tolerance=1, usage_penalty=1):
         """If there is are good matches (within tolerance times the 'just noticeable
         difference'), return one at random. If not, choose the closest match
-        deterministically. Return the match (as a sqlite Row dictionary) and the
-        number of good matches."""
-        JND = 2.3 # "just noticeable difference"
-        (L1, a1, b1), (L2, a2, b2), (L3, a3, b3), (L4, a4, b4) = lab
-        tokens = {'L1': L1, 'a1': a1, 'b1': b1,
-                  'L2': L2, 'a2': a2, 'b2': b2,
-                  'L3': L3, 'a3': a3, 'b3': b3,
-                  'L4': L4, 'a4': a4, 'b4': b4,
-                  'tol': tolerance*JND, 'usage_penalty': usage_penalty*JND}
-        
+        deterministically. Return the match as a Match."""
+        if self.matcher is not None:
+            return self.matcher.choose_match(lab, tolerance, usage_penalty)
+        tokens = dict(zip(LAB_COLUMNS, [ch for color in lab for ch in color]))
+        tokens.update(zip(['Lm', 'am', 'bm'], color_means(lab)))
+        query = RTREE_MATCH if self.rtree else BTREE_MATCH
         c = self.db.cursor()
         try:
-            # Before we compute the exact color distance E, 
-            # which is expensive and requires
-            # adding 12 numbers in quadrature, the WHERE clause computes
-            # a simpler upper bound on E and filters out disqualifying rows.
-            # The survivors are ranked by their exact E plus a random component
-            # determined by the tolerance. Thus, decisive winners are chosen
-            # deterministically, but if there are many good matches, one is taken
-            # at random.
-            c.execute("""SELECT
-                         image_id,
-                         ((L1-({L1}))*(L1-({L1}))
-                           + (a1-({a1}))*(a1-({a1})) 
-                           + (b1-({b1}))*(b1-({b1}))
-                           + (L2-({L2}))*(L2-({L2}))
-                           + (a2-({a2}))*(a2-({a2})) 
-                           + (b2-({b2}))*(b2-({b2}))
-                           + (L3-({L3}))*(L3-({L3}))
-                           + (a3-({a3}))*(a3-({a3})) 
-                           + (b3-({b3}))*(b3-({b3}))
-                           + (L4-({L4}))*(L4-({L4}))
-                           + (a4-({a4}))*(a4-({a4}))
-                           + (b4-({b4}))*(b4-({b4})))/4. as E_sq,
-                         (L1-({L1}) + L2-({L2}) + L3-({L3}) + L4-({L4}))/4. as dL,
-                         usages,
-                         filename
-                         FROM LabColors
-                         JOIN Images using (image_id)
-                         WHERE
-                         L1-({L1}) + a1-({a1}) + b1-({b1})
-                           + L2-({L2}) + a2-({a2}) + b2-({b2})
-                           + L3-({L3}) + a3-({a3}) + b3-({b3})
-                           + L4-({L4}) + a4-({a4}) + b4-({b4})
-                         < 4*{tol}
-                         ORDER BY
-                         E_sq 
-                         + {tol}*{tol}*RANDOM()/9223372036854775808.
-                         + {usage_penalty}*{usage_penalty}*usages ASC
-                         LIMIT 1""".format(**tokens))
-                         # 9223372036854775808 is the range of sqlite RANDOM()
-            match = c.fetchone()
-            if not match:
-                return self.choose_match(lab, tolerance + 1)
-            c.execute("UPDATE Images SET usages=1+usages WHERE image_id=?",
-                      (match['image_id'],))
+            # The candidates are the images within a radius r of the target,
+            # starting from the tolerance. If there are none, widen it.
+            r = max(tolerance, 1)*JND
+            while True:
+                tokens['r'] = r
+                c.execute(query, tokens)
+                candidates = c.fetchall()
+                if candidates or r > MAX_E:
+                    break
+                r *= 2
         finally:
             c.close()
+        if not candidates:
+            return None
+        # Rank the candidates by their exact E plus a random component
+        # determined by the tolerance, plus the usage penalty. Thus,
+        # decisive winners are chosen deterministically, but if there are
+        # many good matches, one is taken at random.
+        tol = tolerance*JND
+        penalty = usage_penalty*JND
+        best = min(candidates, key=lambda row:
+                   row['E_sq'] + tol*tol*random.uniform(-1, 1)
+                   + penalty*penalty*self.usages[row['image_id']])
+        match = Match(best['image_id'], best['E_sq'], best['dL'],
+                      self.usages[best['image_id']], best['filename'])
+        self.usages[match.image_id] += 1
         logger.debug("%s", match)
         return match
             
+    def choose_matches(self, labs, tolerance=1, usage_penalty=1):
+        """Choose matches for a list of targets, with the same results as
+        calling choose_match on each in turn. Matchers other than 'sql'
+        compare many targets with the pool at once."""
+        if self.matcher is not None:
+            return self.matcher.choose_matches(labs, tolerance, usage_penalty)
+        return [self.choose_match(lab, tolerance, usage_penalty)
+                for lab in labs]
+
+    def assign_matches(self, labs, max_usage=1, candidates=20):
+        """Choose matches for all the targets at once, minimizing the total
+        distance with no image used more than max_usage times, among each
+        target's nearest candidates. See assignment.assign_matches. With
+        the 'sql' matcher, the pool is loaded into memory for this."""
+        matcher = self.matcher
+        if matcher is not None:
+            return assign_matches(matcher, labs, max_usage, candidates)
+        matcher = ArrayMatcher.from_pool(self)
+        rows = np.searchsorted(matcher.image_ids, self.usages.keys())
+        matcher.usages[rows] = self.usages.values()
+        matches = assign_matches(matcher, labs, max_usage, candidates)
+        self.usages = collections.Counter(matcher.usage_counts())
+        return matches
+
     def __contains__(self, filename):
         c = self.db.cursor()
         try: 
-            c.execute("SELECT count(*) FROM Images WHERE filename=?", (filename,))
+            c.execute("SELECT count(*) FROM Images WHERE filename=?",
+                      (fs_path(filename),))
             return c.fetchone()[0] > 0
         finally:
             c.close()
         return False
         
     def __len__(self):
+        if self.writer is not None:
+            self.writer.flush()
         c = self.db.cursor()
         try: 
             c.execute("SELECT count(*) FROM Images")
@@ -203,5 +893,6 @@ class SqlImagePool(ImagePool):
         return 0   
 
     def close(self):
+        self._drop_matcher()
         self.db.commit()
         self.db.close()
@@ -0,0 +1,156 @@
+"""Write an RGB image to a file a horizontal strip at a time, so that an
+image larger than memory can be made a strip at a time and never held
+whole.
+
+TiffWriter writes an uncompressed TIFF, one TIFF strip per strip written,
+and its directory at the end, once the strips' offsets are known; images
+of 4 GB or more are written as BigTIFF. NpyWriter fills a memory-mapped
+.npy array of shape (height, width, 3), which numpy.load(path,
+mmap_mode='r') reads without loading it."""
+from __future__ import division
+import io
+import struct
+import logging
+import numpy as np
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+# TIFF field types, by their struct format.
+SHORT, LONG, LONG8 = 3, 4, 16
+TYPE_FORMATS = {SHORT: 'H', LONG: 'I', LONG8: 'Q'}
+
+class StripWriter(object):
+    """Writes an image of size (width, height) in strips of strip_height
+    rows, from the top; the last may be shorter. Use it in a with
+    statement, or call close when the last strip is written."""
+    def __init__(self, path, size, strip_height):
+        self.path = path
+        self.width, self.height = size
+        self.strip_height = strip_height
+        self.rows = 0 # rows written so far
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write(self, strip):
+        "Write the next strip, an RGB image of the full width."
+        rows = min(self.strip_height, self.height - self.rows)
+        if strip.size != (self.width, rows) or strip.mode != 'RGB':
+            raise ValueError("Expected an RGB strip of %dx%d, not %s %dx%d."
+                             % ((self.width, rows, strip.mode) + strip.size))
+        self._write(strip)
+        self.rows += rows
+
+    def close(self):
+        if self.rows < self.height:
+            logger.warning("%s is missing its last %d rows.", self.path,
+                           self.height - self.rows)
+
+class TiffWriter(StripWriter):
+    """Writes an uncompressed RGB TIFF. With bigtiff=None, BigTIFF is used
+    only if a classic TIFF, limited to 4 GB, would not do."""
+    def __init__(self, path, size, strip_height, bigtiff=None):
+        StripWriter.__init__(self, path, size, strip_height)
+        strips = -(-self.height//strip_height)
+        if bigtiff is None:
+            # The pixels, the strips' offsets and byte counts, and some
+            # room for the rest of the header and directory.
+            bigtiff = 3*self.width*self.height + 8*strips + 4096 >= 2**32
+        self.bigtiff = bigtiff
+        self.offsets, self.byte_counts = [], []
+        self.file = io.open(path, 'wb')
+        # The offset of the directory is filled in by close.
+        if bigtiff:
+            self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        else:
+            self.file.write(b'II' + struct.pack('<HI', 42, 0))
+
+    def _write(self, strip):
+        data = strip.tobytes()
+        self.offsets.append(self.file.tell())
+        self.byte_counts.append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        if self.file.closed:
+            return
+        StripWriter.close(self)
+        offset_type = LONG8 if self.bigtiff else LONG
+        # Entries are (tag, type, values), in order of tag.
+        entries = [(256, LONG, [self.width]), # ImageWidth
+                   (257, LONG, [self.height]), # ImageLength
+                   (258, SHORT, [8, 8, 8]), # BitsPerSample
+                   (259, SHORT, [1]), # Compression: none
+                   (262, SHORT, [2]), # PhotometricInterpretation: RGB
+                   (273, offset_type, self.offsets), # StripOffsets
+                   (277, SHORT, [3]), # SamplesPerPixel
+                   (278, LONG, [self.strip_height]), # RowsPerStrip
+                   (279, offset_type, self.byte_counts), # StripByteCounts
+                   (284, SHORT, [1])] # PlanarConfiguration: chunky
+        if self.bigtiff:
+            count_format, entry_format, inline = '<Q', '<HHQ', 8
+        else:
+            count_format, entry_format, inline = '<H', '<HHI', 4
+        pointer_format = count_format if self.bigtiff else '<I'
+        # The directory starts on a word boundary. Values too long to fit
+        # in their entries follow it.
+        if self.file.tell() % 2:
+            self.file.write(b'\0')
+        start = self.file.tell()
+        extra_start = (start + struct.calcsize(count_format)
+                       + len(entries)*(struct.calcsize(entry_format) + inline)
+                       + struct.calcsize(pointer_format))
+        directory = [struct.pack(count_format, len(entries))]
+        extra = []
+        for tag, type, values in entries:
+            data = struct.pack('<%d%s' % (len(values), TYPE_FORMATS[type]),
+                               *values)
+            if len(data) <= inline:
+                value = data.ljust(inline, b'\0')
+            else:
+                value = struct.pack(pointer_format,
+                                    extra_start + sum(map(len, extra)))
+                extra.append(data.ljust(len(data) + len(data) % 2, b'\0'))
+            directory.append(struct.pack(entry_format, tag, type, len(values))
+                             + value)
+        directory.append(struct.pack(pointer_format, 0)) # no next directory
+        self.file.write(b''.join(directory + extra))
+        # Point the header at the directory.
+        self.file.seek(8 if self.bigtiff else 4)
+        self.file.write(struct.pack(pointer_format, start))
+        self.file.close()
+
+class NpyWriter(StripWriter):
+    "Fills a memory-mapped .npy array of shape (height, width, 3)."
+    def __init__(self, path, size, strip_height):
+        StripWriter.__init__(self, path, size, strip_height)
+        self.array = np.lib.format.open_memmap(
+            path, mode='w+', dtype=np.uint8, shape=(self.height, self.width, 3))
+
+    def _write(self, strip):
+        self.array[self.rows:self.rows + strip.size[1]] = np.asarray(strip)
+        # Write the strip out, so that its pages can be let go.
+        self.array.flush()
+
+    def close(self):
+        if self.array is None:
+            return
+        StripWriter.close(self)
+        self.array.flush()
+        self.array = None
+
+def open_writer(path, size, strip_height):
+    "A TiffWriter or NpyWriter, by the extension of path."
+    extension = path.lower().rsplit('.', 1)[-1]
+    if extension in ('tif', 'tiff'):
+        return TiffWriter(path, size, strip_height)
+    if extension == 'npy':
+        return NpyWriter(path, size, strip_height)
+    raise ValueError("A mosaic written in strips is saved as .tif or .npy, "
+                     "not %s." % path)
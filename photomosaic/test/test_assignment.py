@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from array_matcher import ArrayMatcher
+from assignment import auction, assign_matches
+
+def optimum(costs, capacity):
+    """The least total cost of giving each row one object, with no object
+    given more than its capacity; costs is dense, with np.inf where a row
+    cannot have an object."""
+    copies = np.repeat(np.arange(len(capacity)), capacity)
+    dense = costs[:, copies]
+    dense[~np.isfinite(dense)] = 1e9
+    rows, columns = linear_sum_assignment(dense)
+    return dense[rows, columns].sum()
+
+class TestAuction(unittest.TestCase):
+    def test_optimal_within_epsilon(self):
+        random = np.random.RandomState(0)
+        for trial in range(5):
+            T, N, K = 60, 25, 6
+            capacity = random.randint(1, 4, N)
+            candidates = np.array([random.choice(N, K, replace=False)
+                                   for _ in range(T)])
+            costs = random.uniform(0, 100, (T, K))
+            # A private place for each row, so that a solution exists.
+            candidates = np.column_stack([candidates, N + np.arange(T)])
+            costs = np.column_stack([costs, np.full(T, 500.)])
+            capacity = np.concatenate([capacity, np.ones(T, dtype=int)])
+            candidates[random.uniform(size=(T, K + 1)) < 0.1] = -1
+            candidates[:, -1] = N + np.arange(T)
+            assigned = auction(candidates, costs, capacity, epsilon=0.01)
+
+            dense = np.full((T, N + T), np.inf)
+            for t in range(T):
+                valid = candidates[t] >= 0
+                dense[t, candidates[t, valid]] = costs[t, valid]
+            self.assertTrue(np.isfinite(dense[np.arange(T), assigned]).all())
+            self.assertTrue((np.bincount(assigned, minlength=N + T)
+                             <= capacity).all())
+            total = dense[np.arange(T), assigned].sum()
+            best = optimum(dense, capacity)
+            self.assertTrue(best - 1e-6 <= total <= best + T*0.01 + 1e-6,
+                            (total, best))
+
+class TestAssignMatches(unittest.TestCase):
+    def test_least_total_cost_within_usage_limit(self):
+        random = np.random.RandomState(1)
+        N, T, max_usage = 15, 40, 3
+        features = random.uniform(0, 100, (N, 12)).astype(np.float32)
+        matcher = ArrayMatcher(np.arange(10, 10 + N), features,
+                               np.zeros(N, dtype=np.int64),
+                               ['%d.jpg' % i for i in range(N)])
+        targets = random.uniform(0, 100, (T, 4, 3))
+        matches = assign_matches(matcher, targets, max_usage, k=N)
+        rows = np.array([match.image_id for match in matches]) - 10
+        self.assertTrue((np.bincount(rows, minlength=N) <= max_usage).all())
+        self.assertTrue((matcher.usages == np.bincount(rows, minlength=N)).all())
+        E_sq = ((targets.reshape(T, 1, 12) - features.astype(float))**2).sum(2)
+        total = E_sq[np.arange(T), rows].sum()
+        best = optimum(E_sq, np.full(N, max_usage))
+        self.assertTrue(total <= best*(1 + 1e-5) + T*0.01, (total, best))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from array_matcher import JND
+from partition import Partition
+from image_analysis import analyze_this, analyze_tiles, analyze_tiles_parallel
+from test_tile_stats import target
+
+class TestAnalyzeTiles(unittest.TestCase):
+    def setUp(self):
+        # Tiles of several sizes, some with quadrants big enough to shrink.
+        self.img = target((640, 480))
+        self.p = Partition(self.img)
+        self.p.simple_partition((3, 2))
+        self.p.recursive_split(3, 40)
+        self.tiles = self.p.get_tiles()
+        self.expected = [analyze_this(self.p.get_tile_img(tile), 'mean')
+                         for tile in self.tiles]
+
+    def test_vectorized_is_close_to_one_at_a_time(self):
+        rgb, lab = analyze_tiles(self.img, self.tiles, 'mean')
+        self.assertEqual(lab.shape, (len(self.tiles), 4, 3))
+        expected = np.array([tile_lab for _, tile_lab in self.expected])
+        E = np.sqrt(((lab - expected)**2).sum(2))
+        self.assertTrue(E.max() < JND, E.max())
+
+    def test_parallel_is_one_at_a_time_in_order(self):
+        results = list(analyze_tiles_parallel(self.img, self.tiles, 'mean',
+                                               processes=2, chunksize=5))
+        self.assertEqual(results, self.expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ivf_index import IVFPQIndex, IVFPQMatcher
+from array_matcher import load_features
+from test_sql_image_pool import PoolTestCase, make_image
+
+def pool_features(n=2000, seed=0):
+    "Lab vectors in clumps, as the colors of real pools are."
+    random = np.random.RandomState(seed)
+    centers = random.uniform([0, -80, -80]*4, [100, 80, 80]*4, (30, 12))
+    features = centers[random.randint(0, 30, n)] + random.normal(0, 6, (n, 12))
+    return np.arange(100, 100 + n), features.astype(np.float32)
+
+class TestIVFPQIndex(unittest.TestCase):
+    def setUp(self):
+        self.image_ids, self.features = pool_features()
+        self.index = IVFPQIndex(self.image_ids, self.features)
+
+    def test_every_probe_finds_every_image(self):
+        cells = len(self.index.centers)
+        found = self.index.search(self.features[0], nprobe=cells,
+                                  k=len(self.features))
+        self.assertEqual(sorted(found), list(self.image_ids))
+
+    def test_finds_nearest_images(self):
+        targets = pool_features(200, seed=1)[1]
+        recalled = 0
+        for target in targets:
+            E_sq = ((self.features - target)**2).sum(1)
+            nearest = self.image_ids[E_sq.argmin()]
+            recalled += nearest in self.index.search(target, nprobe=8, k=50)
+        self.assertTrue(recalled >= 0.9*len(targets), recalled)
+
+    def test_update(self):
+        self.assertFalse(self.index.update(self.image_ids, self.features))
+        features = self.features.copy()
+        features[5] += 20
+        keep = np.arange(len(features)) != 7
+        self.assertTrue(self.index.update(self.image_ids[keep],
+                                          features[keep]))
+        self.assertEqual(len(self.index), len(features) - 1)
+        self.assertFalse(self.image_ids[7] in self.index.image_ids)
+        self.assertFalse(self.index.update(self.image_ids[keep],
+                                           features[keep]))
+
+    def test_retrains_after_many_changes(self):
+        features = self.features + 1
+        self.index.update(self.image_ids, features)
+        self.assertEqual(self.index.changed, 0)
+        self.assertFalse(self.index.update(self.image_ids, features))
+
+    def test_save_and_open(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'pool.db.ivfpq')
+            self.index.save(path)
+            loaded = IVFPQIndex.open(path, self.image_ids, self.features)
+            for target in self.features[:20]:
+                np.testing.assert_array_equal(loaded.search(target),
+                                              self.index.search(target))
+        finally:
+            shutil.rmtree(directory)
+
+class TestIVFPQMatcher(unittest.TestCase):
+    def test_top_k_is_padded(self):
+        image_ids, features = pool_features(300)
+        index = IVFPQIndex(image_ids, features, cells=60)
+        matcher = IVFPQMatcher(image_ids, features,
+                               np.zeros(len(features), dtype=np.int64),
+                               [str(i) for i in image_ids], index, nprobe=1,
+                               k=5)
+        rows, E_sq = matcher.top_k(features[:10], k=40)
+        self.assertEqual(rows.shape, (10, 40))
+        for row in rows:
+            self.assertEqual(len(set(row)), 40)
+        self.assertTrue((np.diff(E_sq, axis=1) >= 0).all())
+
+class TestIVFPQMatcherFromPool(PoolTestCase):
+    def test_features_are_memory_mapped(self):
+        for i in range(8):
+            make_image(self.path('photos', '%d.jpg' % i),
+                       (30*i, 255 - 30*i, 15*i))
+        self.pool.add_directory(self.path('photos'))
+        self.pool.set_matcher('ivfpq')
+        matcher = self.pool.matcher
+        self.assertEqual(len([name for name in os.listdir(self.dir)
+                              if name.endswith('.npy')]), 1)
+        self.assertTrue(isinstance(matcher.features, np.memmap))
+        image_ids, features, usages, filenames = load_features(self.pool.db)
+        np.testing.assert_array_equal(matcher.image_ids, image_ids)
+        np.testing.assert_array_equal(matcher.features, features)
+        self.assertEqual([matcher.filenames[i] for i in range(8)], filenames)
+        for row in range(8):
+            match = self.pool.choose_match(features[row].reshape(4, 3), 0, 0)
+            self.assertEqual(match.filename, filenames[row])
+        # Unloading the matcher deletes its copy of the features.
+        self.pool.set_matcher('sql')
+        self.assertFalse([name for name in os.listdir(self.dir)
+                          if name.endswith('.npy')])
+
+if __name__ == '__main__':
+    unittest.main()
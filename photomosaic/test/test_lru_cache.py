@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lru_cache import LRUCache, nbytes
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used_by_bytes(self):
+        cache = LRUCache(max_bytes=300, sizeof=len)
+        cache['a'] = 'x'*100
+        cache['b'] = 'x'*100
+        cache['c'] = 'x'*100
+        cache.get('a') # Now b is the least recently used.
+        cache['d'] = 'x'*150
+        self.assertEqual(sorted(cache._entries), ['a', 'd'])
+        self.assertEqual(cache.nbytes, 250)
+        self.assertEqual(cache.evictions, 2)
+        self.assertRaises(KeyError, cache.__getitem__, 'b')
+
+    def test_replacing_an_entry_frees_its_bytes(self):
+        cache = LRUCache(max_bytes=300, sizeof=len)
+        cache['a'] = 'x'*200
+        cache['a'] = 'x'*50
+        cache['b'] = 'x'*250
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 300)
+        self.assertEqual(cache.evictions, 0)
+
+    def test_too_large_entries_are_not_kept(self):
+        cache = LRUCache(max_bytes=100, sizeof=len)
+        cache['a'] = 'x'*50
+        cache['b'] = 'x'*101
+        self.assertEqual(list(cache._entries), ['a'])
+        self.assertEqual(cache.nbytes, 50)
+
+    def test_max_items(self):
+        cache = LRUCache(max_items=2)
+        for key in 'abc':
+            cache[key] = key
+        self.assertEqual(list(cache._entries), ['b', 'c'])
+
+    def test_stats(self):
+        cache = LRUCache()
+        cache['a'] = 1
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_nbytes(self):
+        self.assertEqual(nbytes(Image.new('RGB', (10, 20))), 600)
+        self.assertEqual(nbytes(Image.new('F', (10, 20))), 800)
+        self.assertEqual(nbytes(np.zeros((4, 5), np.float32)), 80)
+        self.assertEqual(nbytes((Image.new('L', (3, 3)), np.zeros(4, np.uint8))),
+                         13)
+
+if __name__ == '__main__':
+    unittest.main()
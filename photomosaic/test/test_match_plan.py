@@ -0,0 +1,42 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from partition import TileSet
+from match_plan import save_plan, load_plan, VERSION
+
+class TestMatchPlan(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'plan.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        tiles = TileSet([0, 40, 0, 40], [0, 0, 30, 30], [40, 40, 40, 20],
+                        [30, 30, 30, 15], dtype=int)
+        tiles.image_id = np.array([7, 3, -1, 7])
+        tiles.E_sq = np.array([1.5, 20.25, 0, 1.5], dtype=np.float32)
+        tiles.dL = np.array([-0.5, 3, 0, -0.5], dtype=np.float32)
+        tiles.filenames = {7: '/photos/caf\xc3\xa9.jpg', 3: u'/photos/3.jpg'}
+        save_plan(self.path, tiles)
+        loaded = load_plan(self.path)
+        for name in TileSet.ARRAYS:
+            if name not in ('depth', 'rgb', 'lab'):
+                np.testing.assert_array_equal(getattr(loaded, name),
+                                              getattr(tiles, name))
+        self.assertEqual(loaded.filenames[7], tiles.filenames[7])
+        self.assertEqual(loaded.filenames[3], tiles.filenames[3])
+        self.assertEqual(loaded.image_id.dtype, np.int64)
+
+    def test_newer_plans_are_refused(self):
+        np.savez_compressed(self.path, version=VERSION + 1)
+        self.assertRaises(ValueError, load_plan, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from partition import TileSet
+from render import layout, render_tiles, render_strips
+
+class FilePool(object):
+    "The part of a pool render uses, reading every image from its file."
+    def image_sources(self, requests):
+        return [('file', filename) for _, filename, _ in requests]
+
+    def read_source(self, source):
+        return Image.open(source[1])
+
+class StripList(object):
+    "A strip writer that keeps the strips."
+    def __init__(self, strip_height):
+        self.strip_height = strip_height
+        self.strips = []
+
+    def write(self, strip):
+        self.strips.append(np.asarray(strip))
+
+class TestRenderStrips(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        random = np.random.RandomState(0)
+        # JPEGs, which are drafted at a smaller scale for small tiles.
+        self.filenames = {}
+        for image_id in range(4):
+            filename = os.path.join(self.dir, '%d.jpg' % image_id)
+            pixels = random.randint(0, 256, (300, 400, 3)).astype(np.uint8)
+            Image.fromarray(pixels).save(filename)
+            self.filenames[image_id] = filename
+        n = 300
+        tiles = TileSet(random.uniform(-20, 480, n), random.uniform(-20, 380, n),
+                        random.choice([7, 12.5, 30, 64, 130], n),
+                        random.choice([9, 15, 30.5, 70, 110], n))
+        tiles.image_id = random.randint(-1, 4, n)
+        tiles.filenames = self.filenames
+        self.tiles = tiles
+        self.size = 500, 400
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_strips_are_the_whole_mosaic(self):
+        whole = Image.new('RGB', self.size, (255, 255, 255))
+        render_tiles(whole, FilePool(), self.tiles, threads=2)
+        for strip_height in 37, 128, 400:
+            writer = StripList(strip_height)
+            render_strips(writer, FilePool(), self.tiles, self.size,
+                          threads=2)
+            np.testing.assert_array_equal(np.concatenate(writer.strips),
+                                          np.asarray(whole))
+
+    def test_styled_strips_are_the_whole_mosaic(self):
+        self.tiles.dL = np.random.RandomState(2).uniform(-30, 30, len(self.tiles))
+        placed = layout(self.tiles, pad=1, scatter=True, margin=6)
+        whole = Image.new('RGB', self.size, (255, 255, 255))
+        render_tiles(whole, FilePool(), self.tiles, threads=2, placed=placed)
+        writer = StripList(50)
+        render_strips(writer, FilePool(), self.tiles, self.size, threads=2,
+                      placed=placed)
+        np.testing.assert_array_equal(np.concatenate(writer.strips),
+                                      np.asarray(whole))
+
+class TestLayout(unittest.TestCase):
+    def setUp(self):
+        self.tiles = TileSet([0, 100, 200, 300], [0, 0, 50, 50],
+                             [100, 100, 50, 50], [80, 80, 40, 40],
+                             depth=[0, 0, 1, 1])
+        self.tiles.dL = np.array([-40., 0., 10., -100.])
+
+    def test_plain(self):
+        x, y, w, h = layout(self.tiles, scale=0.5)
+        self.assertEqual(x.tolist(), [0, 50, 100, 150])
+        self.assertEqual(y.tolist(), [0, 0, 25, 25])
+        self.assertEqual(w.tolist(), [50, 50, 25, 25])
+        self.assertEqual(h.tolist(), [40, 40, 20, 20])
+
+    def test_pad_shrinks_dark_matches_in_place(self):
+        x, y, w, h = layout(self.tiles, pad=1)
+        # Matches too dark for a light background shrink; the rest do not.
+        self.assertEqual(w.tolist(), [77, 100, 50, 25])
+        self.assertEqual(h.tolist(), [61, 80, 40, 20])
+        self.assertEqual(x.tolist(), [11, 100, 200, 312])
+        self.assertEqual(y.tolist(), [9, 0, 50, 60])
+        # A dark background pads the matches that are too light.
+        x, y, w, h = layout(self.tiles, pad=-1)
+        self.assertEqual(w.tolist(), [100, 100, 45, 50])
+
+    def test_margin(self):
+        x, y, w, h = layout(self.tiles, margin=4)
+        self.assertEqual(w.tolist(), [92, 92, 42, 42])
+        self.assertEqual(x.tolist(), [4, 104, 204, 304])
+        x, y, w, h = layout(self.tiles, margin=4, scaled_margin=True)
+        self.assertEqual(w.tolist(), [92, 92, 46, 46])
+
+    def test_scatter_stays_within_margin(self):
+        np.random.seed(0)
+        for _ in range(50):
+            x, y, w, h = layout(self.tiles, pad=1, scatter=True, margin=5)
+            self.assertEqual(w.tolist(), [77, 100, 50, 25])
+            x0 = self.tiles.x.astype(int)
+            self.assertTrue((x >= x0 - 5).all())
+            self.assertTrue((x + w <= x0 + self.tiles.w.astype(int) + 5).all())
+        # Without a margin, only padded tiles move, within their places.
+        x, y, w, h = layout(self.tiles, pad=1, scatter=True)
+        self.assertEqual(x[1:3].tolist(), [100, 200])
+        self.assertTrue(0 <= x[0] <= 23)
+
+if __name__ == '__main__':
+    unittest.main()
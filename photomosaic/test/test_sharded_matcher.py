@@ -0,0 +1,30 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from array_matcher import ArrayMatcher
+from sharded_matcher import ShardedMatcher
+from test_sql_image_pool import PoolTestCase, make_image
+
+class TestShardedMatcher(PoolTestCase):
+    def test_sees_images_not_yet_committed(self):
+        for i in range(8):
+            make_image(self.path('photos', '%d.jpg' % i),
+                       (30*i, 255 - 30*i, 15*i))
+        targets = np.random.RandomState(0).uniform(-50, 100, (20, 4, 3))
+        self.pool.add_directory(self.path('photos'))
+        matcher = ShardedMatcher.from_pool(self.pool, processes=3, k=4)
+        try:
+            rows, E_sq = matcher.top_k(targets, 4)
+        finally:
+            matcher.close()
+        self.assertEqual(len(matcher), 8)
+        expected_rows, expected_E_sq = \
+            ArrayMatcher.from_pool(self.pool).top_k(targets, 4)
+        np.testing.assert_array_equal(rows, expected_rows)
+        np.testing.assert_allclose(E_sq, expected_E_sq, rtol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spatial_index import KDTreeIndex
+from array_matcher import ArrayMatcher
+from test_ivf_index import pool_features
+from test_sql_image_pool import PoolTestCase, make_image
+
+def nearest_ids(image_ids, features, target, k):
+    E_sq = ((features - target)**2).sum(1)
+    return image_ids[E_sq.argsort(kind='mergesort')[:k]]
+
+class TestKDTreeIndex(unittest.TestCase):
+    def setUp(self):
+        self.image_ids, self.features = pool_features(500)
+        self.index = KDTreeIndex(self.image_ids, self.features)
+
+    def test_finds_the_nearest_images(self):
+        for target in pool_features(50, seed=1)[1]:
+            np.testing.assert_array_equal(
+                self.index.query(target, 10),
+                nearest_ids(self.image_ids, self.features, target, 10))
+
+    def test_added_images_are_searched_until_rebuilt(self):
+        image_ids, features = pool_features(520, seed=2)
+        image_ids = np.concatenate([self.image_ids, image_ids[500:] + 1000])
+        features = np.concatenate([self.features, features[500:]])
+        tree = self.index.tree
+        self.assertTrue(self.index.update(image_ids, features))
+        self.assertTrue(self.index.tree is tree)
+        self.assertEqual(len(self.index), 520)
+        for target in features[495:505]:
+            np.testing.assert_array_equal(
+                self.index.query(target, 10),
+                nearest_ids(image_ids, features, target, 10))
+        self.assertFalse(self.index.update(image_ids, features))
+        # Any other change is a rebuild.
+        features = features.copy()
+        features[3] += 10
+        self.assertTrue(self.index.update(image_ids, features))
+        self.assertFalse(self.index.tree is tree)
+        self.assertEqual(len(self.index.pending_ids), 0)
+        np.testing.assert_array_equal(
+            self.index.query(features[3], 5),
+            nearest_ids(image_ids, features, features[3], 5))
+
+class TestKDTreeMatcher(PoolTestCase):
+    def test_index_is_kept_beside_the_pool(self):
+        for i in range(10):
+            make_image(self.path('photos', '%d.jpg' % i),
+                       (25*i, 255 - 25*i, 60))
+        self.pool.add_directory(self.path('photos'))
+        self.pool.set_matcher('kdtree', k=3)
+        targets = np.random.RandomState(0).uniform(-50, 100, (30, 4, 3))
+        self.pool.choose_matches(targets)
+        self.assertTrue(os.path.exists(self.path('pool.db.kdtree')))
+        self.pool.close()
+        self.pool = self.open_pool()
+        for i in range(10, 12):
+            make_image(self.path('photos', '%d.jpg' % i), (40, 40, 25*i))
+        self.pool.add_directory(self.path('photos'))
+        self.pool.set_matcher('kdtree', k=3)
+        self.assertEqual(len(self.pool.matcher.index), 12)
+        # Without tolerance or penalties, the nearest of the k candidates
+        # is the nearest of the pool.
+        expected = ArrayMatcher.from_pool(self.pool).choose_matches(
+            targets, 0, 0)
+        self.assertEqual(self.pool.choose_matches(targets, 0, 0), expected)
+
+if __name__ == '__main__':
+    unittest.main()
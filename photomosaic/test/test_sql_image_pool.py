@@ -0,0 +1,378 @@
+import os
+import sys
+import random
+import collections
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+from PIL import ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cli
+import image_pool
+import image_functions
+from sql_image_pool import SqlImagePool, BULK_LOAD_PRAGMAS, rebuild_histogram
+from array_matcher import load_features, JND
+
+def make_image(path, color, size=(40, 30)):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    Image.new('RGB', size, color).save(path)
+
+class PoolTestCase(unittest.TestCase):
+    "A pool in a fresh temporary directory, analyzed with the mean color."
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pool = self.open_pool()
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.dir)
+
+    def open_pool(self, **options):
+        options.setdefault('estimator', 'mean')
+        return SqlImagePool(self.path('pool.db'), **options)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+class TestSettings(PoolTestCase):
+    def test_opening_does_not_write(self):
+        self.pool.close()
+        self.pool = self.open_pool(thumbnail_sizes=(20,))
+        make_image(self.path('photos', '0.jpg'), (10, 0, 0))
+        self.pool.add_directory(self.path('photos'))
+        for options in {}, {'estimator': None}, {'thumbnail_sizes': [20]}:
+            self.pool.close()
+            self.pool = self.open_pool(**options)
+            self.assertEqual(self.pool.db.total_changes, 0)
+            self.assertEqual(self.pool.estimator, 'mean')
+            self.assertEqual(self.pool.thumbnail_sizes, (20,))
+
+    def test_opening_while_another_connection_writes(self):
+        make_image(self.path('photos', '0.jpg'), (10, 0, 0))
+        self.pool.add_directory(self.path('photos'))
+        self.pool.close()
+        writer = sqlite3.connect(self.path('pool.db'), isolation_level=None)
+        writer.execute("BEGIN IMMEDIATE")
+        writer.execute("UPDATE Images SET usages=usages")
+        try:
+            self.pool = SqlImagePool(self.path('pool.db'))
+            self.assertEqual(len(self.pool), 1)
+            self.assertEqual(self.pool.db.total_changes, 0)
+        finally:
+            writer.rollback()
+            writer.close()
+
+    def test_estimator_must_match_the_images(self):
+        self.pool.close()
+        # An empty pool may still change its estimator.
+        self.pool = self.open_pool(estimator='histogram')
+        make_image(self.path('photos', '0.jpg'), (10, 0, 0))
+        self.pool.add_directory(self.path('photos'))
+        self.pool.close()
+        self.assertRaises(ValueError, self.open_pool, estimator='mean')
+        self.pool = self.open_pool(estimator=None)
+        self.assertEqual(self.pool.estimator, 'histogram')
+
+class TestAddDirectory(PoolTestCase):
+    def test_parallel_adds_only_new_files(self):
+        for i in range(4):
+            make_image(self.path('photos', '%d.jpg' % i), (10*i, 0, 0))
+        self.pool.add_directory(self.path('photos'), processes=2)
+        self.assertEqual(len(self.pool), 4)
+        for i in range(4, 6):
+            make_image(self.path('photos', '%d.jpg' % i), (10*i, 0, 0))
+        # Known files are filtered out with one query, not one per file.
+        def contains(pool, filename):
+            raise AssertionError("%s looked up alone" % filename)
+        original, SqlImagePool.__contains__ = SqlImagePool.__contains__, contains
+        try:
+            self.pool.add_directory(self.path('photos'), processes=2)
+        finally:
+            SqlImagePool.__contains__ = original
+        self.assertEqual(sorted(self.pool.file_records()),
+                         [self.path('photos', '%d.jpg' % i) for i in range(6)])
+
+    def test_files_are_filtered_before_they_are_opened(self):
+        make_image(self.path('photos', 'a.JPG'), (10, 0, 0))
+        make_image(self.path('photos', 'nested', 'b.png'), (20, 0, 0))
+        make_image(self.path('other', 'c.jpg'), (30, 0, 0))
+        os.symlink(self.path('other'), self.path('photos', 'link'))
+        with open(self.path('photos', 'notes.txt'), 'w') as f:
+            f.write('not an image')
+        with open(self.path('photos', 'small.jpg'), 'w') as f:
+            f.write('x')
+        opened = []
+        def analyze_file(filename, *args):
+            opened.append(filename)
+            return original(filename, *args)
+        original, image_pool.analyze_file = image_pool.analyze_file, analyze_file
+        try:
+            self.pool.add_directory(self.path('photos'), min_size=100)
+        finally:
+            image_pool.analyze_file = original
+        expected = [self.path('photos', 'a.JPG'),
+                    self.path('photos', 'nested', 'b.png')]
+        self.assertEqual(sorted(opened), expected)
+        self.assertEqual(sorted(self.pool.file_records()), expected)
+
+    def test_fast_decode_is_close_to_the_full_decode(self):
+        # A large photo-like image: colored blotches, blurred.
+        blotches = np.random.RandomState(0).randint(0, 256, (6, 8, 3))
+        image = Image.fromarray(blotches.astype(np.uint8)).resize(
+            (4000, 3000), Image.BILINEAR).filter(ImageFilter.GaussianBlur(20))
+        image.save(self.path('large.jpg'), quality=90)
+        reduced = image_functions.reduce_on_decode(
+            Image.open(self.path('large.jpg')), (100, 100))
+        self.assertTrue(reduced.size[0] <= 1000)
+        self.assertTrue(image_pool.decode_error(self.path('large.jpg'),
+                                                'mean') < JND)
+
+    def test_fast_decode_from_the_command_line(self):
+        make_image(self.path('photos', '0.jpg'), (10, 0, 0))
+        args = cli.args_parser().parse_args(
+            ['target.jpg', self.path('cli.db'), '-e', 'mean',
+             '-f', self.path('photos'), '--fast-decode'])
+        decoded = []
+        def analyze_file(filename, fast_decode=False, *args):
+            decoded.append(fast_decode)
+            return original(filename, fast_decode, *args)
+        original, image_pool.analyze_file = image_pool.analyze_file, analyze_file
+        try:
+            cli.get_database(args).close()
+        finally:
+            image_pool.analyze_file = original
+        self.assertEqual(decoded, [True])
+
+class TestBulkLoad(PoolTestCase):
+    def settings(self):
+        c = self.pool.db.cursor()
+        pragmas = [c.execute("PRAGMA %s" % pragma).fetchone()[0]
+                   for pragma, value in BULK_LOAD_PRAGMAS]
+        indexes = c.execute("""SELECT name FROM sqlite_master
+                               WHERE type='index' ORDER BY name""").fetchall()
+        return pragmas, indexes
+
+    def test_settings_and_indexes_are_restored(self):
+        before = self.settings()
+        self.assertNotEqual(before[0][0], 'wal')
+        self.assertTrue(before[1])
+        for i in range(2):
+            make_image(self.path('photos', '%d.jpg' % i), (10*i, 0, 0))
+        with self.pool.bulk_load():
+            self.pool.add_directory(self.path('photos'))
+            self.assertEqual(self.settings()[0][0], 'wal')
+        self.assertEqual(self.settings(), before)
+        self.pool.close()
+        self.pool = self.open_pool()
+        self.assertEqual(self.settings(), before)
+        self.assertEqual(len(self.pool), 2)
+
+class TestChooseMatches(PoolTestCase):
+    def test_same_as_choosing_one_at_a_time(self):
+        for i in range(24):
+            make_image(self.path('photos', '%d.jpg' % i),
+                       (100 + 2*i, 150 - i, 120 + (5*i) % 12))
+        self.pool.add_directory(self.path('photos'))
+        # More targets than images, around a few of them, so the jitter
+        # and the usage penalty both decide matches.
+        features = load_features(self.pool.db)[1]
+        state = np.random.RandomState(0)
+        labs = (features[state.randint(0, 6, 60)] +
+                state.normal(0, 2, (60, 12))).reshape(60, 4, 3).tolist()
+        for name in ['sql', 'array', 'kdtree', 'ivfpq']:
+            options = {} if name == 'sql' else {'seed': 0}
+            results = []
+            for choose in [
+                    lambda: self.pool.choose_matches(labs, 3, 2),
+                    lambda: [self.pool.choose_match(lab, 3, 2)
+                             for lab in labs]]:
+                self.pool.set_matcher(name, **options)
+                self.pool.reset_usage()
+                random.seed(0)
+                results.append((choose(), self.pool.usage_counts()))
+            self.assertEqual(results[0], results[1], name)
+            self.assertTrue(len(results[0][1]) > 6, name)
+
+class TestRangeQuery(PoolTestCase):
+    def add_images(self, directory, state, n=30):
+        for i in range(n):
+            path = self.path(directory, '%d.jpg' % i)
+            make_image(path, tuple(state.randint(0, 256, 3)))
+            # Paint the right half another color, so quadrants differ.
+            image = Image.open(path)
+            image.paste(tuple(state.randint(0, 256, 3)), (20, 0, 40, 30))
+            image.save(path)
+        self.pool.add_directory(self.path(directory))
+
+    def test_finds_the_nearest_image(self):
+        state = np.random.RandomState(0)
+        self.add_images('photos', state)
+        # Images added after reopening must be indexed as well.
+        self.pool.close()
+        self.pool = self.open_pool()
+        self.add_images('more', state)
+        image_ids, features = load_features(self.pool.db)[:2]
+        self.assertEqual(len(image_ids), 60)
+        targets = state.uniform([0, -60, -60]*4, [100, 60, 60]*4, (100, 12))
+        for rtree in sorted(set([False, self.pool.rtree])):
+            self.pool.rtree = rtree
+            for target in targets:
+                E_sq = ((features - target)**2).sum(1)/4
+                match = self.pool.choose_match(target.reshape(4, 3).tolist(),
+                                               tolerance=0, usage_penalty=0)
+                self.assertEqual(match.image_id, image_ids[E_sq.argmin()])
+                self.assertAlmostEqual(match.E_sq, E_sq.min(), 2)
+
+class TestUsage(PoolTestCase):
+    def usages(self):
+        return dict(self.pool.db.execute(
+            "SELECT image_id, usages FROM Images").fetchall())
+
+    def test_counted_in_memory_and_flushed_once(self):
+        for i in range(3):
+            make_image(self.path('photos', '%d.jpg' % i), (80*i, 0, 0))
+        self.pool.add_directory(self.path('photos'))
+        self.pool.db.commit()
+        other = self.open_pool()
+        try:
+            for name in ['sql', 'array']:
+                self.pool.set_matcher(name)
+                self.pool.reset_usage()
+                before = self.pool.db.total_changes
+                matches = [self.pool.choose_match([(50, 0, 0)]*4)
+                           for i in range(5)]
+                self.assertEqual(self.pool.db.total_changes, before, name)
+                counts = collections.Counter(m.image_id for m in matches)
+                self.assertEqual(self.pool.usage_counts(), counts, name)
+                # Another render on the same pool sees none of them.
+                self.assertEqual(other.usage_counts(), {}, name)
+                self.assertEqual(set(self.usages().values()), set([0]), name)
+            # The counts of the last render are written in one update each.
+            before = self.pool.db.total_changes
+            self.pool.flush_usage()
+            self.assertEqual(self.pool.db.total_changes - before, len(counts))
+            self.assertEqual(dict((k, v) for k, v in self.usages().items() if v),
+                             counts)
+        finally:
+            other.close()
+
+def pack_sizes(directory):
+    return dict((name, os.path.getsize(os.path.join(directory, name)))
+                for name in os.listdir(directory))
+
+class TestBuildThumbnails(PoolTestCase):
+    def test_small_images_are_not_made_again(self):
+        make_image(self.path('photos', 'small.jpg'), (10, 0, 0), (40, 30))
+        make_image(self.path('photos', 'large.jpg'), (0, 10, 0), (200, 150))
+        self.pool.add_directory(self.path('photos'))
+        self.pool.close()
+        self.pool = self.open_pool(thumbnail_sizes=(20, 50))
+        self.pool.build_thumbnails()
+        c = self.pool.db.cursor()
+        c.execute("""SELECT filename, Thumbnails.size FROM Thumbnails
+                     JOIN Images ON Images.image_id=Thumbnails.image_id""")
+        self.assertEqual(sorted(tuple(row) for row in c),
+                         [(self.path('photos', 'large.jpg'), 20),
+                          (self.path('photos', 'large.jpg'), 50),
+                          (self.path('photos', 'small.jpg'), 20)])
+        packs = pack_sizes(self.path('pool.db.thumbs'))
+        self.pool.build_thumbnails()
+        self.assertEqual(pack_sizes(self.path('pool.db.thumbs')), packs)
+
+class TestSyncDirectory(PoolTestCase):
+    def test_sibling_with_the_same_start_is_left_alone(self):
+        for i in range(3):
+            make_image(self.path('photos', '%d.jpg' % i), (10*i, 0, 0))
+            make_image(self.path('photos_2019', '%d.jpg' % i), (0, 10*i, 0))
+        self.pool.add_directory(self.path('photos_2019'))
+        self.pool.sync_directory(self.path('photos'))
+        self.assertEqual(len(self.pool), 6)
+        self.pool.sync_directory(self.path('photos') + os.sep)
+        self.assertEqual(len(self.pool), 6)
+        self.assertEqual(sorted(self.pool.file_records(self.path('photos'))),
+                         [self.path('photos', '%d.jpg' % i) for i in range(3)])
+
+    def test_non_ascii_directory(self):
+        photos = self.path('caf\xc3\xa9')
+        for i in range(3):
+            make_image(os.path.join(photos, '%d.jpg' % i), (10*i, 0, 0))
+            make_image(os.path.join(photos + '_2019', '%d.jpg' % i),
+                       (0, 10*i, 0))
+        self.pool.add_directory(photos + '_2019', processes=2)
+        self.pool.sync_directory(photos)
+        self.assertEqual(len(self.pool), 6)
+        self.assertEqual(sorted(self.pool.file_records(photos)),
+                         [os.path.join(photos, '%d.jpg' % i) for i in range(3)])
+        self.pool.sync_directory(photos)
+        self.pool.add_directory(photos, processes=2)
+        self.assertEqual(len(self.pool), 6)
+
+    def test_changed_and_removed_files(self):
+        for i in range(3):
+            make_image(self.path('photos', '%d.jpg' % i), (10*i, 0, 0))
+        self.pool.sync_directory(self.path('photos'))
+        os.remove(self.path('photos', '0.jpg'))
+        make_image(self.path('photos', '1.jpg'), (0, 0, 200), (50, 30))
+        self.pool.sync_directory(self.path('photos'))
+        records = self.pool.file_records()
+        self.assertEqual(sorted(records), [self.path('photos', '%d.jpg' % i)
+                                           for i in (1, 2)])
+        self.assertEqual(records[self.path('photos', '1.jpg')][2],
+                         os.path.getsize(self.path('photos', '1.jpg')))
+
+    def test_histogram_is_kept_up_to_date(self):
+        def histogram():
+            return self.pool.db.execute("""SELECT channel, value, count
+                                           FROM ColorHistogram
+                                           ORDER BY channel, value""").fetchall()
+        def check():
+            counted = histogram()
+            rebuild_histogram(self.pool.db)
+            self.assertEqual(counted, histogram())
+            self.assertTrue(sum(row[2] for row in counted) > 0)
+        for i in range(3):
+            make_image(self.path('photos', '%d.jpg' % i), (10*i, 50, 100))
+        self.pool.add_directory(self.path('photos'))
+        check()
+        make_image(self.path('photos', '3.jpg'), (200, 150, 0))
+        self.pool.sync_directory(self.path('photos'))
+        check()
+        os.remove(self.path('photos', '0.jpg'))
+        self.pool.sync_directory(self.path('photos'))
+        check()
+        make_image(self.path('photos', '1.jpg'), (0, 0, 200), (50, 30))
+        self.pool.sync_directory(self.path('photos'))
+        check()
+
+    def test_unusable_files_are_not_tried_again_until_they_change(self):
+        make_image(self.path('photos', 'rgb.jpg'), (10, 0, 0))
+        gray = self.path('photos', 'gray.png')
+        Image.new('L', (40, 30), 128).save(gray)
+        self.pool.sync_directory(self.path('photos'))
+        self.assertEqual(len(self.pool), 1)
+        self.assertEqual(list(self.pool.skipped_records()), [gray])
+        analyzed = []
+        analyze_file = image_pool.analyze_file
+        def spy(filename, *args):
+            analyzed.append(filename)
+            return analyze_file(filename, *args)
+        image_pool.analyze_file = spy
+        try:
+            self.pool.sync_directory(self.path('photos'))
+        finally:
+            image_pool.analyze_file = analyze_file
+        self.assertEqual(analyzed, [])
+        self.assertEqual(list(self.pool.skipped_records()), [gray])
+        # Once it changes, it is tried again.
+        Image.new('RGB', (40, 31), (0, 99, 0)).save(gray)
+        self.pool.sync_directory(self.path('photos'))
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(self.pool.skipped_records(), {})
+
+if __name__ == '__main__':
+    unittest.main()
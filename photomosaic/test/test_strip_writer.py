@@ -0,0 +1,80 @@
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from strip_writer import TiffWriter, NpyWriter, open_writer
+
+def read_bigtiff(path):
+    "Read the pixels of an uncompressed RGB strip BigTIFF, as TiffWriter writes."
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert data[:4] == b'II+\0'
+    start, = struct.unpack_from('<Q', data, 8)
+    count, = struct.unpack_from('<Q', data, start)
+    fields = {}
+    sizes = {3: 2, 4: 4, 16: 8}
+    formats = {3: 'H', 4: 'I', 16: 'Q'}
+    for n in range(count):
+        tag, type, values = struct.unpack_from('<HHQ', data, start + 8 + 20*n)
+        where = start + 8 + 20*n + 12
+        if values*sizes[type] > 8:
+            where, = struct.unpack_from('<Q', data, where)
+        fields[tag] = struct.unpack_from('<%d%s' % (values, formats[type]),
+                                         data, where)
+    width, height = fields[256][0], fields[257][0]
+    pixels = b''.join(data[offset:offset + length] for offset, length
+                      in zip(fields[273], fields[279]))
+    return np.frombuffer(pixels, np.uint8).reshape(height, width, 3)
+
+class TestStripWriters(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pixels = np.random.RandomState(0).randint(
+            0, 256, (45, 31, 3)).astype(np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, writer):
+        with writer:
+            for y in range(0, len(self.pixels), writer.strip_height):
+                strip = self.pixels[y:y + writer.strip_height]
+                writer.write(Image.fromarray(strip))
+
+    def test_tiff(self):
+        path = os.path.join(self.dir, 'mosaic.tif')
+        self.write(open_writer(path, (31, 45), 10))
+        np.testing.assert_array_equal(np.asarray(Image.open(path)),
+                                      self.pixels)
+
+    def test_bigtiff(self):
+        path = os.path.join(self.dir, 'mosaic.tif')
+        self.write(TiffWriter(path, (31, 45), 10, bigtiff=True))
+        np.testing.assert_array_equal(read_bigtiff(path), self.pixels)
+
+    def test_npy(self):
+        path = os.path.join(self.dir, 'mosaic.npy')
+        writer = open_writer(path, (31, 45), 16)
+        self.assertTrue(isinstance(writer, NpyWriter))
+        self.write(writer)
+        np.testing.assert_array_equal(np.load(path, mmap_mode='r'),
+                                      self.pixels)
+
+    def test_strips_must_fit(self):
+        path = os.path.join(self.dir, 'mosaic.npy')
+        with NpyWriter(path, (31, 45), 16) as writer:
+            self.assertRaises(ValueError, writer.write,
+                              Image.new('RGB', (31, 15)))
+            self.assertRaises(ValueError, writer.write,
+                              Image.new('L', (31, 16)))
+        self.assertRaises(ValueError, open_writer,
+                          os.path.join(self.dir, 'mosaic.png'), (31, 45), 16)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import os
+import sys
+import unittest
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_functions import dynamic_range
+from partition import Partition, TileSet, Tile, procreate
+from array_matcher import Match
+from tile_stats import TileStats, MaskStats
+
+def target(size=(211, 157), seed=0):
+    "Noise over a few flat shapes, so that some tiles split and some do not."
+    random = np.random.RandomState(seed)
+    img = Image.new('RGB', size, (120, 140, 160))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = random.randint(0, size[0]), random.randint(0, size[1])
+        r = random.randint(5, 40)
+        draw.ellipse((x - r, y - r, x + r, y + r),
+                     fill=tuple(random.randint(0, 256, 3)))
+    noise = random.randint(-20, 20, (size[1], size[0], 3))
+    pixels = np.clip(np.asarray(img, dtype=int) + noise, 0, 255)
+    return Image.fromarray(pixels.astype(np.uint8))
+
+def mask(size=(211, 157)):
+    img = Image.new('L', size, 0)
+    ImageDraw.Draw(img).ellipse((20, 15, size[0] - 30, size[1] - 10),
+                                fill=255)
+    return img
+
+def grey_mask(size=(211, 157)):
+    "The ellipse of mask, over a grey ramp on the left."
+    pixels = np.array(mask(size))
+    ramp = np.linspace(0, 254, size[0]//2).astype(np.uint8)
+    pixels[:, :size[0]//2] = np.maximum(pixels[:, :size[0]//2], ramp)
+    return Image.fromarray(pixels)
+
+def split_by_crops(p, depth, hdr):
+    "recursive_split as it was, cropping and blurring every tile."
+    tiles = list(p.tiles)
+    for g in range(depth):
+        old_tiles, tiles = tiles, []
+        for tile in old_tiles:
+            if (dynamic_range(p.get_tile_img(tile)) > hdr
+                    or p.straddles_mask_edge(tile)):
+                tiles += procreate(tile)
+            else:
+                tiles.append(tile)
+    return [tile.quad() for tile in tiles]
+
+class TestTileStats(unittest.TestCase):
+    def test_ranges_are_those_of_blurred_crops(self):
+        img = target()
+        # Tiles reaching outside the target, whose crops are padded.
+        tiles = TileSet([-13.5, 60.25, 150.7, 5], [-7, 30.3, 100.1, 120],
+                        [60.2, 90, 80, 37.9], [50, 77.7, 70.5, 41])
+        depth = 4
+        stats = TileStats(img, tiles, depth)
+        for g in range(depth):
+            for p in range(len(tiles)):
+                for i in range(2**g):
+                    for j in range(2**g):
+                        box = (int(stats.x0[g][p, i]), int(stats.y0[g][p, j]),
+                               int(stats.x1[g][p, i]), int(stats.y1[g][p, j]))
+                        self.assertEqual(
+                            stats.dynamic_range(g, p, i, j),
+                            dynamic_range(img.crop(box)))
+
+    def test_split_as_by_crops(self):
+        for m in None, mask():
+            for dimensions, depth, hdr in [((7, 9), 4, 40), ((4, 3), 5, 80)]:
+                p = Partition(target(), m)
+                p.simple_partition(dimensions)
+                expected = split_by_crops(p, depth, hdr)
+                p.recursive_split(depth, hdr)
+                self.assertEqual([tile.quad() for tile in p.tiles], expected)
+
+class TestTileSet(unittest.TestCase):
+    def setUp(self):
+        self.tiles = TileSet([-1.5, 10, 20.25], [0, 5.5, 7], [10, 9.75, 3],
+                             [4.5, 4, 2.2], depth=[0, 1, 2])
+
+    def test_tiles_are_views_of_the_arrays(self):
+        quads = [(-1.5, 0.0, 10.0, 4.5), (10.0, 5.5, 9.75, 4.0),
+                 (20.25, 7.0, 3.0, 2.2)]
+        self.assertEqual([tile.quad() for tile in self.tiles], quads)
+        self.assertEqual(self.tiles[2].index, 2)
+        self.assertEqual([tile.quad() for tile in self.tiles.int_version()],
+                         [Tile(*quad).int_version().quad() for quad in quads])
+        self.assertEqual(TileSet.from_tiles(self.tiles).quads().tolist(),
+                         self.tiles.quads().tolist())
+
+    def test_subsets_keep_colors_and_matches(self):
+        self.tiles.lab[:] = np.arange(3)[:, np.newaxis, np.newaxis]
+        self.tiles.set_matches([0, 2], [Match(7, 1.5, -0.5, 0, 'a.jpg'),
+                                        None])
+        self.assertEqual(self.tiles.match(0), (7, 1.5, -0.5, None, 'a.jpg'))
+        self.assertEqual(self.tiles.match(2), None)
+        for subset in [self.tiles[np.array([True, False, True])],
+                       self.tiles[[0, 2]], self.tiles[::2]]:
+            self.assertEqual(len(subset), 2)
+            self.assertEqual(subset.depth.tolist(), [0, 2])
+            self.assertEqual(subset.lab[:, 0, 0].tolist(), [0, 2])
+            self.assertEqual(subset.match(0), self.tiles.match(0))
+        both = TileSet.concatenate([self.tiles[2:], self.tiles[:1]])
+        self.assertEqual(both.quads().tolist(),
+                         self.tiles.quads()[[2, 0]].tolist())
+        self.assertEqual(both.match(1).filename, 'a.jpg')
+
+    def test_split_tiles_know_their_depth(self):
+        p = Partition(target(), mask())
+        p.simple_partition((4, 3))
+        width = p.tiles.w[0]
+        p.recursive_split(4, 40)
+        self.assertTrue((p.tiles.depth > 0).any())
+        np.testing.assert_allclose(p.tiles.w,
+                                   width/2.**p.tiles.depth.astype(int))
+
+class TestMaskStats(unittest.TestCase):
+    def test_as_by_crops(self):
+        m = grey_mask()
+        stats = MaskStats(m)
+        random = np.random.RandomState(0)
+        # Boxes of a few sizes, some reaching outside the mask.
+        x0 = random.randint(-20, 211, 300)
+        y0 = random.randint(-20, 157, 300)
+        x1 = x0 + random.choice([1, 4, 13, 40], 300)
+        y1 = y0 + random.choice([1, 4, 13, 40], 300)
+        brightest = stats.brightest(x0, y0, x1, y1)
+        straddles = stats.straddles_edge(x0, y0, x1, y1)
+        for k, box in enumerate(zip(x0, y0, x1, y1)):
+            crop = np.asarray(m.crop(box))
+            self.assertEqual(brightest[k], crop.max())
+            self.assertEqual(straddles[k], (crop == 255).any() and
+                                           (crop != 255).any())
+
+    def test_blanking_is_seeded(self):
+        def blanked(seed):
+            p = Partition(target(), grey_mask(), seed=seed)
+            p.simple_partition((30, 20))
+            return [tile.quad() for tile in p.get_tiles()]
+        self.assertEqual(blanked(1), blanked(1))
+        self.assertNotEqual(blanked(1), blanked(2))
+        # White tiles are always kept, and tiles all black never.
+        p = Partition(target(), grey_mask(), seed=1)
+        p.simple_partition((30, 20))
+        everything = [tile.quad() for tile in p.tiles.int_version()]
+        kept = set(blanked(1))
+        m = grey_mask()
+        for quad in everything:
+            x, y, w, h = map(int, quad)
+            brightest = np.asarray(m.crop((x, y, x + w, y + h))).max()
+            if brightest == 255:
+                self.assertTrue(quad in kept)
+            elif brightest == 0:
+                self.assertFalse(quad in kept)
+
+if __name__ == '__main__':
+    unittest.main()
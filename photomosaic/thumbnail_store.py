@@ -0,0 +1,85 @@
+from __future__ import division
+from cStringIO import StringIO
+from PIL import Image
+import io
+import os
+import logging
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+def make_thumbnails(img, sizes, quality=90):
+    """Scale an image so that its shorter side is each of the given sizes,
+    and encode the results as JPEGs. Return a list of (size, w, h, data),
+    skipping sizes that would be larger than the image itself."""
+    w, h = img.size
+    thumbs = []
+    for size in sorted(sizes, reverse=True):
+        scale = size/min(w, h)
+        if scale > 1:
+            continue
+        # Scale each thumbnail down from the previous, larger one.
+        img = img.resize((max(1, int(round(w*scale))),
+                          max(1, int(round(h*scale)))), Image.ANTIALIAS)
+        buf = StringIO()
+        img.save(buf, 'JPEG', quality=quality)
+        thumbs.append((size, img.size[0], img.size[1], buf.getvalue()))
+    return thumbs
+
+def covers(img_size, tile_size):
+    """Can crop_to_fit fill tile_size from an image of img_size without
+    scaling it up?"""
+    img_w, img_h = img_size
+    tile_w, tile_h = tile_size
+    if img_w/img_h > tile_w/tile_h:
+        return img_h >= tile_h
+    else:
+        return img_w >= tile_w
+
+class ThumbnailStore:
+    """Thumbnails packed end to end into a fixed number of shard files in
+    one directory. The store only holds the bytes; where each thumbnail is
+    (shard, offset, length) has to be kept by the caller, the pool's
+    Thumbnails table. Space taken by thumbnails of deleted images is not
+    reclaimed."""
+    def __init__(self, directory, shards=64):
+        self.directory = directory
+        self.shards = shards
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def shard_path(self, shard):
+        return os.path.join(self.directory, '%03d.pack' % shard)
+
+    def write(self, records):
+        """Append thumbnails to the store. records is a list of
+        (image_id, thumbs), with thumbs as made by make_thumbnails.
+        Return the locations as a list of
+        (image_id, size, w, h, shard, offset, length) tuples."""
+        by_shard = {}
+        for image_id, thumbs in records:
+            by_shard.setdefault(image_id % self.shards, []).append(
+                (image_id, thumbs))
+        locations = []
+        for shard, shard_records in by_shard.iteritems():
+            with io.open(self.shard_path(shard), 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                for image_id, thumbs in shard_records:
+                    for size, w, h, data in thumbs:
+                        f.write(data)
+                        locations.append((image_id, size, w, h, shard,
+                                          offset, len(data)))
+                        offset += len(data)
+        return locations
+
+    def read(self, shard, offset, length):
+        "Load one thumbnail as an Image."
+        with io.open(self.shard_path(shard), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        img = Image.open(StringIO(data))
+        img.load()
+        return img
@@ -0,0 +1,316 @@
+"""Statistics of the target for deciding, quickly, which tiles to split.
+
+Partition.recursive_split splits a tile if its blurred dynamic range is
+high or if it straddles the edge of the mask. Rather than crop, blur and
+measure every tile of every generation, TileStats blurs the target once
+and, for every generation, tabulates the minimum and maximum of each
+channel over every tile that generation could have. A split decision is
+then a lookup.
+
+MaskStats does the same for the mask, for splitting and for blanking. It
+keeps summed-area tables of the mask's white and lit (not black) pixels,
+so that a tile's pixels of each kind are counted from its four corners."""
+from __future__ import division
+import logging
+import numpy as np
+from PIL import ImageFilter
+
+# Configure logger.
+FORMAT = "%(name)s.%(funcName)s:  %(message)s"
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+
+def run_reduce(ufunc, arr, bounds):
+    """Reduce the 2-d arr with ufunc over the runs of rows between
+    consecutive bounds (sorted and distinct), and return the result
+    transposed, so that its columns are reduced in memory order too. A
+    reduction per run of contiguous rows is several times faster than
+    ufunc.reduceat."""
+    runs = np.empty((len(bounds) - 1, arr.shape[1]), dtype=arr.dtype)
+    for k, (start, stop) in enumerate(zip(bounds[:-1].tolist(),
+                                          bounds[1:].tolist())):
+        ufunc.reduce(arr[start:stop], out=runs[k])
+    return runs.T.copy()
+
+def block_reduce(ufunc, bands, row_bounds, column_bounds):
+    """Reduce each of bands, an array (c, h, w), with ufunc over the blocks
+    between consecutive row bounds and consecutive column bounds. Reducing
+    the result again, with bounds among the indexes of these, gives
+    coarser blocks."""
+    return np.array([run_reduce(ufunc, run_reduce(ufunc, band, row_bounds),
+                                column_bounds) for band in bands])
+
+def rect_lookup(ufunc, blocks, rows, columns, empty):
+    """Reduce blocks, made by block_reduce, with ufunc over a rectangle of
+    them per cell, given by (n, 2) arrays of the first and stop blocks of
+    its rows and of its columns. Return an array (n, c), holding empty for
+    the rectangles that are empty. Cells are a few blocks across, so this
+    takes the blocks at each offset up to the largest, keeping every cell
+    to its own last block."""
+    out = np.empty((len(rows), len(blocks)), dtype=blocks.dtype)
+    out.fill(empty)
+    some = (rows[:, 1] > rows[:, 0]) & (columns[:, 1] > columns[:, 0])
+    rows, columns = rows[some], columns[some]
+    if len(rows):
+        width = blocks.shape[2]
+        flat = blocks.reshape(len(blocks), -1)
+        found = flat.take(rows[:, 0]*width + columns[:, 0], axis=1)
+        for dy in range((rows[:, 1] - rows[:, 0]).max()):
+            y = np.minimum(rows[:, 0] + dy, rows[:, 1] - 1)*width
+            for dx in range((columns[:, 1] - columns[:, 0]).max()):
+                x = np.minimum(columns[:, 0] + dx, columns[:, 1] - 1)
+                ufunc(found, flat.take(y + x, axis=1), out=found)
+        out[some] = found.T
+    return out
+
+def frame_ranges(ranges):
+    """Split each range as a blurred crop is split: the inside, where it is
+    blurred, and the first and last two pixels, where it is not. Return a
+    dict of (n, 2) arrays."""
+    start, stop = ranges[:, 0], ranges[:, 1]
+    inside = np.minimum(start + 2, stop)
+    return dict(
+        whole=ranges,
+        inside=np.column_stack([inside, np.maximum(stop - 2, inside)]),
+        first=np.column_stack([start, inside]),
+        last=np.column_stack([np.maximum(stop - 2, start), stop]))
+
+def bounds_of(frames):
+    "The distinct bounds of the ranges that are not empty, sorted."
+    ranges = np.concatenate(frames.values())
+    return np.unique(ranges[ranges[:, 1] > ranges[:, 0]])
+
+def cell_edges(start, size, levels):
+    """The starts of the cells along one axis of tiles starting at start,
+    of the given size, halved levels times, computed as procreate does, so
+    that they round the same way. Return the starts, an array of shape
+    (len(start), 2**levels), and the cells' sizes."""
+    edges = np.asarray(start, dtype=float)[:, np.newaxis]
+    size = np.asarray(size, dtype=float)
+    for level in range(levels):
+        size = size/2
+        edges = (edges[:, :, np.newaxis]
+                 + size[:, np.newaxis, np.newaxis]*np.arange(2)).reshape(
+                     len(edges), -1)
+    return edges, size
+
+def distinct_ranges(starts, stops):
+    """The distinct (start, stop) pairs, as an (n, 2) array, and the index
+    of each pair among them, in the shape of starts."""
+    pairs = np.column_stack([starts.ravel(), stops.ravel()]).astype(int)
+    distinct, ids = np.unique(pairs.view([('', int)]*2), return_inverse=True)
+    return distinct.view(int).reshape(-1, 2), ids.reshape(starts.shape)
+
+class TileStats:
+    """For tiles (a TileSet, the parents of a recursive split) and their
+    descendants for depth generations, the dynamic range of the blurred
+    target, as image_functions.dynamic_range measures it, and whether they
+    straddle the edge of the mask. Cells are addressed by generation, the
+    index of the parent tile, and their column i and row j within it.
+
+    dynamic_range blurs a crop of each tile. PIL does not filter the two
+    pixels along an image's edges, so a blurred crop is the blurred target
+    inside, and the target itself along a frame two pixels wide. Both are
+    tabulated here, from one blur of the whole target, padded with black as
+    far as the cells reach outside it, as their crops are.
+
+    A generation's cells are bounded where their parents are, and more.
+    The minimum and maximum of both arrays are tabulated, in one pass, over
+    the blocks between all the bounds of the finest generation whose cells
+    are more than 16 pixels across, and each coarser generation's blocks
+    are reduced from the next one's. A cell is then a few blocks along
+    each axis, looked up only when it is asked about; smaller cells are
+    looked up in the pixels."""
+    def __init__(self, img, tiles, depth, mask=None):
+        "mask, if any, is a MaskStats."
+        self.xs, self.ys, self.ws, self.hs = [], [], [], []
+        # Cells of the last generation are not measured, only placed.
+        for g in range(depth + 1):
+            xs, w = cell_edges(tiles.x, tiles.w, g)
+            ys, h = cell_edges(tiles.y, tiles.h, g)
+            self.xs.append(xs)
+            self.ys.append(ys)
+            self.ws.append(w)
+            self.hs.append(h)
+        # The pixel ranges of the cells, as Tile.int_version rounds them.
+        x0 = [np.floor(xs) for xs in self.xs[:depth]]
+        x1 = [np.ceil(xs + w[:, np.newaxis])
+              for xs, w in zip(self.xs[:depth], self.ws)]
+        y0 = [np.floor(ys) for ys in self.ys[:depth]]
+        y1 = [np.ceil(ys + h[:, np.newaxis])
+              for ys, h in zip(self.ys[:depth], self.hs)]
+        columns, rows, self.columns, self.rows = [], [], [], []
+        for g in range(depth):
+            distinct, self_columns = distinct_ranges(x0[g], x1[g])
+            columns.append(distinct)
+            self.columns.append(self_columns)
+            distinct, self_rows = distinct_ranges(y0[g], y1[g])
+            rows.append(distinct)
+            self.rows.append(self_rows)
+        self.mask = mask
+        self.x0, self.x1, self.y0, self.y1 = x0, x1, y0, y1
+        self.bands = len(img.getbands())
+        self.column_blocks, self.row_blocks = [], []
+        self.low, self.high = [], []
+        if not depth:
+            return
+        left = max(0, -min(c[:, 0].min() for c in columns))
+        top = max(0, -min(r[:, 0].min() for r in rows))
+        right = max(c[:, 1].max() for c in columns)
+        bottom = max(r[:, 1].max() for r in rows)
+        if left or top or right > img.size[0] or bottom > img.size[1]:
+            img = img.crop((-left, -top, max(right, img.size[0]),
+                            max(bottom, img.size[1])))
+        column_frames = [frame_ranges(c + left) for c in columns]
+        row_frames = [frame_ranges(r + top) for r in rows]
+        # Raw and blurred, band by band.
+        arrays = [np.array([np.asarray(band) for band in img.split()]),
+                  np.array([np.asarray(band) for band
+                            in img.filter(ImageFilter.BLUR).split()])]
+        # Cells a few pixels across are looked up in the pixels themselves:
+        # the blocks between their bounds would be nearly as many as the
+        # pixels, and only the cells of the tiles that split are asked about.
+        coarse = 0
+        while coarse < depth and max(np.ptp(columns[coarse], 1).max(),
+                                     np.ptp(rows[coarse], 1).max()) > 16:
+            coarse += 1
+        self.low, self.high = [arrays]*depth, [arrays]*depth
+        self.column_blocks = list(column_frames)
+        self.row_blocks = list(row_frames)
+        # The bounds of each generation and those before it.
+        column_bounds, row_bounds = [], []
+        for g in range(coarse):
+            column_bounds.append(bounds_of(column_frames[g]) if g == 0 else
+                                 np.union1d(column_bounds[-1],
+                                            bounds_of(column_frames[g])))
+            row_bounds.append(bounds_of(row_frames[g]) if g == 0 else
+                              np.union1d(row_bounds[-1],
+                                         bounds_of(row_frames[g])))
+            self.column_blocks[g] = dict(
+                (part, np.searchsorted(column_bounds[g], ranges))
+                for part, ranges in column_frames[g].items())
+            self.row_blocks[g] = dict(
+                (part, np.searchsorted(row_bounds[g], ranges))
+                for part, ranges in row_frames[g].items())
+        for table, ufunc in (self.low, np.minimum), (self.high, np.maximum):
+            for g in reversed(range(coarse)):
+                if g == coarse - 1:
+                    bounds = row_bounds[g], column_bounds[g]
+                    blocks = arrays
+                else:
+                    bounds = (np.searchsorted(row_bounds[g + 1],
+                                              row_bounds[g]),
+                              np.searchsorted(column_bounds[g + 1],
+                                              column_bounds[g]))
+                    blocks = table[g + 1]
+                table[g] = [block_reduce(ufunc, bands, *bounds)
+                            for bands in blocks]
+
+    def dynamic_range(self, g, parent, i, j):
+        "The blurred dynamic range of the cells, given as arrays."
+        column = np.ravel(self.columns[g][parent, i])
+        row = np.ravel(self.rows[g][parent, j])
+        columns = dict((part, blocks[column])
+                       for part, blocks in self.column_blocks[g].items())
+        rows = dict((part, blocks[row])
+                    for part, blocks in self.row_blocks[g].items())
+        extrema = []
+        for table, ufunc, empty in ((self.low, np.minimum, 255),
+                                    (self.high, np.maximum, 0)):
+            raw, blurred = table[g]
+            # The blurred inside, and the frame two pixels wide.
+            extrema.append(reduce(ufunc, [
+                rect_lookup(ufunc, blurred, rows['inside'],
+                            columns['inside'], empty),
+                rect_lookup(ufunc, raw, rows['first'], columns['whole'],
+                            empty),
+                rect_lookup(ufunc, raw, rows['last'], columns['whole'],
+                            empty),
+                rect_lookup(ufunc, raw, rows['whole'], columns['first'],
+                            empty),
+                rect_lookup(ufunc, raw, rows['whole'], columns['last'],
+                            empty)]))
+        low, high = extrema
+        ranges = (high.astype(np.int16) - low).sum(1)//self.bands
+        return ranges.reshape(np.shape(parent))[()]
+
+    def straddles_mask_edge(self, g, parent, i, j):
+        """Whether each of the cells has some white (255) pixels and some
+        that are not, like Partition.straddles_mask_edge."""
+        if self.mask is None:
+            return np.zeros(np.shape(parent), dtype=bool)
+        return self.mask.straddles_edge(
+            self.x0[g][parent, i], self.y0[g][parent, j],
+            self.x1[g][parent, i], self.y1[g][parent, j])
+
+    def quad(self, g, parent, i, j):
+        "The (x, y, w, h) of one cell, as procreate would give it."
+        return (float(self.xs[g][parent, i]), float(self.ys[g][parent, j]),
+                float(self.ws[g][parent]), float(self.hs[g][parent]))
+
+def integral(counted):
+    """The summed-area table of a boolean array: table[y, x] is the number
+    of true pixels above and left of (x, y)."""
+    table = np.zeros((counted.shape[0] + 1, counted.shape[1] + 1),
+                     dtype=np.int32)
+    counted.cumsum(0, dtype=np.int32).cumsum(1, out=table[1:, 1:])
+    return table
+
+class MaskStats:
+    """Statistics of a mask over many tiles at once. Tiles are given as
+    arrays of their pixel boxes, x0 <= x < x1 and y0 <= y < y1, which may
+    reach outside the mask; the pixels there count as black, as in a crop.
+    Counts come from summed-area tables, so each is a lookup. Only the
+    brightest pixel of a grey tile (neither pure white anywhere nor black
+    everywhere) takes reading its pixels, and a two-level mask has none."""
+    def __init__(self, mask):
+        self.pixels = np.asarray(mask.convert('L'))
+        self.height, self.width = self.pixels.shape
+        self.white = integral(self.pixels == 255)
+        grey = (self.pixels > 0) & (self.pixels < 255)
+        self.lit = integral(self.pixels > 0) if grey.any() else self.white
+
+    def _count(self, table, x0, y0, x1, y1):
+        x0, x1 = [np.clip(x, 0, self.width).astype(int) for x in (x0, x1)]
+        y0, y1 = [np.clip(y, 0, self.height).astype(int) for y in (y0, y1)]
+        return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+    def counts(self, x0, y0, x1, y1):
+        "The white, lit and total pixels of each box."
+        white = self._count(self.white, x0, y0, x1, y1)
+        lit = white if self.lit is self.white else \
+            self._count(self.lit, x0, y0, x1, y1)
+        return white, lit, (np.asarray(x1) - x0)*(np.asarray(y1) - y0)
+
+    def straddles_edge(self, x0, y0, x1, y1):
+        """Whether each box has some pure white (255) and some that is not.
+        Varying shades of grey are not an edge."""
+        white, lit, area = self.counts(x0, y0, x1, y1)
+        return (white > 0) & (white < area)
+
+    def brightest(self, x0, y0, x1, y1, budget=64 << 20):
+        """The brightest pixel of each box, as getextrema()[1] of a crop.
+        Boxes of grey are read, those of the same size together, budget
+        bytes at a time."""
+        white, lit, area = self.counts(x0, y0, x1, y1)
+        brightest = np.where(white > 0, 255, 0).astype(np.uint8)
+        grey = np.flatnonzero((white == 0) & (lit > 0))
+        if not len(grey):
+            return brightest
+        x0, x1 = [np.clip(np.asarray(x)[grey], 0, self.width).astype(int)
+                  for x in (x0, x1)]
+        y0, y1 = [np.clip(np.asarray(y)[grey], 0, self.height).astype(int)
+                  for y in (y0, y1)]
+        shapes = np.column_stack([x1 - x0, y1 - y0])
+        for w, h in set(map(tuple, shapes.tolist())):
+            same = np.flatnonzero((shapes[:, 0] == w) & (shapes[:, 1] == h))
+            block = max(1, budget//(8*w*h))
+            for start in range(0, len(same), block):
+                chosen = same[start:start + block]
+                ys = y0[chosen, np.newaxis] + np.arange(h)
+                xs = x0[chosen, np.newaxis] + np.arange(w)
+                pixels = self.pixels[ys[:, :, np.newaxis],
+                                     xs[:, np.newaxis, :]]
+                brightest[grey[chosen]] = pixels.reshape(
+                    len(chosen), -1).max(1)
+        return brightest